@@ -1,6 +1,11 @@
 from pathlib import Path
+from array import array
+from collections.abc import Sequence
 import json
+import mmap
+import os
 import random
+import threading
 from config import config
 
 
@@ -8,16 +13,125 @@ def random_number(json_data):
     num_int = random.randint(1, len(json_data) - 1)
     return num_int
 
-class WomenShortStories:
-    json_ins = json.loads(Path(r"D:\01_AI_project\AI_writer\data_library\导语库.json").read_text(encoding='utf-8'))
-    json_plot = json.loads(Path(r"D:\01_AI_project\AI_writer\data_library\主线剧情库.json").read_text(encoding='utf-8'))
-    json_emotion_plot = json.loads(Path(r"D:\01_AI_project\AI_writer\data_library\情绪剧情库.json").read_text(encoding='utf-8'))
 
-    prompt_ins = Path(config['prompt_path_ins']).read_text(encoding='utf-8')
-    prompt_plot = Path(config['prompt_path_change']).read_text(encoding='utf-8')
-    prompt_text = Path(config['prompt_path_text']).read_text(encoding='utf-8')
-    prompt_text_copy = Path(config['prompt_path_text_copy']).read_text(encoding='utf-8')
+class JsonLibrary(Sequence):
+    """
+    按需加载的 JSON 素材库：首次访问时把源 JSON 数组转成 JSONL + 偏移索引，
+    之后按下标直接定位单条记录，无需解析整个文件；源文件 mtime 变化时自动重建
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.jsonl_path = self.path.with_suffix('.jsonl')
+        self.index_path = self.path.with_suffix('.idx')
+        self._offsets = None
+        self._mm = None
+        self._lock = threading.Lock()
+
+    def _source_mtime(self):
+        if not self.path.exists():
+            raise FileNotFoundError(f"素材库文件不存在: {self.path}")
+        return self.path.stat().st_mtime_ns
+
+    def _load_index(self, mtime):
+        # 索引格式: [源文件 mtime_ns, 记录数, offset_0, ..., offset_n]（int64）
+        if not (self.index_path.exists() and self.jsonl_path.exists()):
+            return None
+        data = array('q')
+        data.frombytes(self.index_path.read_bytes())
+        if len(data) < 2 or data[0] != mtime or len(data) != data[1] + 3:
+            return None
+        return data[2:]
+
+    def _build_index(self, mtime):
+        records = json.loads(self.path.read_text(encoding='utf-8'))
+        offsets = array('q')
+        tmp_jsonl = self.jsonl_path.with_suffix('.jsonl.tmp')
+        with open(tmp_jsonl, 'wb') as f:
+            for record in records:
+                offsets.append(f.tell())
+                f.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+            offsets.append(f.tell())
+        header = array('q', [mtime, len(records)])
+        tmp_index = self.index_path.with_suffix('.idx.tmp')
+        tmp_index.write_bytes(header.tobytes() + offsets.tobytes())
+        os.replace(tmp_jsonl, self.jsonl_path)
+        os.replace(tmp_index, self.index_path)
+        return offsets
+
+    def _ensure_loaded(self):
+        if self._offsets is not None:
+            return
+        with self._lock:
+            if self._offsets is not None:
+                return
+            mtime = self._source_mtime()
+            offsets = self._load_index(mtime)
+            if offsets is None:
+                offsets = self._build_index(mtime)
+            with open(self.jsonl_path, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else b''
+            self._offsets = offsets
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._offsets) - 1
 
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        raw = None
+        while raw is None:
+            self._ensure_loaded()
+            # 在锁内读取：reload() 会关闭旧的映射
+            with self._lock:
+                if self._offsets is not None:
+                    raw = self._read(idx)
+        return json.loads(raw)
 
+    def _read(self, idx):
+        n = len(self._offsets) - 1
+        if idx < 0:
+            idx += n
+        if not 0 <= idx < n:
+            raise IndexError(f"{self.path.name} 下标越界: {idx}")
+        return self._mm[self._offsets[idx]:self._offsets[idx + 1]]
 
+    def reload(self):
+        """
+        丢弃已加载的索引，下次访问时重新检查源文件
+        旧的映射随即关闭，否则每次重载都泄漏一个映射，Windows 上还会挡住重建时替换 JSONL 文件
+        """
+        with self._lock:
+            if isinstance(self._mm, mmap.mmap):
+                self._mm.close()
+            self._offsets = None
+            self._mm = None
+
+
+class LazyText:
+    """
+    类属性描述符：首次访问时才读取提示词文件
+    """
+
+    def __init__(self, config_key):
+        self.config_key = config_key
+        self._value = None
+
+    def __get__(self, instance, owner):
+        if self._value is None:
+            self._value = Path(config[self.config_key]).read_text(encoding='utf-8')
+        return self._value
+
+
+class WomenShortStories:
+    json_ins = JsonLibrary(r"D:\01_AI_project\AI_writer\data_library\导语库.json")
+    json_plot = JsonLibrary(r"D:\01_AI_project\AI_writer\data_library\主线剧情库.json")
+    json_emotion_plot = JsonLibrary(r"D:\01_AI_project\AI_writer\data_library\情绪剧情库.json")
+    # 参考故事库：corpus_ingest.py 从 docx 原文切出的 导语/付费点/结尾
+    json_reference = JsonLibrary(config['reference_library'])
 
+    prompt_ins = LazyText('prompt_path_ins')
+    prompt_plot = LazyText('prompt_path_change')
+    prompt_text = LazyText('prompt_path_text')
+    prompt_text_copy = LazyText('prompt_path_text_copy')
@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import time
+from log import logger
+from config import config
+from model_test import write_story
+from key_pool import get_key_pool
+from concurrency_limiter import format_all
+import llm_client
+
+
+async def run_batch_async(total, concurrency, resume=False, parallel=config['parallel_chapters']):
+    """
+    所有故事都是同一个事件循环里的协程，信号量限制同时进行的篇数；
+    实际同时发出的模型请求数由 concurrency_limiter 的自适应窗口决定
+    """
+    start = time.time()
+    done, failed = [], []
+    logger.info(f"批量写作开始：共 {total} 篇，并发 {concurrency}")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(i):
+        async with semaphore:
+            # 并发时关闭逐字打印，否则多篇输出会交错在一起
+            return await write_story(i, False, resume, parallel)
+
+    tasks = {asyncio.ensure_future(run_one(i)): i for i in range(total)}
+    pending = set(tasks)
+    while pending:
+        finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in finished:
+            i = tasks[task]
+            try:
+                done.append(task.result())
+            except Exception as e:
+                failed.append(i + 1)
+                logger.error(f"第 {i+1} 篇写作失败: {e}")
+            logger.info(f"进度: {len(done) + len(failed)}/{total}，成功 {len(done)}，失败 {len(failed)}")
+            logger.info(get_key_pool().format_usage())
+            if config['limiter_enabled']:
+                logger.info(format_all())
+
+    elapsed = time.time() - start
+    logger.info(f"批量写作结束：成功 {len(done)} 篇，失败 {len(failed)} 篇，耗时 {elapsed / 60:.1f} 分钟")
+    if failed:
+        logger.warning(f"失败的篇目序号: {sorted(failed)}")
+    return done, failed
+
+
+def run_batch(total=config['batch_total'], concurrency=config['batch_concurrency'], resume=False,
+              parallel=config['parallel_chapters']):
+    """
+    并发执行多篇故事写作，每篇内部仍按 导语 → 大纲 → 正文×3 顺序执行
+    concurrency 为同时进行的故事数上限，resume=True 时各篇从检查点继续，
+    parallel=True 时每篇的三段正文并行生成
+    返回 (成功路径列表, 失败序号列表)
+    """
+    return llm_client.run_sync(run_batch_async(total, concurrency, resume, parallel))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='并发批量写作')
+    parser.add_argument('-n', '--total', type=int, default=config['batch_total'], help='总篇数')
+    parser.add_argument('-c', '--concurrency', type=int, default=config['batch_concurrency'], help='同时写作的篇数')
+    parser.add_argument('--resume', action='store_true', help='从检查点继续未完成的故事')
+    parser.add_argument('--parallel', action='store_true', default=config['parallel_chapters'],
+                        help='大纲完成后三段正文并行生成')
+    args = parser.parse_args()
+    run_batch(args.total, max(1, args.concurrency), args.resume, args.parallel)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from log import logger
+from config import config
+
+try:
+    import resource  # 仅 Unix
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# 端到端压测：本地模拟接口 + 五步写作流程，在不同并发下统计每小时篇数、各步耗时、客户端 CPU 和峰值内存
+# 用法: python benchmark.py --levels 1 4 16 64 --stories 16
+# 每个并发级别在独立子进程中运行，CPU 和峰值内存互不干扰；结果保存到 config['bench_dir']，并与上一次结果对比
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def peak_rss_mb():
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 单位是 KB，macOS 是字节
+        return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return round(getattr(info, 'peak_wset', info.rss) / (1024 * 1024), 1)
+    return None
+
+
+def cpu_seconds():
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+    return time.process_time()
+
+
+def run_level(level, stories, url, workdir, limiter=True):
+    """
+    子进程内执行：对模拟接口并发写 stories 篇，返回本级别的统计
+    """
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    config.update({
+        'url': url,
+        'cache_enabled': False,
+        'metrics_path': os.path.join(workdir, 'metrics.jsonl'),
+        'limiter_enabled': limiter,
+        'limiter_initial': level,
+        'limiter_max': max(config['limiter_max'], level),
+        # 回放语料与步骤不对应（导语步骤也可能回放正文），关闭质量检查以免被当成坏输出反复重试
+        'quality_enabled': False,
+        # 去重索引（含进程池）和会话日志不属于编排层，开着会把它们的 CPU、内存和磁盘写入算进客户端
+        'dedup_enabled': False,
+        'session_log': False,
+    })
+    # 配置改完再导入，模块级默认参数读到的是压测配置
+    import metrics
+    from batch_runner import run_batch
+
+    cpu_start = cpu_seconds()
+    start = time.time()
+    done, failed = run_batch(stories, level)
+    wall = time.time() - start
+    cpu = cpu_seconds() - cpu_start
+
+    steps = {}
+    if os.path.exists(config['metrics_path']):
+        for row in metrics.summarize(metrics.load(config['metrics_path'])):
+            steps[row['step']] = {k: row[k] for k in ('count', 'failed', 'retries', 'duration_p50',
+                                                       'duration_p95', 'ttft_p50', 'ttft_p95')}
+    return {
+        'concurrency': level,
+        'stories': stories,
+        'ok': len(done),
+        'failed': len(failed),
+        'wall_seconds': round(wall, 2),
+        'stories_per_hour': round(len(done) / wall * 3600, 1) if wall > 0 else None,
+        'cpu_seconds': round(cpu, 2),
+        'cpu_percent': round(cpu / wall * 100, 1) if wall > 0 else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'steps': steps,
+    }
+
+
+def wait_ready(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/models", timeout=2):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"模拟接口未就绪: {url}")
+
+
+def start_mock(args):
+    """
+    模拟接口放在单独进程，避免它的 CPU 计入客户端
+    """
+    cmd = [sys.executable, os.path.join(HERE, 'mock_server.py'), '--port', str(args.port),
+           '--ttft', str(args.ttft), '--tps', str(args.tps), '--max-chars', str(args.max_chars),
+           '--fault-429', str(args.fault_429), '--fault-timeout', str(args.fault_timeout), '--seed', '1']
+    proc = subprocess.Popen(cmd, cwd=HERE)
+    url = f"http://127.0.0.1:{args.port}/v1"
+    try:
+        wait_ready(url)
+    except TimeoutError:
+        proc.kill()
+        raise
+    return proc, url
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_result(bench_dir):
+    files = sorted(f for f in os.listdir(bench_dir) if f.startswith('bench_') and f.endswith('.json'))
+    if not files:
+        return None
+    with open(os.path.join(bench_dir, files[-1]), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def print_results(results, previous=None):
+    before = {r['concurrency']: r for r in previous['results']} if previous else {}
+    print('并发 | 成功/总数 | 每小时篇数 | 对比上次 | 耗时(s) | CPU(s) | CPU% | 峰值内存(MB)')
+    for r in results:
+        old = before.get(r['concurrency'])
+        delta = '-'
+        if old and old.get('stories_per_hour') and r['stories_per_hour'] is not None:
+            delta = f"{(r['stories_per_hour'] / old['stories_per_hour'] - 1) * 100:+.1f}%"
+        print(f"{r['concurrency']} | {r['ok']}/{r['stories']} | {r['stories_per_hour']} | {delta} | "
+              f"{r['wall_seconds']} | {r['cpu_seconds']} | {r['cpu_percent']} | {r['peak_rss_mb']}")
+    for r in results:
+        print(f"\n并发 {r['concurrency']} 各步耗时：步骤 | 次数 | 耗时p50 | 耗时p95 | 首token p50 | 首token p95")
+        for step, s in r['steps'].items():
+            print(f"  {step} | {s['count']} | {s['duration_p50']} | {s['duration_p95']} | "
+                  f"{s['ttft_p50']} | {s['ttft_p95']}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='五步写作流程端到端压测（本地模拟接口）')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 4, 16, 64], help='并发级别')
+    parser.add_argument('--stories', type=int, default=16, help='每个级别写多少篇')
+    parser.add_argument('--port', type=int, default=config['mock_port'])
+    parser.add_argument('--ttft', type=float, default=0.5, help='模拟首 token 延迟（秒）')
+    parser.add_argument('--tps', type=float, default=400, help='模拟每秒输出 token 数')
+    parser.add_argument('--max-chars', type=int, default=2000, help='模拟回复最多多少字')
+    parser.add_argument('--fault-429', type=float, default=0.0)
+    parser.add_argument('--fault-timeout', type=float, default=0.0)
+    parser.add_argument('--no-limiter', action='store_true', help='关闭自适应并发窗口')
+    parser.add_argument('--out', default=config['bench_dir'], help='结果保存目录')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.child:
+        result = run_level(args.child, args.stories, args.url, args.workdir, limiter=not args.no_limiter)
+        with open(os.path.join(args.workdir, 'result.json'), 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False)
+        return
+
+    os.makedirs(args.out, exist_ok=True)
+    previous = previous_result(args.out)
+    proc, url = start_mock(args)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix='bench_') as tmp:
+            for level in args.levels:
+                logger.info(f"压测并发 {level}，共 {args.stories} 篇")
+                workdir = os.path.join(tmp, f'c{level}')
+                cmd = [sys.executable, os.path.abspath(__file__), '--child', str(level),
+                       '--stories', str(args.stories), '--url', url, '--workdir', workdir]
+                if args.no_limiter:
+                    cmd.append('--no-limiter')
+                subprocess.run(cmd, cwd=HERE, check=True)
+                with open(os.path.join(workdir, 'result.json'), 'r', encoding='utf-8') as f:
+                    results.append(json.load(f))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    report = {
+        'ts': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mock': {'ttft': args.ttft, 'tps': args.tps, 'max_chars': args.max_chars,
+                 'fault_429': args.fault_429, 'fault_timeout': args.fault_timeout},
+        'limiter': not args.no_limiter,
+        'results': results,
+    }
+    path = os.path.join(args.out, f"bench_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print_results(results, previous)
+    logger.info(f"压测结果已保存至 {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import json
+import os
+from pathlib import Path
+from config import config
+
+
+def _checkpoint_path(story_id):
+    return Path(config['checkpoint_dir']) / f'story_{story_id}.json'
+
+
+def save_checkpoint(story_id, state):
+    """
+    写入检查点（先写临时文件再替换，避免写到一半崩溃留下损坏文件）
+    """
+    path = _checkpoint_path(story_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_checkpoint(story_id):
+    """
+    读取检查点，不存在或损坏时返回 None
+    """
+    path = _checkpoint_path(story_id)
+    if not path.exists():
+        return None
+    try:
+        return json.loads(path.read_text(encoding='utf-8'))
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def clear_checkpoint(story_id):
+    _checkpoint_path(story_id).unlink(missing_ok=True)
@@ -0,0 +1,68 @@
+import threading
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+
+try:
+    import h2  # noqa: F401  # 安装了 h2 才能启用 HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 每个 (base_url, api_key) 只建一个客户端，整个进程内复用连接池
+_clients = {}
+_async_clients = {}
+_lock = threading.Lock()
+
+# 长时间流式输出之间保持连接，避免每轮重新握手
+_limits = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=300)
+
+
+def get_client(base_url, api_key):
+    """
+    获取共享的 OpenAI 客户端（线程安全），同一 base_url + api_key 复用同一个连接池
+    """
+    key = (base_url, api_key)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                http_client = DefaultHttpxClient(http2=HTTP2_AVAILABLE, limits=_limits)
+                client = OpenAI(base_url=base_url, api_key=api_key, http_client=http_client)
+                _clients[key] = client
+    return client
+
+
+def get_async_client(base_url, api_key):
+    """
+    获取共享的 AsyncOpenAI 客户端；连接池绑定事件循环，只能在 llm_client 的后台事件循环中使用
+    重试由 llm_client 统一处理，这里关闭 SDK 自带重试
+    """
+    key = (base_url, api_key)
+    client = _async_clients.get(key)
+    if client is None:
+        with _lock:
+            client = _async_clients.get(key)
+            if client is None:
+                http_client = DefaultAsyncHttpxClient(http2=HTTP2_AVAILABLE, limits=_limits)
+                client = AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http_client, max_retries=0)
+                _async_clients[key] = client
+    return client
+
+
+def close_all():
+    """
+    关闭所有共享客户端（进程退出前调用，不能在 llm_client 的后台事件循环线程内调用）
+    异步客户端的连接池绑定后台事件循环，需要在该循环上关闭
+    """
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        async_clients = list(_async_clients.values())
+        _async_clients.clear()
+    if async_clients:
+        # llm_client 导入了本模块，这里用到时再导入
+        import llm_client
+        for client in async_clients:
+            llm_client.run_sync(client.close())
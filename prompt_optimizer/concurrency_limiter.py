@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import time
+import openai
+from log import logger
+from config import config
+
+
+def is_overload(error):
+    """
+    429、5xx 和超时视为服务端过载信号；鉴权失败、请求错误、取消等不影响并发窗口
+    """
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, TimeoutError)):
+        return True
+    status = getattr(error, 'status_code', None)
+    return status is not None and status >= 500
+
+
+class LimiterSlot:
+    """
+    一次调用占用的并发名额：async with 块内收到首个 token 时设置 ttft，
+    退出时按是否出错、是否过载、首 token 延迟调整窗口
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.started = 0.0
+        self.ttft = None
+
+    async def __aenter__(self):
+        await self.limiter.acquire()
+        self.started = time.time()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.limiter.release(self, exc)
+        return False
+
+
+class AdaptiveLimiter:
+    """
+    AIMD 并发窗口：请求成功且首 token 延迟正常时窗口每轮 +1（每次成功 +1/窗口），
+    遇到 429/5xx/超时窗口乘以 backoff，首 token 延迟超过基线 latency_ratio 倍时轻微收缩；
+    同一轮窗口内的多次失败只收缩一次（只对上次收缩之后发出的请求生效）
+    只在 llm_client 的事件循环中使用
+    """
+
+    def __init__(self, name, initial=None, min_limit=None, max_limit=None, backoff=None, latency_ratio=None):
+        self.name = name
+        self.limit = float(initial or config['limiter_initial'])
+        self.min_limit = min_limit or config['limiter_min']
+        self.max_limit = max_limit or config['limiter_max']
+        self.backoff = backoff or config['limiter_backoff']
+        self.latency_ratio = latency_ratio or config['limiter_latency_ratio']
+        self.in_flight = 0
+        self.requests = 0
+        self.overloads = 0
+        self.baseline = None  # 首 token 延迟基线（近期最小值，缓慢上浮）
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+
+    @property
+    def window(self):
+        return max(self.min_limit, int(self.limit))
+
+    def slot(self):
+        return LimiterSlot(self)
+
+    async def acquire(self):
+        async with self._cond:
+            while self.in_flight >= self.window:
+                await self._cond.wait()
+            self.in_flight += 1
+            self.requests += 1
+
+    async def release(self, slot, error=None):
+        async with self._cond:
+            busy = self.in_flight >= self.window
+            self.in_flight -= 1
+            before = self.window
+            if error is None:
+                self._on_success(slot, busy)
+            elif is_overload(error):
+                self.overloads += 1
+                self._decrease(slot, self.backoff, f"过载: {type(error).__name__}")
+            if self.window > before:
+                logger.info(f"[{self.name}] 并发窗口扩大至 {self.window}")
+            self._cond.notify_all()
+
+    def _on_success(self, slot, busy):
+        if slot.ttft is not None:
+            if self.baseline is None or slot.ttft < self.baseline:
+                self.baseline = slot.ttft
+            else:
+                self.baseline += (slot.ttft - self.baseline) * 0.05
+            if slot.ttft > self.baseline * self.latency_ratio:
+                self._decrease(slot, 0.9, f"首 token 延迟 {slot.ttft:.1f}s")
+                return
+        # 窗口没用满时不扩大，避免空闲时窗口无限增长
+        if busy:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _decrease(self, slot, factor, reason):
+        if slot.started < self._last_decrease:
+            return
+        self._last_decrease = time.time()
+        before = self.window
+        self.limit = max(self.min_limit, self.limit * factor)
+        if self.window < before:
+            logger.warning(f"[{self.name}] 并发窗口收缩至 {self.window}（{reason}）")
+
+    def snapshot(self):
+        return {
+            'name': self.name,
+            'window': self.window,
+            'limit': round(self.limit, 2),
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'overloads': self.overloads,
+            'baseline_ttft': round(self.baseline, 2) if self.baseline is not None else None,
+        }
+
+    def format_status(self):
+        s = self.snapshot()
+        return (f"并发窗口 [{s['name']}]: {s['window']}（进行中 {s['in_flight']}，请求 {s['requests']}，"
+                f"过载 {s['overloads']}，首 token 基线 {s['baseline_ttft']}s）")
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(base_url=None):
+    """
+    每个接口地址一个并发窗口，进程内共享
+    """
+    base_url = base_url or config['url']
+    limiter = _limiters.get(base_url)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(base_url)
+            if limiter is None:
+                limiter = AdaptiveLimiter(base_url)
+                _limiters[base_url] = limiter
+    return limiter
+
+
+def format_all():
+    return "\n".join(limiter.format_status() for limiter in list(_limiters.values()))
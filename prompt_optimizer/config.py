@@ -14,5 +14,142 @@ config = {
     'prompt_path_text': r'D:\03_note\个人知识库\数字员工\AI作家\小程序风\prompt\正文撰写--三次输出.md',
     'prompt_path_text_copy': r'D:\03_note\个人知识库\数字员工\AI作家\小程序风\prompt\文章仿写.md',
     'log_debug': False,
+    # 参与轮换的 key（上面的配置项名称）；401/403 与 429 后的冷却秒数
+    'api_keys': ["api-key-余额-50", "api-key-8192", "API-100"],
+    'key_auth_cooldown': 600,
+    'key_rate_cooldown': 30,
+    # 批量写作：总篇数与同时进行的故事数
+    'batch_total': 5,
+    'batch_concurrency': 4,
+    # 模型输出缓存：相同 (model, temperature, messages) 直接复用结果
+    'cache_enabled': False,
+    'cache_path': 'response_cache.db',
+    'cache_max_mb': 200,
+    # 五步写作的检查点目录（--resume 从这里恢复）
+    'checkpoint_dir': 'checkpoints',
+    # 并行正文：大纲完成后三段正文同时生成，再修整段落衔接处（前后各取多少字）
+    'parallel_chapters': False,
+    'stitch_chars': 600,
+    # 滚动摘要：续写（第 4、5 步）时用前情摘要 + 人物/剧情状态 + 上一章结尾原文代替前面各章全文，
+    # 每段正文完成后更新一次摘要；摘要字数上限与保留的上一章结尾字数
+    'rolling_summary': False,
+    'summary_max_chars': 1200,
+    'summary_tail_chars': 1500,
+    # 每一步输入 token 预算（估算值，超出时告警）
+    'step_token_budget': 40000,
+    # 提示词前缀复用：True 时固定提示词放在用户消息开头、素材在后（会改变提示词顺序，默认保持原顺序）
+    'stable_prefix': False,
+    # cache_control 标记：'auto' 时只对 Claude 系列且接口在 cache_marker_urls 中时添加，True/False 强制开关
+    'cache_markers': 'auto',
+    'cache_marker_urls': ['https://openrouter.ai/api/v1'],
+    # 流式调用时请求 usage，用于统计缓存命中 token
+    'stream_usage': True,
+    # 单次模型调用超时（秒），超时后按失败重试
+    'call_timeout': 900,
+    # 流式看门狗：首 token 时限与两次输出之间的最长间隔（秒，0 为不限），超时中止并重试
+    'first_token_timeout': 120,
+    'chunk_idle_timeout': 60,
+    # 自适应并发窗口（AIMD）：成功且首 token 延迟正常时逐步扩大，429/5xx/超时时乘以 backoff 收缩
+    'limiter_enabled': True,
+    'limiter_initial': 4,
+    'limiter_min': 1,
+    'limiter_max': 64,
+    'limiter_backoff': 0.5,
+    # 首 token 延迟超过基线多少倍视为拥塞
+    'limiter_latency_ratio': 3.0,
+    # 本地模拟接口（mock_server.py）端口和回放语料
+    'mock_port': 8900,
+    'mock_corpus': ['text.log', 'test_*.txt'],
+    # 压测结果目录（benchmark.py，每次一个 JSON，便于版本间对比）
+    'bench_dir': 'benchmarks',
+    # 参考故事入库（corpus_ingest.py）：源目录、入库文件、进程数（0 为 CPU 核数）
+    'reference_dirs': ['../10.13'],
+    'reference_library': r'D:\01_AI_project\AI_writer\data_library\参考故事库.json',
+    'ingest_workers': 0,
+    # 付费点取全文该比例位置所在章节；没有章节号时导语/付费点/结尾各截取的字数
+    'ingest_paid_ratio': 0.3,
+    'ingest_fallback_chars': 800,
+    # 导语/剧情配对：'similar' 按 MinHash 相似度从前 pair_top_k 条剧情中选，'random' 为各自随机
+    'pair_selection': 'similar',
+    'pair_top_k': 5,
+    # MinHash：字符 n-gram 长度与签名长度（修改后签名文件自动重建）
+    'similarity_shingle': 2,
+    'similarity_perm': 64,
+    # 生成结果查重（dedup_check.py）：索引文件、历史输出、片段字数、MinHash 参数（LSH 每段 dedup_rows 个值）
+    'dedup_enabled': True,
+    'dedup_index': 'dedup_index.db',
+    'dedup_outputs': ['test_*.txt'],
+    'dedup_chunk_chars': 800,
+    'dedup_shingle': 5,
+    'dedup_perm': 128,
+    'dedup_rows': 2,
+    # 片段相似度或对方片段被覆盖比例超过阈值时告警
+    'dedup_threshold': 0.3,
+    'dedup_containment': 0.5,
+    'dedup_top_k': 5,
+    # 会话日志（JSONL，每次模型调用的完整输入和输出）与重放结果目录（replay.py）
+    'session_log': True,
+    'session_dir': 'sessions',
+    'replay_dir': 'replays',
+    # 持久化任务队列（job_queue.py / job_worker.py）：本地 SQLite 文件或远程队列地址 http://host:port
+    'job_store': 'jobs.db',
+    # 远程队列服务端口和访问 token（服务端与各 worker 配置相同的值）
+    'job_port': 8901,
+    'job_token': '',
+    # 租约秒数、心跳间隔、每个任务最多领取次数
+    'job_lease': 180,
+    'job_heartbeat': 30,
+    'job_max_attempts': 3,
+    # 每个 worker 同时写作的篇数；队列空时多久查一次
+    'job_concurrency': 4,
+    'job_poll_interval': 10,
+    # 本地生成服务（gen_server.py）：Qt 界面通过它调用模型；地址为本机时界面会自动启动服务
+    'gen_server': 'http://127.0.0.1:8902',
+    'gen_server_port': 8902,
+    # 多人共用时的访问 token（监听非本机地址时必须设置）；已结束任务保留个数；SSE 心跳间隔（秒）
+    'gen_server_token': '',
+    'gen_server_keep': 200,
+    'gen_server_ping': 15,
+    # 服务端落盘（save_path）只允许写到这个目录内，相对路径按它解析
+    'gen_server_output_dir': 'outputs',
+    # 流式质量检查（stream_checks.py）：每一步（导语、大纲、正文×3）启用的检查，不通过时立即中止本次输出并重试
+    'quality_enabled': True,
+    'quality_checks': [
+        ['refusal', 'meta', 'language', 'repetition'],
+        ['refusal', 'language', 'repetition'],
+        ['refusal', 'meta', 'headings', 'language', 'repetition'],
+        ['refusal', 'meta', 'headings', 'language', 'repetition'],
+        ['refusal', 'meta', 'headings', 'language', 'repetition'],
+    ],
+    # 每收到多少字检查一次
+    'quality_check_every': 200,
+    # 拒答/说明性语句：只检查输出开头多少字
+    'quality_refusal_chars': 200,
+    'quality_refusal_phrases': ['作为一个AI', '作为AI', '作为人工智能', 'AI助手', '语言模型', '无法满足您的', '无法协助',
+                                '不能协助', '无法为您', '不能为您', "I'm sorry", 'I cannot', "I can't", 'As an AI'],
+    # 「好的，」单独出现可能是正文开头的对白，只匹配模型自述的「好的，我…」
+    'quality_meta_phrases': ['以下是', '下面是', '好的，我', '好的！我', '我将为您', '我来为您', '为您创作', '希望您喜欢'],
+    # 章节标题：第一个 # N 须在前多少字内出现；两个标题之间最多多少字
+    'quality_heading_chars': 500,
+    'quality_chapter_max_chars': 5000,
+    # 语言跑偏：最近多少字内汉字在汉字+拉丁字母中的占比下限
+    'quality_language_window': 500,
+    'quality_cjk_min': 0.6,
+    # 重复循环：最后多少字在最近多少字内出现不少于几次
+    'quality_repeat_chars': 50,
+    'quality_repeat_window': 3000,
+    'quality_repeat_times': 3,
+    # 步骤耗时/token 指标（JSONL），汇总: python metrics.py summary
+    'metrics_path': 'metrics.jsonl',
+    'metrics_steps': ['导语', '大纲', '正文1', '正文2', '正文3'],
+    # 流式输出落盘：每篇故事每一步一个文件，按字符数/时间间隔刷新
+    'stream_dir': 'stream_output',
+    'stream_flush_chars': 512,
+    'stream_flush_interval': 1.0,
+    # 流式输出 fsync 间隔（秒）：flush 只交给操作系统，按此间隔和关闭文件时才 fsync，避免频繁阻塞事件循环
+    'stream_fsync_interval': 10.0,
+    # Qt 界面：流式输出刷新间隔（毫秒，约 40Hz）与日志框保留行数
+    'ui_flush_interval_ms': 25,
+    'ui_log_max_lines': 2000,
 }
 
@@ -0,0 +1,225 @@
+import re
+from log import logger
+from config import config
+
+CONTINUE_PROMPTS = ["继续创作五到七章", "继续创作八到十章"]
+
+# 并行正文：三段各自负责的章节范围
+CHAPTER_BATCHES = [(1, 4), (5, 7), (8, 10)]
+
+HANDOFF_PROMPT = (
+    "请根据下面的剧情大纲，分别用两三句话概括故事在第4章结尾、第7章结尾时的状态"
+    "（人物处境、刚发生的事件、悬念），严格按以下格式输出，不要输出其他内容：\n"
+    "【第4章结尾】：……\n【第7章结尾】：……"
+)
+
+SUMMARY_PROMPT = (
+    "请根据【已有摘要】和【新写章节】更新故事状态，供后续续写时代替前文原文使用。"
+    "严格按以下格式输出，不要输出其他内容：\n"
+    "【前情摘要】：按章概括到目前为止的主要情节，每章一两句\n"
+    "【人物状态】：每个主要人物的身份、处境、彼此关系、已知和隐瞒的秘密\n"
+    "【剧情状态】：已埋下的伏笔和悬念、尚未解决的冲突、最后一章结束时的场景和时间\n"
+    f"总字数不超过{config['summary_max_chars']}字。"
+)
+
+STITCH_PROMPT = (
+    "下面是小说相邻两部分的衔接处：【前文结尾】与【后文开头】。"
+    "请在不改变情节和人物设定的前提下改写【后文开头】，使其与前文自然衔接、没有重复或矛盾，"
+    "保持原有章节标题格式，只输出改写后的后文开头。"
+)
+
+_cjk_pattern = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    """
+    粗略估算 token 数：中文字符按 1 个 token，其余按 4 字符 1 个 token
+    """
+    cjk = len(_cjk_pattern.findall(text))
+    return cjk + (len(text) - cjk) // 4
+
+
+def messages_tokens(messages):
+    return sum(estimate_tokens(m['content']) + 4 for m in messages)
+
+
+class StoryContext:
+    """
+    五步写作的上下文组装：每一步只带本步需要的内容（导语、大纲、已写正文），
+    不再把整段对话历史（含系统提示词）重复塞进新的用户消息
+
+    stable_prefix=True 时固定提示词放在用户消息开头、素材放在后面，
+    让同一步骤在不同故事之间共享字节一致的前缀，便于服务端前缀缓存命中
+
+    rolling_summary=True 时续写（Step 4/5）不再带前面各章原文，改为滚动摘要 + 人物/剧情状态
+    + 上一章结尾原文，输入大小不随已写章节增长；摘要由 summary_messages() 在每段正文完成后更新
+    """
+
+    def __init__(self, system_text, intro_material, prompt_ins, plot_material, prompt_plot, prompt_text,
+                 stable_prefix=config['stable_prefix'], rolling_summary=config['rolling_summary']):
+        self.system_text = system_text
+        self.intro_material = intro_material
+        self.prompt_ins = prompt_ins
+        self.plot_material = plot_material
+        self.prompt_plot = prompt_plot
+        self.prompt_text = prompt_text
+        self.stable_prefix = stable_prefix
+        self.rolling_summary = rolling_summary
+        self.intro = ""
+        self.outline = ""
+        self.chapters = []
+        self.summary = ""
+
+    def static_texts(self):
+        """
+        各步骤固定不变的提示词（用于添加缓存断点）
+        """
+        return (self.prompt_ins, self.prompt_plot, self.prompt_text)
+
+    def _compose(self, static, material):
+        if self.stable_prefix:
+            return f"{static}\n{material}"
+        return f"{material}\n{static}"
+
+    def _with_system(self, static, material):
+        return [
+            {"role": "system", "content": self.system_text},
+            {"role": "user", "content": self._compose(static, material)}
+        ]
+
+    def intro_messages(self):
+        # Step 1: [system, 导语提示]
+        return self._with_system(self.prompt_ins, self.intro_material)
+
+    def outline_messages(self):
+        # Step 2: [system, 仿写导语 + 剧情提示]
+        return self._with_system(self.prompt_plot, f"【仿写导语】：\n{self.intro}\n{self.plot_material}")
+
+    def text_messages(self):
+        # Step 3: [system, 仿写导语 + 大纲 + 正文提示]
+        return self._with_system(self.prompt_text, f"【仿写导语】：\n{self.intro}\n【剧情大纲】：\n{self.outline}")
+
+    def continue_messages(self, batch):
+        """
+        Step 4/5: 正文提示 + 已写章节 + 续写指令，batch 为 1 或 2
+        """
+        if self.rolling_summary:
+            return self.summary_continue_messages(batch)
+        messages = self.text_messages()
+        for n in range(batch):
+            messages.append({"role": "assistant", "content": self.chapters[n]})
+            messages.append({"role": "user", "content": CONTINUE_PROMPTS[n]})
+        return messages
+
+    def summary_continue_messages(self, batch):
+        """
+        滚动摘要模式的 Step 4/5: 导语 + 大纲 + 摘要/状态 + 上一章结尾原文 + 本段章节范围
+        """
+        start, end = CHAPTER_BATCHES[batch]
+        _, tail = split_tail(self.chapters[batch - 1], config['summary_tail_chars'])
+        material = (f"【仿写导语】：\n{self.intro}\n【剧情大纲】：\n{self.outline}\n"
+                    f"【前情摘要与人物状态】：\n{self.summary}\n【上一章结尾原文】：\n{tail}\n"
+                    f"第1到第{start - 1}章已完成（见前情摘要），请紧接上一章结尾，直接从第{start}章开始\n"
+                    f"本次只创作第{start}到第{end}章")
+        return self._with_system(self.prompt_text, material)
+
+    def summary_messages(self, batch):
+        """
+        第 batch 段（0 或 1）正文完成后更新摘要：已有摘要 + 本段正文（不带更早的章节原文）
+        摘要不需要写作风格要求，不带系统提示词
+        """
+        material = f"【已有摘要】：\n{self.summary or '（无，这是故事的开头）'}\n【新写章节】：\n{self.chapters[batch]}"
+        return [{"role": "user", "content": self._compose(SUMMARY_PROMPT, material)}]
+
+    def handoff_messages(self):
+        """
+        并行正文前的衔接摘要：由大纲推出第 4、7 章结尾时的状态
+        """
+        return self._with_system(HANDOFF_PROMPT, f"【剧情大纲】：\n{self.outline}")
+
+    def batch_messages(self, batch, handoff=""):
+        """
+        并行正文第 batch 段（0~2）：导语 + 大纲 + 前一段计划结尾 + 本段章节范围
+        """
+        start, end = CHAPTER_BATCHES[batch]
+        material = f"【仿写导语】：\n{self.intro}\n【剧情大纲】：\n{self.outline}"
+        if batch > 0:
+            if handoff:
+                material += f"\n【前文衔接】：第{start - 1}章结束时，{handoff}"
+            material += f"\n第1到第{start - 1}章已由他人完成，请直接从第{start}章开始"
+        material += f"\n本次只创作第{start}到第{end}章"
+        return self._with_system(self.prompt_text, material)
+
+    def stitch_messages(self, prev_tail, next_head):
+        return self._with_system(STITCH_PROMPT, f"【前文结尾】：\n{prev_tail}\n【后文开头】：\n{next_head}")
+
+    def messages_for(self, step):
+        if step == 1:
+            return self.intro_messages()
+        if step == 2:
+            return self.outline_messages()
+        if step == 3:
+            return self.text_messages()
+        return self.continue_messages(step - 3)
+
+    def record(self, step, content):
+        """
+        记录第 step 步的输出，供后续步骤组装上下文
+        """
+        if step == 1:
+            self.intro = content
+        elif step == 2:
+            self.outline = content
+        else:
+            del self.chapters[step - 3:]
+            self.chapters.append(content)
+
+
+def parse_handoff(text):
+    """
+    解析衔接摘要，返回 {4: ..., 7: ...}；格式不符时对应项为空
+    """
+    result = {}
+    for chapter in (4, 7):
+        m = re.search(rf'【第{chapter}章结尾】[：:]\s*(.+)', text)
+        result[chapter] = m.group(1).strip() if m else ""
+    return result
+
+
+def split_head(text, max_chars):
+    """
+    取正文开头不超过 max_chars 的部分，尽量在换行处切开
+    """
+    if len(text) <= max_chars:
+        return text, ""
+    cut = text.rfind("\n", 0, max_chars)
+    if cut <= 0:
+        cut = max_chars
+    return text[:cut], text[cut:]
+
+
+def split_tail(text, max_chars):
+    """
+    取正文结尾不超过 max_chars 的部分，尽量在换行处切开
+    """
+    if len(text) <= max_chars:
+        return "", text
+    cut = text.find("\n", len(text) - max_chars)
+    if cut < 0:
+        cut = len(text) - max_chars
+    return text[:cut], text[cut:].lstrip("\n")
+
+
+def report_budget(step, messages, label=""):
+    """
+    打印本步输入 token 估算，超过 config['step_token_budget'] 时告警
+    """
+    tokens = messages_tokens(messages)
+    budget = config['step_token_budget']
+    chars = sum(len(m['content']) for m in messages)
+    msg = f"{label}第 {step} 步输入: {len(messages)} 条消息, {chars} 字符, 约 {tokens} tokens（预算 {budget}）"
+    if tokens > budget:
+        logger.warning(msg + " —— 超出预算")
+    else:
+        logger.info(msg)
+    return tokens
@@ -0,0 +1,230 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from xml.etree import ElementTree
+from log import logger
+from config import config
+
+# 参考故事入库：把 10.13/ 这类目录里的 .docx/.doc/.txt 抽取成文本，切出 导语 / 付费点 / 结尾，
+# 追加到 config['reference_library']（JSON 数组，由 atom_library.JsonLibrary 建索引按需读取）
+# 以文件内容哈希去重，新增一天的目录时只处理新文件
+# 用法: python corpus_ingest.py ../10.13 ../10.14
+
+SUFFIXES = ('.docx', '.doc', '.txt')
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+# 单独成行的章节号：1 / 1. / 01 / 一、 / 第1章 / 第一节
+_chapter_line = re.compile(r'^(第?[0-9０-９一二三四五六七八九十百]{1,4}[章节]?[.、．]?)$|^第[0-9一二三四五六七八九十百]{1,4}[章节]')
+_intro_head = re.compile(r'^导语[：:]?$')
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_docx(path):
+    with zipfile.ZipFile(path) as z:
+        root = ElementTree.fromstring(z.read('word/document.xml'))
+    return "\n".join(''.join(t.text or '' for t in p.iter(_W + 't')) for p in root.iter(_W + 'p'))
+
+
+def read_doc(path):
+    """
+    旧版 .doc 依赖 antiword 或 catdoc 命令行工具，都没有时跳过
+    """
+    for tool in ('antiword', 'catdoc'):
+        if shutil.which(tool):
+            return subprocess.run([tool, str(path)], capture_output=True, check=True).stdout.decode('utf-8', 'ignore')
+    raise RuntimeError("解析 .doc 需要安装 antiword 或 catdoc（也可以先另存为 .docx）")
+
+
+def read_txt(path):
+    raw = Path(path).read_bytes()
+    for encoding in ('utf-8-sig', 'gb18030'):
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return raw.decode('utf-8', 'ignore')
+
+
+def split_paragraphs(text):
+    """
+    去掉全角空格缩进；有的文档整篇只有一两个段落、段落之间用全角空格隔开，一并拆开
+    """
+    paragraphs = []
+    for line in text.splitlines():
+        for part in re.split(r'[\u3000\xa0]{2,}', line):
+            part = part.strip(' \t\u3000\xa0')
+            if part:
+                paragraphs.append(part)
+    return paragraphs
+
+
+def segment(paragraphs, paid_ratio=None, fallback_chars=None):
+    """
+    切分 导语 / 付费点 / 结尾：
+    导语为第一个章节号之前的部分；付费点为全文 paid_ratio 位置所在的章节；结尾为最后一章
+    没有章节号时按字数截取（导语取开头、付费点取 paid_ratio 处、结尾取最后 fallback_chars 字）
+    """
+    paid_ratio = paid_ratio or config['ingest_paid_ratio']
+    fallback_chars = fallback_chars or config['ingest_fallback_chars']
+    # 开头几行内出现“导语：”时，之前的（标题等）一并去掉
+    for n, p in enumerate(paragraphs[:3]):
+        if _intro_head.match(p):
+            paragraphs = paragraphs[n + 1:]
+            break
+
+    chapters, current, intro = [], None, []
+    for p in paragraphs:
+        if len(p) <= 12 and _chapter_line.match(p):
+            current = []
+            chapters.append(current)
+        elif current is None:
+            intro.append(p)
+        else:
+            current.append(p)
+    chapters = ["\n".join(c) for c in chapters if c]
+    intro = "\n".join(intro)
+
+    if not chapters or len(intro) > fallback_chars * 2:
+        text = "\n".join(paragraphs)
+        head = text[:fallback_chars]
+        cut = head.rfind("\n")
+        intro = head[:cut] if cut > 0 else head
+        pos = int(len(text) * paid_ratio)
+        return {'intro': intro, 'paid': text[pos:pos + fallback_chars], 'ending': text[-fallback_chars:],
+                'chapters': 0}
+
+    if not intro:
+        # 没有单独的导语段落时，取第一章开头
+        head = chapters[0][:fallback_chars]
+        cut = head.rfind("\n")
+        intro = head[:cut] if cut > 0 else head
+    total = sum(len(c) for c in chapters)
+    pos, paid = 0, chapters[-1]
+    for c in chapters:
+        pos += len(c)
+        if pos >= total * paid_ratio:
+            paid = c
+            break
+    return {'intro': intro, 'paid': paid, 'ending': chapters[-1], 'chapters': len(chapters)}
+
+
+def title_of(path):
+    name = Path(path).stem
+    match = re.search(r'《(.+?)》', name)
+    return (match.group(1) if match else re.sub(r'\s*\(\d+\)', '', name)).strip()
+
+
+def extract(job):
+    """
+    进程池中执行：抽取一个文件，返回 (记录, None) 或 (None, 错误信息)
+    """
+    path, digest = job
+    try:
+        suffix = Path(path).suffix.lower()
+        text = read_docx(path) if suffix == '.docx' else read_doc(path) if suffix == '.doc' else read_txt(path)
+        paragraphs = split_paragraphs(text)
+        title = title_of(path)
+        if paragraphs and title in paragraphs[0] and len(paragraphs[0]) <= len(title) + 4:
+            paragraphs = paragraphs[1:]
+        if not paragraphs:
+            return None, "没有文本"
+        parts = segment(paragraphs)
+        body = "\n".join(paragraphs)
+        return {
+            "标题": title,
+            "文件": os.path.basename(path),
+            "目录": os.path.basename(os.path.dirname(os.path.abspath(path))),
+            "哈希": digest,
+            "字数": len(body),
+            "章节数": parts['chapters'],
+            "导语": parts['intro'],
+            "付费点": parts['paid'],
+            "结尾": parts['ending'],
+            "正文": body,
+        }, None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def scan(dirs):
+    for d in dirs:
+        for path in sorted(Path(d).rglob('*')):
+            # ~$ 开头的是 Word 打开文档时的锁文件
+            if path.is_file() and path.suffix.lower() in SUFFIXES and not path.name.startswith('~$'):
+                yield str(path)
+
+
+def load_library(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_library(path, records):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def ingest(dirs=None, library=None, workers=None):
+    """
+    增量入库，返回 (新增条数, 失败文件列表)
+    """
+    dirs = dirs or config['reference_dirs']
+    library = library or config['reference_library']
+    records = load_library(library)
+    known = {r["哈希"] for r in records}
+
+    jobs, seen = [], set(known)
+    for path in scan(dirs):
+        digest = file_hash(path)
+        if digest not in seen:
+            seen.add(digest)
+            jobs.append((path, digest))
+    logger.info(f"参考故事库已有 {len(records)} 篇，本次新文件 {len(jobs)} 个")
+    if not jobs:
+        return 0, []
+
+    added, failed = [], []
+    with ProcessPoolExecutor(max_workers=workers or config['ingest_workers'] or None) as pool:
+        for (path, _), (record, error) in zip(jobs, pool.map(extract, jobs, chunksize=4)):
+            if record is None:
+                failed.append(path)
+                logger.warning(f"入库失败 {path}: {error}")
+            else:
+                added.append(record)
+    if added:
+        save_library(library, records + added)
+    logger.info(f"入库完成：新增 {len(added)} 篇，失败 {len(failed)} 个，共 {len(records) + len(added)} 篇")
+    return len(added), failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='参考故事增量入库（docx/doc/txt）')
+    parser.add_argument('dirs', nargs='*', help='故事目录，默认 config["reference_dirs"]')
+    parser.add_argument('--library', default=config['reference_library'], help='入库的 JSON 文件')
+    parser.add_argument('-j', '--workers', type=int, default=config['ingest_workers'], help='进程数（默认 CPU 核数）')
+    args = parser.parse_args()
+    ingest(args.dirs or None, args.library, args.workers)
+
+
+if __name__ == '__main__':
+    main()
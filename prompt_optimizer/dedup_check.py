@@ -0,0 +1,273 @@
+import argparse
+import glob
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from log import logger
+from config import config
+from minhash import signature, shingles, similarity, lsh_buckets
+
+# 生成结果查重：参考故事库、导语库和历史输出切成约 dedup_chunk_chars 字的片段，
+# 每段一个 MinHash 签名，LSH 分桶存入 SQLite；新故事按同样方式切段，只和同桶候选比较
+# 用法: python dedup_check.py index            # 增量索引参考故事库、导语库和历史输出
+#       python dedup_check.py check test_1.txt # 检查指定故事
+
+
+def split_chunks(text, size=None):
+    """
+    按段落切成约 size 字的片段（超长段落按字数硬切）
+    """
+    size = size or config['dedup_chunk_chars']
+    chunks, current = [], ""
+    for line in text.splitlines():
+        line = line.strip()
+        for start in range(0, len(line), size):
+            current = f"{current}\n{line[start:start + size]}" if current else line[start:start + size]
+            if len(current) >= size:
+                chunks.append(current)
+                current = ""
+    if current:
+        if chunks and len(current) < size // 3:
+            chunks[-1] += "\n" + current
+        else:
+            chunks.append(current)
+    return chunks
+
+
+def sign_parts(parts):
+    """
+    [(片段名, 文本)] → [(片段名, shingle 数, 签名)]；可在进程池中执行
+    """
+    n, num_perm = config['dedup_shingle'], config['dedup_perm']
+    return [(name, len(shingles(text, n)), signature(text, num_perm, n)) for name, text in parts]
+
+
+def story_parts(text, intro=None):
+    """
+    正文按片段切分；有单独的导语时另加一段，短导语被整段照搬时也能和片段对上
+    """
+    parts = [('导语', intro)] if intro else []
+    return parts + [(str(k + 1), chunk) for k, chunk in enumerate(split_chunks(text))]
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class DedupIndex:
+    """
+    片段签名与 LSH 桶的 SQLite 索引：sources 每篇一行（按内容哈希去重），docs 每个片段一行
+    """
+
+    def __init__(self, path=None):
+        self.path = path or config['dedup_index']
+        self.rows = config['dedup_rows']
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sources (
+                id INTEGER PRIMARY KEY,
+                kind TEXT,
+                name TEXT,
+                hash TEXT UNIQUE,
+                added REAL
+            );
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY,
+                source INTEGER,
+                part TEXT,
+                shingles INTEGER,
+                sig BLOB
+            );
+            CREATE TABLE IF NOT EXISTS buckets (
+                band INTEGER,
+                bucket INTEGER,
+                doc INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS idx_buckets ON buckets(band, bucket);
+        """)
+        self._conn.commit()
+
+    def source_id(self, digest):
+        row = self._conn.execute("SELECT id FROM sources WHERE hash = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, kind, name, digest, signed_parts):
+        """
+        写入一篇已签名的故事，已存在（内容哈希相同）时返回已有 id
+        """
+        with self._lock:
+            existing = self.source_id(digest)
+            if existing is not None:
+                return existing
+            cur = self._conn.execute("INSERT INTO sources (kind, name, hash, added) VALUES (?, ?, ?, ?)",
+                                     (kind, name, digest, time.time()))
+            source = cur.lastrowid
+            for part, count, sig in signed_parts:
+                doc = self._conn.execute("INSERT INTO docs (source, part, shingles, sig) VALUES (?, ?, ?, ?)",
+                                         (source, part, count, sig.tobytes())).lastrowid
+                self._conn.executemany("INSERT INTO buckets (band, bucket, doc) VALUES (?, ?, ?)",
+                                       [(band, bucket, doc) for band, bucket in lsh_buckets(sig, self.rows)])
+            self._conn.commit()
+            return source
+
+    def candidates(self, sig):
+        with self._lock:
+            docs = set()
+            for band, bucket in lsh_buckets(sig, self.rows):
+                docs.update(r[0] for r in self._conn.execute(
+                    "SELECT doc FROM buckets WHERE band = ? AND bucket = ?", (band, bucket)))
+            if not docs:
+                return []
+            marks = ",".join("?" * len(docs))
+            return self._conn.execute(
+                f"SELECT d.id, d.part, d.shingles, d.sig, s.id, s.kind, s.name FROM docs d "
+                f"JOIN sources s ON s.id = d.source WHERE d.id IN ({marks})", list(docs)).fetchall()
+
+    def stats(self):
+        with self._lock:
+            sources = self._conn.execute("SELECT kind, COUNT(*) FROM sources GROUP BY kind").fetchall()
+            docs = self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+        return {'sources': dict(sources), 'docs': docs}
+
+    def check(self, text, exclude_hash=None):
+        """
+        返回查重报告：
+        overlap_ratio 为与已有内容高度相似的片段占比；neighbours 为最相近的几篇，
+        jaccard 为片段间相似度估计，containment 为重合部分占两段中较短一段的比例估计
+        """
+        start = time.time()
+        exclude = self.source_id(exclude_hash) if exclude_hash else None
+        signed = sign_parts(story_parts(text))
+        threshold, containment_threshold = config['dedup_threshold'], config['dedup_containment']
+        neighbours, flagged_parts = {}, 0
+        for part, count, sig in signed:
+            hit = False
+            for _, other_part, other_count, raw, source, kind, name in self.candidates(sig):
+                if source == exclude:
+                    continue
+                other = array('Q')
+                other.frombytes(raw)
+                j = similarity(sig, other)
+                # 由 Jaccard 和两边 shingle 数估计重合部分占较短一方的比例（短导语被照搬进长片段也能发现）
+                containment = min(1.0, j / (1 + j) * (count + other_count) / max(min(count, other_count), 1))
+                if j >= threshold or containment >= containment_threshold:
+                    hit = True
+                best = neighbours.setdefault(source, {'kind': kind, 'name': name, 'jaccard': 0.0,
+                                                      'containment': 0.0, 'parts': []})
+                best['jaccard'] = max(best['jaccard'], round(j, 3))
+                best['containment'] = max(best['containment'], round(containment, 3))
+                best['parts'].append((part, other_part))
+            flagged_parts += hit
+        ranked = sorted(neighbours.values(), key=lambda n: (-n['containment'], -n['jaccard']))
+        flagged = [n for n in ranked if n['jaccard'] >= threshold or n['containment'] >= containment_threshold]
+        return {
+            'parts': len(signed),
+            'overlap_ratio': round(flagged_parts / len(signed), 3) if signed else 0.0,
+            'flagged': bool(flagged),
+            'neighbours': ranked[:config['dedup_top_k']],
+            'seconds': round(time.time() - start, 3),
+        }
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_dedup_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = DedupIndex()
+    return _index
+
+
+def _sign_story(job):
+    kind, name, text, intro = job
+    return kind, name, content_hash(text), sign_parts(story_parts(text, intro))
+
+
+def collect_corpus(output_patterns=None):
+    """
+    待索引的全部内容：[(类别, 名称, 文本, 导语)]
+    """
+    from atom_library import WomenShortStories
+    jobs = []
+    for library, kind, field, intro in ((WomenShortStories.json_reference, '参考故事', '正文', '导语'),
+                                        (WomenShortStories.json_ins, '导语库', '导语内容', None)):
+        try:
+            for i in range(len(library)):
+                record = library[i]
+                jobs.append((kind, record.get('标题', f"{kind}{i}"), record[field], record.get(intro)))
+        except FileNotFoundError as e:
+            logger.warning(f"跳过{kind}: {e}")
+    for pattern in output_patterns or config['dedup_outputs']:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                jobs.append(('输出', path, f.read(), None))
+    return jobs
+
+
+def build_index(output_patterns=None, workers=None):
+    """
+    增量索引：内容哈希已在库中的跳过，签名计算放进进程池
+    """
+    index = get_dedup_index()
+    jobs = [job for job in collect_corpus(output_patterns) if index.source_id(content_hash(job[2])) is None]
+    logger.info(f"查重索引：本次新增 {len(jobs)} 篇")
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers or config['ingest_workers'] or None) as pool:
+            for kind, name, digest, signed in pool.map(_sign_story, jobs, chunksize=8):
+                index.add(kind, name, digest, signed)
+    logger.info(f"查重索引: {index.stats()}")
+
+
+def check_output(path, add=True):
+    """
+    检查一篇生成结果并（默认）加入索引，返回查重报告；命中时记警告
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    index = get_dedup_index()
+    digest = content_hash(text)
+    report = index.check(text, exclude_hash=digest)
+    if report['flagged']:
+        top = report['neighbours'][0]
+        logger.warning(f"查重命中 {path}: 相似片段占比 {report['overlap_ratio']:.0%}，最相近 [{top['kind']}] "
+                       f"{top['name']}（jaccard {top['jaccard']}，覆盖 {top['containment']}）")
+    else:
+        logger.info(f"查重通过 {path}（{report['parts']} 段，耗时 {report['seconds']} 秒）")
+    if add:
+        index.add('输出', path, digest, sign_parts(story_parts(text)))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成结果查重（MinHash/LSH）')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_index = sub.add_parser('index', help='增量索引参考故事库、导语库和历史输出')
+    p_index.add_argument('--outputs', nargs='*', help='历史输出（glob），默认 config["dedup_outputs"]')
+    p_check = sub.add_parser('check', help='检查故事文件')
+    p_check.add_argument('paths', nargs='+')
+    p_check.add_argument('--no-add', action='store_true', help='检查后不加入索引')
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        build_index(args.outputs)
+        return
+    for path in args.paths:
+        report = check_output(path, add=not args.no_add)
+        print(f"{path}: 片段 {report['parts']}，相似片段占比 {report['overlap_ratio']:.0%}，"
+              f"{'命中' if report['flagged'] else '通过'}，耗时 {report['seconds']} 秒")
+        for n in report['neighbours']:
+            print(f"  [{n['kind']}] {n['name']} | jaccard {n['jaccard']} | 覆盖 {n['containment']} | "
+                  f"片段 {len(n['parts'])}")
+
+
+if __name__ == '__main__':
+    main()
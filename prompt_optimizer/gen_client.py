@@ -0,0 +1,175 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import urlparse
+import httpx
+from config import config
+
+# 生成服务（gen_server.py）的客户端，供 Qt 界面在 QThread 中同步调用
+# 服务没有运行且地址是本机时自动在后台启动一个（独立进程，关掉界面也继续运行）
+
+
+class RunFailed(Exception):
+    pass
+
+
+class RunCancelled(Exception):
+    pass
+
+
+class GenerationClient:
+    """
+    chat()/turns()/story() 提交任务并阻塞到结束，期间 on_delta 收到输出片段、on_log 收到进度和重试信息，
+    on_reset() 表示之前收到的本次输出作废（中途中止后重试），界面应清掉这部分内容
+    cancel() 可在其他线程调用，取消当前任务
+    """
+
+    def __init__(self, url=None, token=None):
+        self.url = (url or config['gen_server']).rstrip('/')
+        self.headers = {'X-Gen-Token': config['gen_server_token'] if token is None else token}
+        self.run_id = None
+
+    def _request(self, method, path, **kwargs):
+        response = httpx.request(method, f"{self.url}{path}", headers=self.headers, timeout=30, **kwargs)
+        if response.status_code >= 400:
+            raise RunFailed(f"生成服务返回 {response.status_code}: {response.text}")
+        return response.json()
+
+    def ensure_server(self, wait=30):
+        """
+        服务不可达且为本机地址时启动 gen_server.py 并等待就绪
+        """
+        try:
+            return self._request('GET', '/status')
+        except httpx.TransportError:
+            if urlparse(self.url).hostname not in ('127.0.0.1', 'localhost'):
+                raise
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gen_server.py')
+        args = [sys.executable, script, '--port', str(urlparse(self.url).port or config['gen_server_port'])]
+        if os.name == 'nt':
+            flags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+            subprocess.Popen(args, cwd=os.path.dirname(script), creationflags=flags, close_fds=True)
+        else:
+            subprocess.Popen(args, cwd=os.path.dirname(script), start_new_session=True,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + wait
+        while True:
+            time.sleep(0.5)
+            try:
+                return self._request('GET', '/status')
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise RunFailed(f"生成服务 {self.url} 启动超时") from None
+
+    def start(self, kind, **params):
+        self.ensure_server()
+        self.run_id = self._request('POST', '/runs', json={'kind': kind, **params})['id']
+        return self.run_id
+
+    def events(self, run_id, after=0, retries=5):
+        """
+        逐个产出 (事件名, 数据)，直到 done/error/cancelled；断线时从最后收到的序号重连
+        """
+        failures = 0
+        while True:
+            try:
+                timeout = httpx.Timeout(30, read=config['gen_server_ping'] * 3)
+                with httpx.stream('GET', f"{self.url}/runs/{run_id}/events", params={'after': after},
+                                  headers=self.headers, timeout=timeout) as response:
+                    if response.status_code >= 400:
+                        response.read()
+                        raise RunFailed(f"生成服务返回 {response.status_code}: {response.text}")
+                    seq, event, data = None, None, []
+                    for line in response.iter_lines():
+                        if line.startswith('id:'):
+                            seq = int(line[3:].strip())
+                        elif line.startswith('event:'):
+                            event = line[6:].strip()
+                        elif line.startswith('data:'):
+                            data.append(line[5:].strip())
+                        elif not line and event is not None:
+                            after = seq
+                            failures = 0
+                            yield event, json.loads("\n".join(data))
+                            if event in ('done', 'error', 'cancelled'):
+                                return
+                            seq, event, data = None, None, []
+            except httpx.TransportError:
+                failures += 1
+                if failures > retries:
+                    raise
+                time.sleep(min(2 ** failures, 10))
+
+    def wait(self, run_id, on_delta=None, on_log=None, on_event=None, on_reset=None):
+        """
+        阻塞到任务结束，返回结果 dict；失败抛 RunFailed，被取消抛 RunCancelled
+        其他事件（turn/output 等）交给 on_event(事件名, 数据)
+        """
+        for event, data in self.events(run_id):
+            if event == 'delta':
+                if on_delta is not None:
+                    on_delta(data['text'])
+            elif event == 'reset':
+                if on_reset is not None:
+                    on_reset()
+            elif event == 'log':
+                if on_log is not None:
+                    on_log(data['message'])
+            elif event == 'done':
+                return data
+            elif event == 'error':
+                raise RunFailed(data['message'])
+            elif event == 'cancelled':
+                raise RunCancelled("任务已取消")
+            elif on_event is not None:
+                on_event(event, data)
+
+    def chat(self, messages, model=None, api_key=None, base_url=None, max_retries=5, save_path=None,
+             on_delta=None, on_log=None, on_reset=None, on_saved=None):
+        """
+        单次对话，返回完整输出；save_path 不为空时由服务端落盘（界面关闭后也会保存）
+        save_path 是相对服务端输出目录（config['gen_server_output_dir']）的路径，on_saved(实际保存路径) 在落盘后调用
+        """
+        run_id = self.start('chat', messages=messages, model=model, api_key=api_key, base_url=base_url,
+                            max_retries=max_retries, save_path=save_path)
+        result = self.wait(run_id, on_delta, on_log, on_reset=on_reset)
+        if result.get('path') and on_saved is not None:
+            on_saved(result['path'])
+        return result['content']
+
+    def turns(self, turns, model=None, api_key=None, base_url=None, max_retries=5, on_delta=None, on_log=None,
+              on_turn=None, on_output=None, on_reset=None, on_saved=None):
+        """
+        多轮对话整条链在服务端按顺序执行，返回各轮输出列表
+        turns 为 [{'messages': [...], 'save_path': ...}]，消息内容可以是字符串和 {'output': n}（第 n 轮输出）组成的列表；
+        on_turn(序号, 实际发送的 messages) 在每轮开始时调用，on_output(序号, 输出) 在每轮结束时调用
+        save_path 是相对服务端输出目录的路径，on_saved(序号, 实际保存路径) 在该轮落盘后调用
+        """
+
+        def on_event(event, data):
+            if event == 'turn' and on_turn is not None:
+                on_turn(data['index'], data['messages'])
+            elif event == 'output':
+                if on_output is not None:
+                    on_output(data['index'], data['content'])
+                if data.get('path') and on_saved is not None:
+                    on_saved(data['index'], data['path'])
+
+        run_id = self.start('turns', turns=turns, model=model, api_key=api_key, base_url=base_url,
+                            max_retries=max_retries)
+        return self.wait(run_id, on_delta, on_log, on_event, on_reset)['outputs']
+
+    def story(self, story=None, pair=None, parallel=None, resume=False, on_delta=None, on_log=None, on_reset=None):
+        """
+        服务端完整写一篇（导语 → 大纲 → 正文×3），返回 {'output': 保存路径, 'content': 全文}
+        """
+        params = {'story': story, 'pair': list(pair) if pair else None, 'resume': resume}
+        if parallel is not None:
+            params['parallel'] = parallel
+        return self.wait(self.start('story', **params), on_delta, on_log, on_reset=on_reset)
+
+    def cancel(self):
+        if self.run_id is not None:
+            self._request('POST', f"/runs/{self.run_id}/cancel")
@@ -0,0 +1,423 @@
+import argparse
+import asyncio
+import contextvars
+import glob
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from log import logger
+from config import config
+from key_pool import get_key_pool
+from concurrency_limiter import format_all
+from stream_writer import write_text, read_text
+import llm_client
+
+# 本地生成服务：连接池、缓存、key 轮换和写作流程都在这个进程里，Qt 界面通过 HTTP 提交任务、
+# 用 Server-Sent Events 接收进度；多个界面共用一个已预热的后端，关掉窗口不会中断正在生成的任务
+# 用法: python gen_server.py                  # 默认 127.0.0.1:8902；监听其他地址时必须设置 config['gen_server_token']
+# 接口:
+#   POST /runs                 {"kind": "chat", "messages": [...], "model", "api_key", "base_url", "max_retries", "save_path"}
+#                              {"kind": "turns", "turns": [{"messages": [...], "save_path"}, ...], "model", "api_key", ...}
+#                              {"kind": "story", "story": 篇号, "pair": [导语索引, 剧情索引], "parallel", "resume"}
+#                              返回 {"id": ...}；base_url 不是 config['url'] 时必须带 api_key（key 池只用于默认接口），
+#                              save_path 是 config['gen_server_output_dir'] 内的相对路径，结果里的 path 为服务端实际保存路径
+#   GET  /runs/<id>/events     SSE：delta（输出片段）、reset（之前发出的本次输出作废，接着是重试的输出）、
+#                              log（进度/重试）、turn/output（turns 每轮开始/结束）、最后一条 done/error/cancelled；
+#                              断线重连时带 Last-Event-ID（或 ?after=N）从断点继续
+#   GET  /runs/<id>            状态和结果；GET /runs 列出所有任务；POST /runs/<id>/cancel 取消
+#   GET  /status               key 用量、并发窗口和任务数
+
+TERMINAL_EVENTS = ('done', 'error', 'cancelled')
+
+# 当前协程所属的任务：写作流程里的日志按它转发给对应任务的订阅者
+_current_run = contextvars.ContextVar('gen_run', default=None)
+
+
+class Run:
+    """
+    一次生成任务；事件按序号保存在内存里，订阅者随时加入都能从头（或断点）收到完整进度
+    """
+
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.params = params
+        self.status = 'running'
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.future = None
+        self.events = []
+        self._cond = threading.Condition()
+
+    def emit(self, event, data):
+        with self._cond:
+            self.events.append((len(self.events) + 1, event, data))
+            self._cond.notify_all()
+
+    def finish(self, status, result=None, error=None):
+        with self._cond:
+            self.status, self.result, self.error = status, result, error
+            self.finished = time.time()
+        payload = {'done': result, 'error': {'message': error}, 'cancelled': {}}[status]
+        self.emit(status, payload)
+
+    def wait_events(self, after, timeout):
+        """
+        返回序号大于 after 的事件；没有新事件时最多等 timeout 秒
+        """
+        with self._cond:
+            if len(self.events) <= after:
+                self._cond.wait(timeout)
+            return self.events[after:]
+
+    def summary(self, with_result=False):
+        info = {'id': self.id, 'kind': self.kind, 'status': self.status, 'created': self.created,
+                'finished': self.finished, 'events': len(self.events), 'error': self.error}
+        if self.kind == 'story':
+            info['story'] = self.params.get('story')
+        if with_result:
+            info['result'] = self.result
+        return info
+
+
+class RunLogHandler(logging.Handler):
+    """
+    写作流程里的日志（导语索引、步骤完成、重试等）作为 log 事件转发给所属任务
+    """
+
+    def emit(self, record):
+        run = _current_run.get()
+        if run is not None:
+            run.emit('log', {'message': record.getMessage()})
+
+
+def output_path(save_path):
+    """
+    save_path 是相对 config['gen_server_output_dir'] 的路径，只能落在该目录内，避免通过接口覆盖任意文件
+    """
+    root = os.path.realpath(config['gen_server_output_dir'])
+    path = os.path.realpath(os.path.join(root, save_path))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"save_path 必须在输出目录 {root} 内: {save_path}")
+    return path
+
+
+def resolve_content(content, outputs):
+    """
+    turns 任务的消息内容：字符串，或由字符串和 {"output": n}（第 n 轮的输出，从 0 开始）组成的列表
+    """
+    if isinstance(content, str):
+        return content
+    return ''.join(outputs[part['output']] if isinstance(part, dict) else part for part in content)
+
+
+def check_params(kind, params):
+    """
+    提交时校验参数，不合法抛 ValueError（返回 400）；save_path 换成服务端的实际路径
+    """
+    if kind not in RUNNERS:
+        raise ValueError(f"未知的任务类型: {kind}")
+    if kind == 'story':
+        return
+    # key 池里的 key 只发给默认接口，其他接口地址必须由调用方自带 key
+    base_url = (params.get('base_url') or '').rstrip('/')
+    if base_url and base_url != config['url'].rstrip('/') and not params.get('api_key'):
+        raise ValueError(f"base_url 不是默认接口时必须提供 api_key: {base_url}")
+    turns = params.get('turns') if kind == 'turns' else [params]
+    if not turns:
+        raise ValueError(f"{kind} 任务缺少 turns")
+    for index, turn in enumerate(turns):
+        if not turn.get('messages'):
+            raise ValueError(f"{kind} 任务缺少 messages")
+        for m in turn['messages'] if kind == 'turns' else ():
+            if not isinstance(m['content'], (str, list)):
+                raise ValueError("消息内容必须是字符串或片段列表")
+            refs = [part['output'] for part in m['content'] if isinstance(part, dict)] \
+                if isinstance(m['content'], list) else []
+            if any(not isinstance(n, int) or not 0 <= n < index for n in refs):
+                raise ValueError(f"第 {index + 1} 轮引用了尚未生成的输出: {refs}")
+        if turn.get('save_path'):
+            turn['save_path'] = output_path(turn['save_path'])
+
+
+def chat(run, messages):
+    # 重试信息由 llm_client 的日志经 RunLogHandler 转发，这里不再单独发 log 事件
+    p = run.params
+    return llm_client.chat_with_retry(
+        messages, max_retries=p.get('max_retries', 5), model=p.get('model') or config['model'],
+        api_key=p.get('api_key') or None, base_url=p.get('base_url') or None,
+        on_delta=lambda delta: run.emit('delta', {'text': delta}), on_reset=lambda: run.emit('reset', {}))
+
+
+async def run_chat(run):
+    """
+    单次对话：界面自己组装 messages，这里负责重试、key 轮换和流式输出
+    save_path 不为空时结果直接落盘，界面关闭后结果也不会丢
+    """
+    p = run.params
+    content = await chat(run, p['messages'])
+    if p.get('save_path'):
+        write_text(p['save_path'], content)
+    return {'content': content, 'path': p.get('save_path')}
+
+
+async def run_turns(run):
+    """
+    多轮对话：按顺序执行 turns，后面轮次的消息可引用前面轮次的输出，整条链在服务端跑完（界面关闭也不中断）
+    每轮开始发 turn 事件（实际发送的 messages），结束发 output 事件（含实际保存路径）；各轮 save_path 不为空时落盘
+    """
+    outputs, paths = [], []
+    for index, turn in enumerate(run.params['turns']):
+        messages = [{**m, 'content': resolve_content(m['content'], outputs)} for m in turn['messages']]
+        run.emit('turn', {'index': index, 'messages': messages})
+        content = await chat(run, messages)
+        if turn.get('save_path'):
+            write_text(turn['save_path'], content)
+        outputs.append(content)
+        paths.append(turn.get('save_path'))
+        run.emit('output', {'index': index, 'content': content, 'path': turn.get('save_path')})
+    return {'outputs': outputs, 'paths': paths}
+
+
+async def run_story(run):
+    """
+    完整的五步写作（model_test.write_story），输出和检查点都在服务端
+    """
+    # 写作流程依赖提示词文件，第一次提交写作任务时才导入
+    from model_test import write_story
+    p = run.params
+    pair = tuple(p['pair']) if p.get('pair') else None
+    output = await write_story(p['story'] - 1, echo=lambda delta: run.emit('delta', {'text': delta}),
+                               resume=p.get('resume', False), parallel=p.get('parallel', config['parallel_chapters']),
+                               pair=pair, on_reset=lambda: run.emit('reset', {}))
+    return {'output': os.path.abspath(output), 'content': read_text(output)}
+
+
+RUNNERS = {'chat': run_chat, 'turns': run_turns, 'story': run_story}
+
+
+async def execute(run):
+    _current_run.set(run)
+    try:
+        result = await RUNNERS[run.kind](run)
+    except asyncio.CancelledError:
+        run.finish('cancelled')
+        raise
+    except Exception as e:
+        logger.error(f"任务 {run.id} 失败: {e}")
+        run.finish('error', error=f"{type(e).__name__}: {e}")
+        return None
+    run.finish('done', result)
+    return result
+
+
+class RunRegistry:
+    """
+    进程内的任务表；已结束的任务只保留最近 config['gen_server_keep'] 个
+    """
+
+    def __init__(self, keep=None):
+        self.keep = keep or config['gen_server_keep']
+        self._runs = {}
+        self._lock = threading.Lock()
+        self._stories = set()
+
+    def _next_story(self):
+        # 篇号取已有输出 test_<n>.txt 和本服务已分配篇号中的最大值 + 1
+        used = {int(m.group(1)) for m in (re.match(r'test_(\d+)\.txt$', os.path.basename(p))
+                                          for p in glob.glob('test_*.txt')) if m}
+        return max(used | self._stories | {0}) + 1
+
+    def start(self, kind, params):
+        check_params(kind, params)
+        with self._lock:
+            if kind == 'story':
+                params['story'] = int(params.get('story') or self._next_story())
+                self._stories.add(params['story'])
+            run = Run(kind, params)
+            self._runs[run.id] = run
+            self._prune()
+        run.future = llm_client.submit(execute(run))
+        logger.info(f"任务 {run.id} 已开始（{kind}）")
+        return run
+
+    def _prune(self):
+        finished = sorted((r for r in self._runs.values() if r.status != 'running'), key=lambda r: r.finished)
+        for run in finished[:max(0, len(finished) - self.keep)]:
+            del self._runs[run.id]
+
+    def get(self, run_id):
+        with self._lock:
+            return self._runs.get(run_id)
+
+    def list(self):
+        with self._lock:
+            return [run.summary() for run in self._runs.values()]
+
+    def cancel(self, run_id):
+        run = self.get(run_id)
+        if run is None or run.status != 'running':
+            return False
+        # 取消后台事件循环中的任务，流式请求随之关闭，execute 发出 cancelled 事件
+        llm_client.get_loop().call_soon_threadsafe(run.future.cancel)
+        return True
+
+    def counts(self):
+        with self._lock:
+            counts = {}
+            for run in self._runs.values():
+                counts[run.status] = counts.get(run.status, 0) + 1
+        return counts
+
+
+class GenHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    registry = None
+
+    def log_message(self, fmt, *args):
+        logger.debug("gen_server: " + fmt % args)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        if hmac.compare_digest(self.headers.get('X-Gen-Token', ''), config['gen_server_token']):
+            return True
+        self._send_json(403, {'error': 'token 不正确'})
+        return False
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream_events(self, run, after):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            while True:
+                events = run.wait_events(after, config['gen_server_ping'])
+                if not events:
+                    # 注释行作为心跳，避免代理或客户端因长时间无数据断开
+                    self._write_chunk(b": ping\n\n")
+                    continue
+                for seq, event, data in events:
+                    payload = json.dumps(data, ensure_ascii=False)
+                    self._write_chunk(f"id: {seq}\nevent: {event}\ndata: {payload}\n\n".encode('utf-8'))
+                    after = seq
+                    if event in TERMINAL_EVENTS:
+                        self._write_chunk(b"")
+                        return
+        except (BrokenPipeError, ConnectionResetError):
+            # 界面关闭或断线，任务继续在后台运行
+            self.close_connection = True
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        if parts == ['status']:
+            self._send_json(200, {'runs': self.registry.counts(), 'keys': get_key_pool().format_usage(),
+                                  'limiter': format_all() if config['limiter_enabled'] else ''})
+        elif parts == ['runs']:
+            self._send_json(200, {'runs': self.registry.list()})
+        elif len(parts) >= 2 and parts[0] == 'runs':
+            run = self.registry.get(parts[1])
+            if run is None:
+                self._send_json(404, {'error': '任务不存在或已清理'})
+            elif parts[2:] == ['events']:
+                after = self.headers.get('Last-Event-ID') or parse_qs(url.query).get('after', ['0'])[0]
+                self._stream_events(run, int(after))
+            elif not parts[2:]:
+                self._send_json(200, run.summary(with_result=True))
+            else:
+                self._send_json(404, {'error': 'not found'})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if not self._authorized():
+            return
+        parts = [p for p in urlparse(self.path).path.split('/') if p]
+        if parts == ['runs']:
+            try:
+                params = json.loads(body or b'{}')
+                run = self.registry.start(params.pop('kind', 'chat'), params)
+            except (TypeError, ValueError, KeyError, AttributeError) as e:
+                self._send_json(400, {'error': f"参数不合法: {e}"})
+                return
+            self._send_json(201, {'id': run.id, 'story': params.get('story')})
+        elif len(parts) == 3 and parts[0] == 'runs' and parts[2] == 'cancel':
+            self._send_json(200, {'cancelled': self.registry.cancel(parts[1])})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def start_server(host='127.0.0.1', port=None, registry=None):
+    """
+    在后台线程启动生成服务，返回 server（server.shutdown() 停止）；port=0 时随机端口
+    监听非本机地址时必须设置 config['gen_server_token']，否则任何能连上的人都能用 key 池
+    """
+    if not is_loopback(host) and not config['gen_server_token']:
+        raise ValueError(f"监听 {host} 需要先设置 config['gen_server_token']")
+    registry = registry or RunRegistry()
+    if not any(isinstance(h, RunLogHandler) for h in logger.handlers):
+        logger.addHandler(RunLogHandler())
+    handler = type('BoundGenHandler', (GenHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, config['gen_server_port'] if port is None else port), handler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name='gen-server', daemon=True).start()
+    # 预热事件循环，第一次请求不用再等
+    llm_client.get_loop()
+    logger.info(f"生成服务已启动: http://{host}:{server.server_address[1]}")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地生成服务（Qt 界面的后端）')
+    parser.add_argument('--host', default='127.0.0.1', help='多人共用时用 0.0.0.0，并设置 config["gen_server_token"]')
+    parser.add_argument('--port', type=int, default=config['gen_server_port'])
+    args = parser.parse_args()
+    try:
+        server = start_server(args.host, args.port)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        while True:
+            time.sleep(60)
+            logger.info(f"生成服务任务: {server.registry.counts()}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
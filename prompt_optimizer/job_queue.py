@@ -0,0 +1,388 @@
+import argparse
+import hmac
+import ipaddress
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from log import logger
+from config import config
+
+# 持久化任务队列：每个任务是一篇故事的规格（导语索引、剧情索引、提示词版本、模型），
+# 任意多个 worker 进程（job_worker.py，可分布在多台机器）领取任务，领取时拿到租约并定期心跳续约；
+# worker 崩溃或断网后租约过期，任务自动回到队列由其他 worker 接手
+# 本地用 SQLite 文件；多台机器时在一台上运行 python job_queue.py serve，其他机器把
+# config['job_store'] 设为 http://<该机器>:<端口>，接口与 SqliteJobStore 相同
+# 用法: python job_queue.py add -n 20      # 入队 20 篇
+#       python job_queue.py status         # 查看队列
+#       python job_queue.py requeue        # 失败的任务重新入队
+
+STATUSES = ('queued', 'running', 'done', 'failed')
+
+
+def worker_name():
+    """
+    默认 worker 名：主机名:进程号（同一台机器多进程时互不冲突）
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SqliteJobStore:
+    """
+    SQLite 任务表；领取在 BEGIN IMMEDIATE 事务中完成，同一台机器上的多个进程不会领到同一个任务
+    attempts 为已领取次数，达到 max_attempts 后不再派发
+    """
+
+    def __init__(self, path=None, max_attempts=None):
+        self.path = path or config['job_store']
+        self.max_attempts = max_attempts or config['job_max_attempts']
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                spec TEXT,
+                model TEXT,
+                prompt_version TEXT,
+                status TEXT,
+                attempts INTEGER DEFAULT 0,
+                worker TEXT,
+                lease_until REAL,
+                heartbeat REAL,
+                result TEXT,
+                error TEXT,
+                created REAL,
+                updated REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id)")
+
+    def _row(self, row):
+        keys = ('id', 'spec', 'model', 'prompt_version', 'status', 'attempts', 'worker', 'lease_until',
+                'heartbeat', 'result', 'error', 'created', 'updated')
+        job = dict(zip(keys, row))
+        job['spec'] = json.loads(job['spec'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def add(self, specs):
+        """
+        批量入队，spec 为 dict（idx_ins/idx_plot/prompt_version/model），返回新任务 id 列表
+        model/prompt_version 为空表示任意 worker 都可以领取
+        """
+        now = time.time()
+        ids = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for spec in specs:
+                    cur = self._conn.execute(
+                        "INSERT INTO jobs (spec, model, prompt_version, status, created, updated) "
+                        "VALUES (?, ?, ?, 'queued', ?, ?)",
+                        (json.dumps(spec, ensure_ascii=False), spec.get('model') or '',
+                         spec.get('prompt_version') or '', now, now)
+                    )
+                    ids.append(cur.lastrowid)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return ids
+
+    def claim(self, worker, lease=None, model='', prompt_version=''):
+        """
+        领取一个任务：排队中的，或租约已过期的运行中任务；只派发 model/prompt_version 为空或与本 worker 一致的任务
+        返回任务 dict，没有可领取的任务时返回 None
+        """
+        lease = lease or config['job_lease']
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 租约过期且次数用完的任务不再派发
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = '租约过期（worker 无响应）', updated = ? "
+                    "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                    (now, now, self.max_attempts)
+                )
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE (status = 'queued' OR (status = 'running' AND lease_until < ?)) "
+                    "AND attempts < ? AND model IN ('', ?) AND prompt_version IN ('', ?) ORDER BY id LIMIT 1",
+                    (now, self.max_attempts, model or '', prompt_version or '')
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, lease_until = ?, "
+                    "heartbeat = ?, updated = ? WHERE id = ?",
+                    (worker, now + lease, now, now, row[0])
+                )
+                job = self._row(self._conn.execute("SELECT * FROM jobs WHERE id = ?", (row[0],)).fetchone())
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return job
+
+    def _update_owned(self, sql, params, job_id, worker):
+        # 只有仍持有租约的 worker 能修改任务；租约已被别人接手时返回 False
+        with self._lock:
+            cur = self._conn.execute(f"{sql} WHERE id = ? AND worker = ? AND status = 'running'",
+                                     (*params, job_id, worker))
+        return cur.rowcount == 1
+
+    def heartbeat(self, job_id, worker, lease=None):
+        """
+        续约，返回 False 表示租约已失效（过期后被其他 worker 领走），应停止该任务
+        """
+        now = time.time()
+        return self._update_owned("UPDATE jobs SET lease_until = ?, heartbeat = ?, updated = ?",
+                                  (now + (lease or config['job_lease']), now, now), job_id, worker)
+
+    def complete(self, job_id, worker, result=None):
+        return self._update_owned("UPDATE jobs SET status = 'done', result = ?, error = NULL, updated = ?",
+                                  (json.dumps(result, ensure_ascii=False), time.time()), job_id, worker)
+
+    def fail(self, job_id, worker, error):
+        """
+        失败：次数未用完时回到队列，否则标记为 failed
+        """
+        return self._update_owned(
+            "UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, error = ?, "
+            "lease_until = NULL, updated = ?",
+            (self.max_attempts, str(error), time.time()), job_id, worker
+        )
+
+    def release(self, job_id, worker):
+        """
+        worker 主动退出时归还任务，不计入尝试次数
+        """
+        return self._update_owned(
+            "UPDATE jobs SET status = 'queued', attempts = attempts - 1, worker = NULL, lease_until = NULL, "
+            "updated = ?", (time.time(),), job_id, worker
+        )
+
+    def requeue(self, statuses=('failed',)):
+        """
+        把指定状态的任务重新入队并清零尝试次数，返回数量
+        """
+        marks = ",".join("?" * len(statuses))
+        with self._lock:
+            cur = self._conn.execute(
+                f"UPDATE jobs SET status = 'queued', attempts = 0, worker = NULL, lease_until = NULL, "
+                f"updated = ? WHERE status IN ({marks})", (time.time(), *statuses)
+            )
+        return cur.rowcount
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def stats(self):
+        """
+        各状态任务数和正在运行的任务（worker、剩余租约秒数）
+        """
+        now = time.time()
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            running = self._conn.execute(
+                "SELECT id, worker, lease_until, attempts FROM jobs WHERE status = 'running' ORDER BY id"
+            ).fetchall()
+        return {
+            'counts': {s: counts.get(s, 0) for s in STATUSES},
+            'running': [{'id': i, 'worker': w, 'lease_left': round(lease - now, 1), 'attempts': a}
+                        for i, w, lease, a in running],
+        }
+
+
+class HttpJobStore:
+    """
+    远程任务队列的客户端（python job_queue.py serve 起的服务），方法与 SqliteJobStore 相同
+    """
+
+    def __init__(self, url=None, token=None, timeout=30):
+        self.path = (url or config['job_store']).rstrip('/')
+        self.token = config['job_token'] if token is None else token
+        self.timeout = timeout
+
+    def _call(self, method, **kwargs):
+        body = json.dumps(kwargs, ensure_ascii=False).encode('utf-8')
+        request = urllib.request.Request(f"{self.path}/jobs/{method}", data=body, method='POST',
+                                         headers={'Content-Type': 'application/json', 'X-Job-Token': self.token})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())['result']
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"任务队列 {method} 失败: {e.code} {e.read().decode('utf-8', 'ignore')}") from None
+
+    def add(self, specs):
+        return self._call('add', specs=specs)
+
+    def claim(self, worker, lease=None, model='', prompt_version=''):
+        return self._call('claim', worker=worker, lease=lease, model=model, prompt_version=prompt_version)
+
+    def heartbeat(self, job_id, worker, lease=None):
+        return self._call('heartbeat', job_id=job_id, worker=worker, lease=lease)
+
+    def complete(self, job_id, worker, result=None):
+        return self._call('complete', job_id=job_id, worker=worker, result=result)
+
+    def fail(self, job_id, worker, error):
+        return self._call('fail', job_id=job_id, worker=worker, error=str(error))
+
+    def release(self, job_id, worker):
+        return self._call('release', job_id=job_id, worker=worker)
+
+    def requeue(self, statuses=('failed',)):
+        return self._call('requeue', statuses=list(statuses))
+
+    def get(self, job_id):
+        return self._call('get', job_id=job_id)
+
+    def stats(self):
+        return self._call('stats')
+
+
+# 网络接口允许调用的方法
+REMOTE_METHODS = ('add', 'claim', 'heartbeat', 'complete', 'fail', 'release', 'requeue', 'get', 'stats')
+
+
+class JobStoreHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    store = None
+
+    def log_message(self, fmt, *args):
+        logger.debug("job_queue: " + fmt % args)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if not hmac.compare_digest(self.headers.get('X-Job-Token', ''), config['job_token']):
+            self._send_json(403, {'error': 'token 不正确'})
+            return
+        method = self.path.rstrip('/').rsplit('/', 1)[-1]
+        if not self.path.startswith('/jobs/') or method not in REMOTE_METHODS:
+            self._send_json(404, {'error': 'not found'})
+            return
+        try:
+            kwargs = json.loads(body or b'{}')
+            self._send_json(200, {'result': getattr(self.store, method)(**kwargs)})
+        except (TypeError, ValueError) as e:
+            self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            # 例如 SQLite 的 database is locked，客户端收到 500 后按各自的策略重试
+            logger.error(f"任务队列 {method} 出错: {e}")
+            self._send_json(500, {'error': f"{type(e).__name__}: {e}"})
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def serve_store(store, host='127.0.0.1', port=None):
+    """
+    在后台线程提供任务队列的 HTTP 接口，返回 server（server.shutdown() 停止）
+    监听非本机地址时必须设置 config['job_token']，否则任何能连上的人都能入队、完成或重新入队任务
+    """
+    if not is_loopback(host) and not config['job_token']:
+        raise ValueError(f"监听 {host} 需要先设置 config['job_token']")
+    handler = type('BoundJobStoreHandler', (JobStoreHandler,), {'store': store})
+    server = ThreadingHTTPServer((host, config['job_port'] if port is None else port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='job-store', daemon=True).start()
+    logger.info(f"任务队列服务已启动: http://{host}:{server.server_address[1]}（{store.path}）")
+    return server
+
+
+def get_job_store(target=None):
+    """
+    target（默认 config['job_store']）为 http:// 地址时连接远程队列，否则为本地 SQLite 文件
+    """
+    target = target or config['job_store']
+    if target.startswith(('http://', 'https://')):
+        return HttpJobStore(target)
+    return SqliteJobStore(target)
+
+
+def make_specs(total, idx_ins=None, idx_plot=None, model='', prompt_version=''):
+    """
+    生成 total 个故事规格；未指定导语/剧情索引时按 pair_selector 配对（入队时就确定，重跑结果可复现）
+    """
+    from pair_selector import pick_pair
+    specs = []
+    for _ in range(total):
+        ins, plot = (idx_ins, idx_plot) if idx_ins is not None and idx_plot is not None else pick_pair()
+        specs.append({'idx_ins': ins, 'idx_plot': plot, 'model': model, 'prompt_version': prompt_version})
+    return specs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='持久化任务队列')
+    parser.add_argument('--store', help='SQLite 文件或 http:// 地址，默认 config["job_store"]')
+    sub = parser.add_subparsers(dest='command', required=True)
+    add = sub.add_parser('add', help='入队')
+    add.add_argument('-n', '--total', type=int, default=config['batch_total'], help='篇数')
+    add.add_argument('--ins', type=int, help='导语索引（与 --plot 一起指定时每篇都用这一对）')
+    add.add_argument('--plot', type=int, help='剧情索引')
+    add.add_argument('--model', default=config['model'], help='模型（空字符串表示任意 worker 的模型）')
+    add.add_argument('--prompt-version', help='提示词版本，默认为本机提示词文件的哈希；空字符串表示不限')
+    sub.add_parser('status', help='查看队列')
+    requeue = sub.add_parser('requeue', help='重新入队')
+    requeue.add_argument('--status', nargs='+', default=['failed'], choices=STATUSES)
+    serve = sub.add_parser('serve', help='提供 HTTP 接口，供其他机器的 worker 使用')
+    serve.add_argument('--host', default='127.0.0.1', help='多台机器时用 0.0.0.0，并设置 config["job_token"]')
+    serve.add_argument('--port', type=int, default=config['job_port'])
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        store = SqliteJobStore(args.store)
+        try:
+            server = serve_store(store, args.host, args.port)
+        except ValueError as e:
+            parser.error(str(e))
+        try:
+            while True:
+                time.sleep(60)
+                logger.info(f"任务队列: {store.stats()['counts']}")
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+
+    store = get_job_store(args.store)
+    if args.command == 'add':
+        version = args.prompt_version
+        if version is None:
+            from job_worker import prompt_version
+            version = prompt_version()
+        ids = store.add(make_specs(args.total, args.ins, args.plot, args.model, version))
+        logger.info(f"已入队 {len(ids)} 篇: {ids[0]}~{ids[-1]}" if ids else "没有入队任何任务")
+    elif args.command == 'status':
+        stats = store.stats()
+        logger.info(f"任务队列: {stats['counts']}")
+        for job in stats['running']:
+            logger.info(f"  #{job['id']} {job['worker']} 第 {job['attempts']} 次，租约剩余 {job['lease_left']} 秒")
+    elif args.command == 'requeue':
+        logger.info(f"已重新入队 {store.requeue(args.status)} 个任务")
+
+
+if __name__ == '__main__':
+    main()
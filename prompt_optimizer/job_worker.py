@@ -0,0 +1,176 @@
+import argparse
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+import socket
+from pathlib import Path
+from log import logger
+from config import config
+from job_queue import get_job_store, worker_name
+import llm_client
+
+# 任务队列的 worker：从 config['job_store']（本地 SQLite 或远程 http:// 队列）领取故事任务并写作，
+# 写作期间定期心跳续约；想加快进度就在本机或其他机器上多启动几个 worker
+# 用法: python job_worker.py -c 4          # 同时写 4 篇，队列空时等待新任务
+#       python job_worker.py --drain       # 队列空时退出
+# Ctrl+C 停止时未完成的任务归还队列，检查点保留，本机再次领到时从断点继续
+
+PROMPT_KEYS = ('prompt_path_sys', 'prompt_path_ins', 'prompt_path_change', 'prompt_path_text')
+
+
+def prompt_version():
+    """
+    本机提示词文件内容的短哈希；入队时记入任务，worker 只领取版本一致（或未指定版本）的任务
+    """
+    digest = hashlib.sha256()
+    for key in PROMPT_KEYS:
+        digest.update(Path(config[key]).read_bytes())
+        digest.update(b'\0')
+    return digest.hexdigest()[:12]
+
+
+async def report(call, job_id, *args, retries=5):
+    """
+    向队列提交 fail/complete，连不上或出错时按心跳间隔重试；仍失败时返回 None，
+    租约到期后任务会被重新领取
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await asyncio.to_thread(call, job_id, *args)
+        except Exception as e:
+            if attempt == retries:
+                logger.error(f"任务 #{job_id} 的 {call.__name__} 提交失败，放弃: {e}")
+                return None
+            logger.warning(f"任务 #{job_id} 的 {call.__name__} 提交失败（第 {attempt + 1} 次），稍后重试: {e}")
+            await asyncio.sleep(config['job_heartbeat'])
+
+
+async def run_job(store, job, worker, lease, parallel):
+    """
+    写一篇任务故事，期间每 config['job_heartbeat'] 秒续约一次；租约被别人接手时停止本篇
+    成功返回输出路径，失败或租约失效返回 None；不会因为队列不可用而抛异常
+    """
+    # 写作流程依赖提示词文件，在领到任务时才导入
+    from model_test import write_story
+    job_id, spec = job['id'], job['spec']
+    logger.info(f"[{worker}] 领取任务 #{job_id}（第 {job['attempts']} 次）：导语 {spec['idx_ins']}，剧情 {spec['idx_plot']}")
+    # 以任务 id 作为篇号，输出为 test_<id>.txt，检查点按任务 id 保存
+    pair = (spec['idx_ins'], spec['idx_plot'])
+    story = asyncio.ensure_future(write_story(job_id - 1, False, True, parallel, pair=pair))
+    try:
+        while True:
+            done, _ = await asyncio.wait([story], timeout=config['job_heartbeat'])
+            if done:
+                break
+            try:
+                alive = await asyncio.to_thread(store.heartbeat, job_id, worker, lease)
+            except Exception as e:
+                # 队列暂时连不上时继续写，租约到期前恢复即可
+                logger.warning(f"任务 #{job_id} 心跳失败: {e}")
+                continue
+            if not alive:
+                logger.warning(f"任务 #{job_id} 的租约已失效（已被其他 worker 接手），停止本篇")
+                story.cancel()
+                await asyncio.gather(story, return_exceptions=True)
+                return None
+    except asyncio.CancelledError:
+        story.cancel()
+        await asyncio.gather(story, return_exceptions=True)
+        try:
+            await asyncio.to_thread(store.release, job_id, worker)
+            logger.info(f"任务 #{job_id} 已归还队列")
+        except Exception as e:
+            logger.warning(f"任务 #{job_id} 归还失败，租约到期后会被重新领取: {e}")
+        raise
+
+    try:
+        output = story.result()
+    except Exception as e:
+        logger.error(f"任务 #{job_id} 失败: {e}")
+        await report(store.fail, job_id, worker, f"{type(e).__name__}: {e}")
+        return None
+    result = {'output': os.path.abspath(output), 'host': socket.gethostname()}
+    if await report(store.complete, job_id, worker, result) is False:
+        logger.warning(f"任务 #{job_id} 已完成，但租约已失效，结果未记入队列: {output}")
+    return output
+
+
+async def run_worker(store, worker=None, concurrency=None, lease=None, drain=False, stop=None,
+                     parallel=config['parallel_chapters']):
+    """
+    持续领取任务，最多同时写 concurrency 篇；drain=True 时队列空且手头任务完成后返回
+    stop（asyncio.Event）被设置时停止领取，取消手头任务并归还队列
+    返回完成的篇数
+    """
+    worker = worker or worker_name()
+    concurrency = concurrency or config['job_concurrency']
+    lease = lease or config['job_lease']
+    model, version = config['model'], prompt_version()
+    stop = stop or asyncio.Event()
+    stopping = asyncio.ensure_future(stop.wait())
+    running, completed = set(), 0
+    logger.info(f"worker {worker} 启动：并发 {concurrency}，模型 {model}，提示词版本 {version}，队列 {store.path}")
+    try:
+        while not stop.is_set():
+            while len(running) < concurrency:
+                try:
+                    job = await asyncio.to_thread(store.claim, worker, lease, model, version)
+                except Exception as e:
+                    logger.warning(f"领取任务失败: {e}")
+                    break
+                if job is None:
+                    break
+                running.add(asyncio.ensure_future(run_job(store, job, worker, lease, parallel)))
+            if not running and drain:
+                break
+            done, _ = await asyncio.wait(running | {stopping}, timeout=config['job_poll_interval'],
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done - {stopping}:
+                running.discard(task)
+                try:
+                    if task.result() is not None:
+                        completed += 1
+                except Exception as e:
+                    # 单个任务出错不影响其他正在写的篇目
+                    logger.error(f"任务异常: {type(e).__name__}: {e}")
+    finally:
+        stopping.cancel()
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+    logger.info(f"worker {worker} 退出，完成 {completed} 篇")
+    return completed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='任务队列 worker')
+    parser.add_argument('--store', help='SQLite 文件或 http:// 地址，默认 config["job_store"]')
+    parser.add_argument('-c', '--concurrency', type=int, default=config['job_concurrency'], help='同时写作的篇数')
+    parser.add_argument('--name', help='worker 名，默认 主机名:进程号')
+    parser.add_argument('--model', help='本 worker 使用的模型（只领取该模型或未指定模型的任务）')
+    parser.add_argument('--drain', action='store_true', help='队列空时退出')
+    parser.add_argument('--parallel', action='store_true', default=config['parallel_chapters'],
+                        help='大纲完成后三段正文并行生成')
+    args = parser.parse_args()
+    if args.model:
+        config['model'] = args.model
+
+    stop = asyncio.Event()
+    future = llm_client.submit(run_worker(get_job_store(args.store), args.name, max(1, args.concurrency),
+                                          drain=args.drain, stop=stop, parallel=args.parallel))
+    try:
+        # 带超时轮询，Windows 下 Ctrl+C 才能及时打断
+        while True:
+            try:
+                return future.result(timeout=1)
+            except concurrent.futures.TimeoutError:
+                continue
+    except KeyboardInterrupt:
+        logger.info("正在停止 worker，未完成的任务归还队列…")
+        llm_client.get_loop().call_soon_threadsafe(stop.set)
+        return future.result(timeout=60)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from log import logger
+from config import config
+
+
+def retry_after_seconds(error):
+    """
+    从错误响应头读取 Retry-After（支持 retry-after-ms、秒数和 HTTP 日期），没有则返回 None
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class KeyState:
+    def __init__(self, name, api_key):
+        self.name = name
+        self.api_key = api_key
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.tokens = 0
+        self.cooldown_until = 0.0
+        self.last_error = ""
+        self._recent = deque()  # (时间戳, tokens)，用于统计最近一分钟的速率
+
+    def record(self, tokens, now):
+        self._recent.append((now, tokens))
+        self._trim(now)
+
+    def _trim(self, now):
+        while self._recent and now - self._recent[0][0] > 60:
+            self._recent.popleft()
+
+    def rate(self, now):
+        """
+        最近 60 秒的 (请求数, token 数)
+        """
+        self._trim(now)
+        return len(self._recent), sum(t for _, t in self._recent)
+
+
+class KeyLease:
+    """
+    一次调用占用的 key：with 块内抛出异常时按状态码记错误并视情况冷却
+    """
+
+    def __init__(self, pool, state):
+        self.pool = pool
+        self.state = state
+        self.api_key = state.api_key
+        self.tokens = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is None:
+            self.pool.release(self.state, tokens=self.tokens)
+        else:
+            self.pool.release(self.state, error=exc)
+        return False
+
+
+class KeyPool:
+    """
+    多 key 轮换：每次取当前并发最少、且不在冷却中的 key；
+    401/403（鉴权失败、余额不足）长时间冷却，429 按 Retry-After 或默认时长冷却
+    """
+
+    def __init__(self, names=None):
+        names = names or config['api_keys']
+        self.keys = [KeyState(name, config[name]) for name in names if config.get(name)]
+        if not self.keys:
+            raise ValueError("config['api_keys'] 中没有可用的 key")
+        self._cond = threading.Condition()
+
+    def _available(self, now):
+        return [k for k in self.keys if k.cooldown_until <= now]
+
+    def _try_acquire(self):
+        """
+        返回 (lease, 0)；全部冷却时返回 (None, 需要等待的秒数)
+        """
+        now = time.time()
+        candidates = self._available(now)
+        if candidates:
+            state = min(candidates, key=lambda k: (k.in_flight, k.requests))
+            state.in_flight += 1
+            state.requests += 1
+            return KeyLease(self, state), 0
+        return None, max(min(k.cooldown_until for k in self.keys) - now, 0.1)
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                lease, wait = self._try_acquire()
+                if lease is not None:
+                    return lease
+                logger.warning(f"所有 key 都在冷却中，等待 {wait:.0f} 秒")
+                self._cond.wait(timeout=wait)
+
+    async def acquire_async(self):
+        """
+        事件循环中使用：等待期间不阻塞循环
+        """
+        while True:
+            with self._cond:
+                lease, wait = self._try_acquire()
+            if lease is not None:
+                return lease
+            logger.warning(f"所有 key 都在冷却中，等待 {wait:.0f} 秒")
+            await asyncio.sleep(min(wait, 5))
+
+    def lease(self):
+        return self.acquire()
+
+    def release(self, state, tokens=0, error=None):
+        with self._cond:
+            now = time.time()
+            state.in_flight -= 1
+            state.tokens += tokens
+            state.record(tokens, now)
+            if error is not None:
+                state.errors += 1
+                state.last_error = str(error)[:200]
+                cooldown = self._cooldown_for(error)
+                if cooldown:
+                    state.cooldown_until = max(state.cooldown_until, now + cooldown)
+                    logger.warning(f"key {state.name} 暂停使用 {cooldown:.0f} 秒: {state.last_error}")
+            self._cond.notify_all()
+
+    @staticmethod
+    def _cooldown_for(error):
+        status = getattr(error, 'status_code', None)
+        if status in (401, 403):
+            return config['key_auth_cooldown']
+        if status == 429:
+            retry_after = retry_after_seconds(error)
+            return retry_after if retry_after is not None else config['key_rate_cooldown']
+        return 0
+
+    def snapshot(self):
+        """
+        各 key 的实时用量
+        """
+        with self._cond:
+            now = time.time()
+            rows = []
+            for k in self.keys:
+                rpm, tpm = k.rate(now)
+                rows.append({
+                    'name': k.name,
+                    'in_flight': k.in_flight,
+                    'requests': k.requests,
+                    'errors': k.errors,
+                    'tokens': k.tokens,
+                    'rpm': rpm,
+                    'tpm': tpm,
+                    'cooldown': max(0, round(k.cooldown_until - now)),
+                    'last_error': k.last_error,
+                })
+            return rows
+
+    def format_usage(self):
+        lines = ["key 用量: 名称 | 进行中 | 请求 | 错误 | tokens | 每分钟请求 | 每分钟tokens | 冷却秒"]
+        for r in self.snapshot():
+            lines.append(f"  {r['name']} | {r['in_flight']} | {r['requests']} | {r['errors']} | {r['tokens']} | "
+                         f"{r['rpm']} | {r['tpm']} | {r['cooldown']}")
+        return "\n".join(lines)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_key_pool():
+    """
+    进程内共享的 key 池
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = KeyPool()
+    return _pool
@@ -0,0 +1,210 @@
+import asyncio
+import random
+import threading
+import time
+from contextlib import nullcontext
+import openai
+from log import logger
+from config import config
+from client_pool import get_async_client
+from concurrency_limiter import get_limiter
+from key_pool import get_key_pool, retry_after_seconds
+from prompt_cache import apply_cache_markers, log_usage
+from stream_writer import StreamFile, read_text
+from stream_checks import QualityCheckFailed
+import metrics
+
+# 所有模型调用共用一个后台事件循环：Qt 线程和命令行脚本都把协程提交到这里，
+# 几十个流式请求在同一个循环里并发，不再一个调用占一个系统线程
+_loop = None
+_loop_lock = threading.Lock()
+
+# 重试也不会成功的错误（请求本身有问题）
+NON_RETRYABLE = (openai.BadRequestError, openai.NotFoundError, openai.UnprocessableEntityError)
+
+
+class RetryExhausted(Exception):
+    pass
+
+
+class StreamStalled(TimeoutError):
+    """
+    流式响应停顿：首 token 超时（kind='first_token'）或两次输出之间间隔过长（kind='idle'）
+    """
+
+    def __init__(self, kind, seconds):
+        self.kind = kind
+        self.seconds = seconds
+        label = '首 token' if kind == 'first_token' else '输出间隔'
+        super().__init__(f"流式响应停顿：{label}超过 {seconds} 秒")
+
+
+def get_loop():
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='llm-loop', daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def submit(coro):
+    """
+    把协程提交到后台事件循环，返回 concurrent.futures.Future；future.cancel() 会取消正在进行的请求
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run_sync(coro):
+    """
+    同步等待协程结果（不能在后台事件循环线程内调用）
+    """
+    return submit(coro).result()
+
+
+async def stream_chat(messages, model=None, temperature=1.0, on_delta=None, out_path=None,
+                      static_texts=(), timeout=None, api_key=None, base_url=None, checks=None):
+    """
+    一次流式调用，返回 (完整内容, usage)
+    on_delta: 每收到一段 delta 调用一次；out_path: delta 边收边落盘，最终内容从文件读回
+    api_key 为空时从 key 池取 key；timeout 为整次调用的超时秒数
+    首 token 超过 config['first_token_timeout'] 秒、或两次输出间隔超过 config['chunk_idle_timeout'] 秒时
+    中止本次请求并抛出 StreamStalled（由 chat_with_retry 重试）
+    checks 为质量检查器工厂（见 stream_checks.step_checks），每次请求新建一个；检查不通过时
+    立即中止本次请求并抛出 QualityCheckFailed（同样由 chat_with_retry 重试）
+    config['limiter_enabled'] 打开时先在该接口的自适应并发窗口内排队
+    """
+    model = model or config['model']
+    base_url = base_url or config['url']
+    timeout = timeout or config['call_timeout']
+    limiter = get_limiter(base_url) if config['limiter_enabled'] else None
+    async with (limiter.slot() if limiter else nullcontext()) as slot:
+        if limiter is not None:
+            metrics.set_field('window', limiter.window)
+        content, usage = await _stream_once(messages, model, temperature, on_delta, out_path, static_texts,
+                                            timeout, api_key, base_url, slot, checks)
+    logger.debug(f"模型流式输出完成，总长度: {len(content)} 字符")
+    log_usage(usage)
+    metrics.set_output(content, usage)
+    return content, usage
+
+
+async def _stream_once(messages, model, temperature, on_delta, out_path, static_texts, timeout, api_key, base_url,
+                       slot, checks=None):
+    parts = []
+    usage = None
+    lease = nullcontext() if api_key else await get_key_pool().acquire_async()
+    started = time.monotonic()
+    with lease, (StreamFile(out_path) if out_path else nullcontext()) as sink:
+        client = get_async_client(base_url, api_key or lease.api_key)
+        metrics.attempt_started()
+        extra = {"stream_options": {"include_usage": True}} if config['stream_usage'] else {}
+        loop = asyncio.get_running_loop()
+        first_token_timeout = config['first_token_timeout'] or None
+        idle_timeout = config['chunk_idle_timeout'] or None
+        # 看门狗：收到首个 token 之前按首 token 时限，之后每收到一块就顺延 idle_timeout
+        watchdog = asyncio.timeout(first_token_timeout)
+        got_token = False
+        gate = checks() if checks is not None else None
+        try:
+            async with asyncio.timeout(timeout), watchdog:
+                stream = await client.chat.completions.create(
+                    model=model,
+                    messages=apply_cache_markers(messages, model, static_texts, base_url),
+                    temperature=temperature,
+                    stream=True,
+                    **extra
+                )
+                # 超时或被取消时及时关闭响应，连接回到连接池
+                async with stream:
+                    async for chunk in stream:
+                        if getattr(chunk, 'usage', None):
+                            usage = chunk.usage
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            delta = chunk.choices[0].delta.content
+                            got_token = True
+                            metrics.first_token()
+                            if slot is not None and slot.ttft is None:
+                                slot.ttft = time.monotonic() - started
+                            if sink is not None:
+                                sink.write(delta)
+                            else:
+                                parts.append(delta)
+                            if on_delta is not None:
+                                on_delta(delta)
+                            if gate is not None:
+                                gate.feed(delta)
+                        if got_token:
+                            watchdog.reschedule(loop.time() + idle_timeout if idle_timeout else None)
+                if gate is not None:
+                    gate.finish()
+        except QualityCheckFailed as e:
+            # 抛出异常时 async with stream 已关闭连接，服务端随之停止生成
+            metrics.add_quality_abort(e.check)
+            raise
+        except TimeoutError:
+            if not watchdog.expired():
+                raise
+            kind, seconds = ('idle', idle_timeout) if got_token else ('first_token', first_token_timeout)
+            metrics.add_stall(kind)
+            raise StreamStalled(kind, seconds) from None
+        if not api_key:
+            lease.tokens = (usage.total_tokens or 0) if usage is not None else 0
+    content = read_text(out_path) if out_path else "".join(parts)
+    return content, usage
+
+
+def backoff_seconds(retry, error):
+    """
+    优先使用服务端 Retry-After，否则指数退避加随机抖动
+    """
+    if isinstance(error, QualityCheckFailed):
+        # 内容问题与服务端负载无关，不用退避
+        return random.uniform(0, 1)
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        return retry_after + random.uniform(0, 1)
+    return (2 ** retry) + random.uniform(0, 1)
+
+
+async def chat_with_retry(messages, max_retries=5, on_retry=None, on_reset=None, **kwargs):
+    """
+    带重试的流式调用，返回完整内容；kwargs 透传给 stream_chat
+    on_retry(第几次, 等待秒数, 错误) 用于界面提示
+    on_reset() 在重试前调用：失败的那次已经通过 on_delta 发出的内容作废（流被中止或质检未通过），
+    调用方据此清掉半截输出；该次没有发出过内容时不调用
+    """
+    sent = False
+    on_delta = kwargs.get('on_delta')
+    if on_delta is not None and on_reset is not None:
+        def forward(delta):
+            nonlocal sent
+            sent = True
+            on_delta(delta)
+        kwargs['on_delta'] = forward
+    for retry in range(max_retries):
+        try:
+            content, _ = await stream_chat(messages, **kwargs)
+            return content
+        except NON_RETRYABLE:
+            raise
+        except (openai.OpenAIError, TimeoutError, OSError, QualityCheckFailed) as e:
+            metrics.add_retry()
+            wait_time = backoff_seconds(retry, e)
+            logger.warning(f"第 {retry + 1} 次调用失败，{wait_time:.2f} 秒后重试... 错误: {e!r}")
+            if on_retry is not None:
+                on_retry(retry + 1, wait_time, e)
+            if sent:
+                sent = False
+                on_reset()
+            await asyncio.sleep(wait_time)
+    raise RetryExhausted("模型调用失败，已达到最大重试次数")
+
+
+def chat_sync(messages, **kwargs):
+    """
+    同步版 chat_with_retry，供 Qt 工作线程和命令行脚本直接调用
+    """
+    return run_sync(chat_with_retry(messages, **kwargs))
@@ -0,0 +1,210 @@
+import argparse
+import contextvars
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from config import config
+from prompt_cache import cached_tokens
+
+_write_lock = threading.Lock()
+_current = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """
+    一个步骤的耗时与 token 记录，退出时追加一行到 JSONL 指标文件
+    """
+
+    def __init__(self, step, model, story=None, path=None, **extra):
+        self.path = path or config['metrics_path']
+        self.record = {
+            'step': step,
+            'model': model,
+            'story': story,
+            'ttft': None,
+            'duration': None,
+            'input_tokens': None,
+            'output_tokens': None,
+            'cached_tokens': None,
+            'retries': 0,
+            'stalls': 0,
+            'quality_aborts': 0,
+            'chars': 0,
+            'ok': False,
+            'error': None,
+        }
+        self.record.update(extra)
+        self._start = None
+        self._attempt_start = None
+        self._token = None
+
+    def __enter__(self):
+        self._start = self._attempt_start = time.monotonic()
+        self.record['ts'] = time.time()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        self.record['duration'] = round(time.monotonic() - self._start, 3)
+        self.record['ok'] = exc is None
+        if exc is not None:
+            self.record['error'] = f"{type(exc).__name__}: {exc}"[:300]
+        line = json.dumps(self.record, ensure_ascii=False)
+        with _write_lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        return False
+
+
+def current_span():
+    return _current.get()
+
+
+def attempt_started():
+    """
+    一次请求开始（重试时重新计时首 token）
+    """
+    span = _current.get()
+    if span is not None:
+        span._attempt_start = time.monotonic()
+        span.record['ttft'] = None
+
+
+def first_token():
+    span = _current.get()
+    if span is not None and span.record['ttft'] is None:
+        span.record['ttft'] = round(time.monotonic() - span._attempt_start, 3)
+
+
+def add_retry():
+    span = _current.get()
+    if span is not None:
+        span.record['retries'] += 1
+
+
+def add_stall(kind):
+    """
+    流式响应停顿被看门狗中止（kind: first_token / idle）
+    """
+    span = _current.get()
+    if span is not None:
+        span.record['stalls'] += 1
+        span.record.setdefault('stall_kinds', []).append(kind)
+
+
+def add_quality_abort(check):
+    """
+    流式质量检查未通过、中止了本次输出（check 为检查名）
+    """
+    span = _current.get()
+    if span is not None:
+        span.record['quality_aborts'] += 1
+        span.record.setdefault('quality_checks', []).append(check)
+
+
+def set_output(content, usage=None):
+    span = _current.get()
+    if span is None:
+        return
+    span.record['chars'] = len(content)
+    if usage is not None:
+        span.record['input_tokens'] = usage.prompt_tokens
+        span.record['output_tokens'] = usage.completion_tokens
+        span.record['cached_tokens'] = cached_tokens(usage)
+
+
+def set_field(key, value):
+    span = _current.get()
+    if span is not None:
+        span.record[key] = value
+
+
+def percentile(values, p):
+    """
+    最近秩法百分位
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+def load(path):
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def summarize(records):
+    """
+    按 (模型, 步骤) 汇总 p50/p95
+    """
+    groups = defaultdict(list)
+    for r in records:
+        groups[(r.get('model'), r.get('step'))].append(r)
+
+    rows = []
+    for (model, step), items in groups.items():
+        ok = [r for r in items if r.get('ok')]
+
+        def pct(field, p):
+            return percentile([r[field] for r in ok if r.get(field) is not None], p)
+
+        rows.append({
+            'model': model,
+            'step': step,
+            'count': len(items),
+            'failed': len(items) - len(ok),
+            'retries': sum(r.get('retries', 0) for r in items),
+            'stalls': sum(r.get('stalls', 0) for r in items),
+            'quality_aborts': sum(r.get('quality_aborts', 0) for r in items),
+            'duration_p50': pct('duration', 50),
+            'duration_p95': pct('duration', 95),
+            'ttft_p50': pct('ttft', 50),
+            'ttft_p95': pct('ttft', 95),
+            'output_tokens_p50': pct('output_tokens', 50),
+            'chars_p50': pct('chars', 50),
+        })
+    order = {name: n for n, name in enumerate(config['metrics_steps'])}
+    rows.sort(key=lambda r: (str(r['model']), order.get(r['step'], len(order)), str(r['step'])))
+    return rows
+
+
+def _fmt(v):
+    if v is None:
+        return '-'
+    return f"{v:.2f}" if isinstance(v, float) else str(v)
+
+
+def print_report(rows):
+    header = ['模型', '步骤', '次数', '失败', '重试', '停顿', '质检中止', '耗时p50', '耗时p95', '首token p50', '首token p95', '输出tokens p50', '字数p50']
+    keys = ['model', 'step', 'count', 'failed', 'retries', 'stalls', 'quality_aborts', 'duration_p50', 'duration_p95',
+            'ttft_p50', 'ttft_p95', 'output_tokens_p50', 'chars_p50']
+    print(' | '.join(header))
+    for r in rows:
+        print(' | '.join(_fmt(r[k]) for k in keys))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='写作流程指标汇总')
+    parser.add_argument('command', choices=['summary'])
+    parser.add_argument('path', nargs='?', default=config['metrics_path'], help='指标 JSONL 文件')
+    parser.add_argument('--model', help='只看某个模型')
+    args = parser.parse_args()
+
+    records = load(args.path)
+    if args.model:
+        records = [r for r in records if r.get('model') == args.model]
+    print_report(summarize(records))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import hashlib
+import mmap
+import os
+import random
+import re
+import threading
+from array import array
+from pathlib import Path
+from config import config
+
+# 字符 n-gram MinHash：文本 → 定长签名，两个签名相同位置相等的比例即 Jaccard 相似度的估计
+# 签名矩阵存成 uint64 文件，启动时 mmap，按行读取无需反序列化
+
+_MASK64 = (1 << 64) - 1
+_punct = re.compile(r'[\s　，。！？、；：“”‘’「」『』《》（）()【】…—,.!?;:"\'\-]+')
+_masks = {}
+
+
+def _perm_masks(num_perm):
+    # 固定种子：签名必须在不同进程、不同次运行之间保持一致
+    masks = _masks.get(num_perm)
+    if masks is None:
+        rng = random.Random(20251013)
+        masks = [rng.getrandbits(64) for _ in range(num_perm)]
+        _masks[num_perm] = masks
+    return masks
+
+
+def shingles(text, n=None):
+    """
+    去掉空白和标点后的字符 n-gram 集合
+    """
+    n = n or config['similarity_shingle']
+    text = _punct.sub('', text)
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _hash64(s):
+    return int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def signature(text, num_perm=None, n=None):
+    """
+    每个“排列”用 hash ^ mask 实现，取最小值；空文本返回全 0xFF 签名
+    """
+    num_perm = num_perm or config['similarity_perm']
+    hashes = [_hash64(s) for s in shingles(text, n)]
+    if not hashes:
+        return array('Q', [_MASK64] * num_perm)
+    return array('Q', [min(h ^ m for h in hashes) for m in _perm_masks(num_perm)])
+
+
+def lsh_buckets(sig, rows):
+    """
+    LSH 分段：每 rows 个值一段，返回 [(段号, 桶哈希)]；两个签名至少一段完全相同才成为候选
+    桶哈希为有符号 int64，可直接存入 SQLite INTEGER
+    """
+    buckets = []
+    for band in range(len(sig) // rows):
+        raw = sig[band * rows:(band + 1) * rows].tobytes()
+        buckets.append((band, int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), 'little', signed=True)))
+    return buckets
+
+
+def similarity(sig_a, sig_b):
+    """
+    估计的 Jaccard 相似度
+    """
+    return sum(a == b for a, b in zip(sig_a, sig_b)) / len(sig_a)
+
+
+class SignatureStore:
+    """
+    某个素材库的签名矩阵：文件头 [源文件 mtime_ns, 行数, 签名长度, shingle 长度]，其后每行一个签名
+    源文件、签名长度或 shingle 长度变化时由调用方重建
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._mm = None
+        self._rows = None
+        self.num_perm = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def load(self, mtime, num_perm=None, n=None):
+        """
+        文件有效时 mmap 并返回 True
+        """
+        num_perm = num_perm or config['similarity_perm']
+        n = n or config['similarity_shingle']
+        if not self.path.exists():
+            return False
+        with self._lock:
+            with open(self.path, 'rb') as f:
+                header = array('Q')
+                header.frombytes(f.read(32))
+                if header[0] != mtime or header[2] != num_perm or header[3] != n:
+                    return False
+                if os.path.getsize(self.path) != 32 + header[1] * num_perm * 8:
+                    return False
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._rows = memoryview(self._mm)[32:].cast('Q')
+            self.num_perm = num_perm
+            self.count = header[1]
+        return True
+
+    def build(self, texts, mtime, num_perm=None, n=None):
+        num_perm = num_perm or config['similarity_perm']
+        n = n or config['similarity_shingle']
+        data = array('Q', [mtime, 0, num_perm, n])
+        count = 0
+        for text in texts:
+            data.extend(signature(text, num_perm, n))
+            count += 1
+        data[1] = count
+        tmp = self.path.with_suffix('.sig.tmp')
+        tmp.write_bytes(data.tobytes())
+        os.replace(tmp, self.path)
+        return self.load(mtime, num_perm, n)
+
+    def __len__(self):
+        return self.count if self._rows is not None else 0
+
+    def row(self, i):
+        k = self.num_perm
+        return self._rows[i * k:(i + 1) * k]
+
+    def top_k(self, sig, k=5):
+        """
+        与 sig 最相似的 k 行，返回 [(相似度, 行号)]
+        """
+        scores = [(similarity(sig, self.row(i)), i) for i in range(len(self))]
+        scores.sort(key=lambda x: -x[0])
+        return scores[:k]
@@ -0,0 +1,264 @@
+import argparse
+import glob
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from log import logger
+from config import config
+from context_builder import estimate_tokens
+
+# 本地 OpenAI 兼容接口（/v1/chat/completions），回放已有的模型输出，用于离线压测批量写作和重试逻辑
+# 用法: python mock_server.py --ttft 1.5 --tps 40 --fault-429 0.05
+# 然后把 config['url'] 改成 http://127.0.0.1:8900/v1（key 任意）
+
+# text.log 中每次模型输出的开头，输出内容到下一条日志为止
+_log_output = re.compile(r'^.*模型输出.*?：\n', re.M)
+_log_line = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} - ', re.M)
+
+
+def load_corpus(patterns=None):
+    """
+    读取回放语料：.log 文件取其中的模型输出段落，其余文件整篇作为一条输出
+    """
+    texts = []
+    for pattern in patterns or config['mock_corpus']:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                content = f.read()
+            if path.endswith('.log'):
+                for match in _log_output.finditer(content):
+                    rest = content[match.end():]
+                    end = _log_line.search(rest)
+                    texts.append(rest[:end.start()] if end else rest)
+            else:
+                texts.append(content)
+    texts = [t.strip() for t in texts if t.strip()]
+    if not texts:
+        raise FileNotFoundError(f"没有找到回放语料: {patterns or config['mock_corpus']}")
+    return texts
+
+
+def prompt_tokens(messages):
+    """
+    content 可能是带 cache_control 的分段列表（见 prompt_cache.apply_cache_markers）
+    """
+    total = 0
+    for m in messages:
+        content = m.get('content') or ''
+        if isinstance(content, list):
+            content = ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+        total += estimate_tokens(content) + 4
+    return total
+
+
+class MockBehavior:
+    """
+    模拟服务端的行为：首 token 延迟、输出速度、回复长度和故障注入概率
+    fault_timeout: 收到请求后不返回任何内容；fault_stall: 输出一部分后停住
+    """
+
+    def __init__(self, corpus, ttft=1.0, tps=50.0, chunk_tokens=4, max_chars=0, jitter=0.2,
+                 fault_401=0.0, fault_429=0.0, fault_500=0.0, fault_timeout=0.0, fault_stall=0.0,
+                 retry_after=2, hang=3600, seed=None):
+        self.corpus = corpus
+        self.ttft = ttft
+        self.tps = tps
+        self.chunk_tokens = chunk_tokens
+        self.max_chars = max_chars
+        self.jitter = jitter
+        self.faults = {401: fault_401, 429: fault_429, 500: fault_500}
+        self.fault_timeout = fault_timeout
+        self.fault_stall = fault_stall
+        self.retry_after = retry_after
+        self.hang = hang
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'ok': 0, 'errors': 0, 'timeouts': 0, 'stalls': 0}
+
+    def roll(self):
+        with self._lock:
+            return self._random.random()
+
+    def pick_text(self):
+        with self._lock:
+            text = self._random.choice(self.corpus)
+        return text[:self.max_chars] if self.max_chars else text
+
+    def delay(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds * (1 + self.jitter * (self.roll() * 2 - 1)))
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    behavior = None
+
+    def log_message(self, fmt, *args):
+        logger.debug("mock: " + fmt % args)
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status):
+        messages = {401: "Invalid API key", 429: "Rate limit reached", 500: "Internal server error"}
+        headers = {'Retry-After': str(self.behavior.retry_after)} if status == 429 else None
+        self.behavior.count('errors')
+        self._send_json(status, {"error": {"message": messages[status], "type": "mock_error", "code": status}},
+                        headers)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _sse(self, payload):
+        self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {"object": "list", "data": [{"id": config['model'], "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        behavior = self.behavior
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        behavior.count('requests')
+
+        roll = behavior.roll()
+        for status, p in behavior.faults.items():
+            if roll < p:
+                self._send_error(status)
+                return
+            roll -= p
+        if roll < behavior.fault_timeout:
+            behavior.count('timeouts')
+            time.sleep(behavior.hang)
+            self.close_connection = True
+            return
+
+        model = request.get('model', config['model'])
+        text = behavior.pick_text()
+        usage = {"prompt_tokens": prompt_tokens(request.get('messages', [])),
+                 "completion_tokens": estimate_tokens(text)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        behavior.delay(behavior.ttft)
+
+        if not request.get('stream'):
+            self._send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            behavior.count('ok')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def chunk(delta, finish_reason=None):
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+        stall_at = len(text) // 2 if behavior.roll() < behavior.fault_stall else None
+        step = max(1, behavior.chunk_tokens)
+        interval = step / behavior.tps if behavior.tps > 0 else 0
+        try:
+            self._sse(chunk({"role": "assistant", "content": ""}))
+            for start in range(0, len(text), step):
+                if stall_at is not None and start >= stall_at:
+                    behavior.count('stalls')
+                    time.sleep(behavior.hang)
+                    self.close_connection = True
+                    return
+                self._sse(chunk({"content": text[start:start + step]}))
+                behavior.delay(interval)
+            self._sse(chunk({}, "stop"))
+            if (request.get('stream_options') or {}).get('include_usage'):
+                self._sse({"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                           "model": model, "choices": [], "usage": usage})
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+            behavior.count('ok')
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端超时或取消后断开
+            self.close_connection = True
+
+
+def start_server(behavior, host='127.0.0.1', port=None):
+    """
+    在后台线程启动模拟服务，返回 server（server.shutdown() 停止）；port=0 时随机端口
+    """
+    handler = type('BoundMockHandler', (MockHandler,), {'behavior': behavior})
+    server = ThreadingHTTPServer((host, config['mock_port'] if port is None else port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-server', daemon=True).start()
+    logger.info(f"模拟接口已启动: http://{host}:{server.server_address[1]}/v1")
+    return server
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='本地 OpenAI 兼容模拟接口（离线压测）')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=config['mock_port'])
+    parser.add_argument('--corpus', nargs='*', help='回放语料（glob），默认 config["mock_corpus"]')
+    parser.add_argument('--ttft', type=float, default=1.0, help='首 token 延迟（秒）')
+    parser.add_argument('--tps', type=float, default=50.0, help='每秒输出 token 数（按 1 字 1 token 计）')
+    parser.add_argument('--chunk-tokens', type=int, default=4, help='每个 SSE 块的 token 数')
+    parser.add_argument('--max-chars', type=int, default=0, help='回复最多多少字（0 为整篇回放）')
+    parser.add_argument('--jitter', type=float, default=0.2, help='延迟随机波动比例')
+    parser.add_argument('--fault-401', type=float, default=0.0, help='返回 401 的概率')
+    parser.add_argument('--fault-429', type=float, default=0.0, help='返回 429 的概率')
+    parser.add_argument('--fault-500', type=float, default=0.0, help='返回 500 的概率')
+    parser.add_argument('--fault-timeout', type=float, default=0.0, help='不响应（触发客户端超时）的概率')
+    parser.add_argument('--fault-stall', type=float, default=0.0, help='输出到一半停住的概率')
+    parser.add_argument('--retry-after', type=int, default=2, help='429 响应的 Retry-After 秒数')
+    parser.add_argument('--hang', type=float, default=3600, help='超时/停住故障持续秒数')
+    parser.add_argument('--seed', type=int, help='随机种子')
+    return parser
+
+
+def behavior_from_args(args):
+    return MockBehavior(load_corpus(args.corpus), ttft=args.ttft, tps=args.tps, chunk_tokens=args.chunk_tokens,
+                        max_chars=args.max_chars, jitter=args.jitter, fault_401=args.fault_401,
+                        fault_429=args.fault_429, fault_500=args.fault_500, fault_timeout=args.fault_timeout,
+                        fault_stall=args.fault_stall, retry_after=args.retry_after, hang=args.hang, seed=args.seed)
+
+
+def main():
+    args = build_parser().parse_args()
+    behavior = behavior_from_args(args)
+    logger.info(f"回放语料 {len(behavior.corpus)} 条")
+    server = start_server(behavior, args.host, args.port)
+    try:
+        while True:
+            time.sleep(60)
+            logger.info(f"模拟接口统计: {behavior.stats}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
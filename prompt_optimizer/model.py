@@ -1,16 +1,13 @@
 import logging
-import openai
 import time
 import random
 from atom_library import WomenShortStories
 from log import logger
 from config import config
-from openai import OpenAI
+from context_builder import StoryContext, report_budget
+import llm_client
 from pathlib import Path
 
-# 初始化客户端
-client = OpenAI(base_url=config['url'],api_key=config['api-key-余额-100'])
-
 # 开启调式模式（True为Debug，False为Info）
 debug_mode = config['log_debug']
 if debug_mode:
@@ -20,22 +17,12 @@ else:
 
 system_text = Path(config['prompt_path_sys']).read_text(encoding='utf-8')
 
-def cell_model(message_sta):
-    for retry in range(6):
-        try:
-            response = client.chat.completions.create(
-                model=config['model'],
-                messages=message_sta,
-                temperature=1,
-            )
-            content = response.choices[0].message.content
-            message_sta.append({"role": "assistant", "content": content})
-            logger.debug(f'模型输出内容：\n{content}')
-            return message_sta
-        except (openai.APIConnectionError, openai.APITimeoutError) as e:
-            wait_time = 2 ** retry
-            logger.warning(f'网络错误，第{retry + 1}次调用失败，等待 {wait_time} 秒后重试... 错误信息: {e}')
-            time.sleep(wait_time)
+def cell_model(message_sta, static_texts=()):
+    # 统一走 llm_client：key 池轮换、超时和退避重试都在那里处理
+    content = llm_client.chat_sync(message_sta, max_retries=6, model=config['model'], static_texts=static_texts)
+    message_sta.append({"role": "assistant", "content": content})
+    logger.debug(f'模型输出内容：\n{content}')
+    return message_sta
 
 
 def main():
@@ -48,41 +35,29 @@ def main():
 
         ins_content = WomenShortStories.json_ins[idx_ins]["导语内容"]
         ins_ins = WomenShortStories.json_ins[idx_ins]["导语结构分析"]
-        model_ins = f"【原始导语】：\n{ins_content}\n【导语结构】：{ins_ins}\n{WomenShortStories.prompt_ins}"
+        intro_material = f"【原始导语】：\n{ins_content}\n【导语结构】：{ins_ins}"
 
         start_plot = WomenShortStories.json_plot[idx_plot]["开篇剧情概述"]
         paid_plot = WomenShortStories.json_plot[idx_plot]["付费点剧情概述"]
         end_plot = WomenShortStories.json_plot[idx_plot]["结尾剧情概述"]
         plot_all = f"{start_plot}\n{paid_plot}\n{end_plot}"
-        prompt_plot_all = f"【主线剧情】：\n{plot_all}\n{WomenShortStories.prompt_plot}"
-
-        message_sta = [
-            {"role": "system", "content": system_text},
-            {"role": "user", "content": f'{model_ins}'},
-        ]
-        message_sta_ins = cell_model(message_sta)
-        logger.info(f"----------1.0----------仿写导语--模型输出内容：\n{message_sta_ins[2]['content']}")
-
-        prompt_plot_all = f"【仿写导语】：\n{message_sta_ins}\n{prompt_plot_all}"
-        message_sta_ins.append({"role": "user", "content": f'{prompt_plot_all}'})
-        message_sta_plot = cell_model(message_sta_ins)
-        logger.info(f"----------2.0----------剧情大纲--模型输出内容：\n{message_sta_plot[4]['content']}")
-
-        ins_plot = f"【仿写导语】：\n{message_sta_plot[2]['content']}\n【剧情大纲】：\n{message_sta_plot[4]['content']}"
-        message_sta_plot.append({"role": "user", "content": f'{ins_plot}\n{WomenShortStories.prompt_text}'})
-        message_sta_text = cell_model(message_sta_plot)
-        logger.info(f"----------3.0----------第一次正文撰写--模型输出内容：\n{message_sta_text[6]['content']}")
-        text = message_sta_text[6]["content"]
-
-        message_sta_text.append({"role": "user", "content": '继续创作五到七章'})
-        message_sta_text_2 = cell_model(message_sta_text)
-        logger.info(f"----------4.0----------第二次正文撰写--模型输出内容：\n{message_sta_text_2[8]['content']}")
-
-        text += f"\n{message_sta_text_2[8]['content']}"
-        message_sta_text_2.append({"role": "user", "content": "继续创作八到十章"})
-        message_sta_text_3 = cell_model(message_sta_text_2)
-        logger.info(f"----------5.0----------第三次正文撰写--模型输出内容：\n{message_sta_text_3[10]['content']}")
-        text += f"\n{message_sta_text_3[10]['content']}"
+        plot_material = f"【主线剧情】：\n{plot_all}"
+
+        # 每一步只组装本步需要的内容，避免把整段消息列表插进新的用户消息
+        ctx = StoryContext(system_text, intro_material, WomenShortStories.prompt_ins,
+                           plot_material, WomenShortStories.prompt_plot, WomenShortStories.prompt_text)
+        step_names = ['仿写导语', '剧情大纲', '第一次正文撰写', '第二次正文撰写', '第三次正文撰写']
+        for step in range(1, 6):
+            if ctx.rolling_summary and step >= 4:
+                # 滚动摘要模式：续写前先用上一段正文更新摘要（与 model_test.ensure_summary 一致）
+                ctx.summary = cell_model(ctx.summary_messages(step - 4))[-1]['content']
+                logger.info(f"前 {step - 3} 段正文的状态摘要已更新（{len(ctx.summary)} 字）")
+            message_sta = ctx.messages_for(step)
+            report_budget(step, message_sta)
+            content = cell_model(message_sta, ctx.static_texts())[-1]['content']
+            ctx.record(step, content)
+            logger.info(f"----------{step}.0----------{step_names[step - 1]}--模型输出内容：\n{content}")
+        text = "\n".join(ctx.chapters)
 
         with open(f'test{i}', 'w', encoding='utf-8') as f:
             f.write(text)
@@ -2,18 +2,20 @@
 import sys
 import os
 import logging
-import random
 import time
+from concurrent.futures import CancelledError
 from pathlib import Path
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QPushButton, QTextEdit,
     QVBoxLayout, QWidget, QLabel, QLineEdit, QFileDialog,
-    QMessageBox, QGroupBox, QHBoxLayout, QScrollArea
+    QMessageBox, QGroupBox, QHBoxLayout, QScrollArea, QCheckBox
 )
 from PyQt5.QtCore import QThread, pyqtSignal, Qt
 from PyQt5.QtGui import QFont
 from config import config
-from openai import OpenAI
+from ui_buffer import ChunkBuffer, limit_scrollback
+import llm_client
+from response_cache import get_cache
 
 
 class LogHandler(logging.Handler):
@@ -31,49 +33,59 @@ class WorkerThread(QThread):
     log_signal = pyqtSignal(str)
     chunk_signal = pyqtSignal(str)
     response_signal = pyqtSignal(str)
+    reset_signal = pyqtSignal()  # 已显示的输出作废（中途中止后重试）
     finished_signal = pyqtSignal()
 
-    def __init__(self, api_key, base_url, model, messages):
+    def __init__(self, api_key, base_url, model, messages, use_cache=True, refresh_cache=False):
         super().__init__()
         self.api_key = api_key
         self.base_url = base_url
         self.model = model
         self.messages = messages
+        self.use_cache = use_cache  # 是否读写缓存
+        self.refresh_cache = refresh_cache  # 忽略已有缓存，重新生成并覆盖
+        self.future = None
+        self.cancelled = False
+
+    def cancel(self):
+        # 取消后台事件循环中正在进行的请求（停止按钮和关闭窗口时调用）
+        self.cancelled = True
+        if self.future is not None:
+            self.future.cancel()
 
     def run(self):
         try:
-            client = OpenAI(base_url=self.base_url, api_key=self.api_key)
-
-            def stream_chat_completion(messages, model=self.model, temperature=1.0):
-                full_content = ""
-                stream = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=temperature,
-                    stream=True
-                )
-                for chunk in stream:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        delta = chunk.choices[0].delta.content
-                        full_content += delta
-                        self.chunk_signal.emit(delta)
-                return full_content
+            cache = get_cache() if self.use_cache else None
+            if cache is not None and not self.refresh_cache:
+                cached = cache.get(self.model, 1.0, self.messages)
+                if cached is not None:
+                    self.log_signal.emit("⚡ 命中缓存，跳过模型调用")
+                    self.chunk_signal.emit(cached)
+                    self.response_signal.emit(cached)
+                    return
 
             def call_with_retry(messages, max_retries=5):
-                for retry in range(max_retries):
-                    try:
-                        return stream_chat_completion(messages)
-                    except Exception as e:
-                        wait_time = (2 ** retry) + random.uniform(0, 1)
-                        self.log_signal.emit(f"第 {retry + 1} 次调用失败，{wait_time:.2f} 秒后重试... 错误: {e}")
-                        time.sleep(wait_time)
-                raise Exception("模型调用失败，已达到最大重试次数")
+                # 请求在 llm_client 的后台事件循环中执行，这里只等待结果
+                self.future = llm_client.submit(llm_client.chat_with_retry(
+                    messages, max_retries=max_retries, model=self.model, api_key=self.api_key,
+                    base_url=self.base_url, on_delta=self.chunk_signal.emit, on_reset=self.reset_signal.emit,
+                    on_retry=lambda n, wait, e: self.log_signal.emit(
+                        f"第 {n} 次调用失败，{wait:.2f} 秒后重试... 错误: {e}")))
+                if self.cancelled:
+                    # 提交前已点击停止
+                    self.future.cancel()
+                full_content = self.future.result()
+                return full_content
 
             self.log_signal.emit("正在调用模型...")
             assistant_response = call_with_retry(self.messages)
+            if cache is not None:
+                cache.put(self.model, 1.0, self.messages, assistant_response)
             self.response_signal.emit(assistant_response)
             self.log_signal.emit("模型响应完成.")
 
+        except CancelledError:
+            self.log_signal.emit("⏹ 已停止")
         except Exception as e:
             self.log_signal.emit(f"❌ 程序异常: {str(e)}")
         finally:
@@ -97,6 +109,8 @@ class MainWindow(QMainWindow):
         self.assistant_outputs = [""] * 5
         self.current_step = -1
         self.system_prompt = ""
+        self.worker = None
+        self.stopped = False
 
         central_widget = QWidget()
         self.setCentralWidget(central_widget)
@@ -180,10 +194,19 @@ class MainWindow(QMainWindow):
         self.start_btn = QPushButton("▶️ 开始5轮对话")
         self.save_btn = QPushButton("💾 保存全部结果")
         self.save_btn.setEnabled(False)
+        self.stop_btn = QPushButton("⏹ 停止")
+        self.stop_btn.setEnabled(False)
         self.start_btn.clicked.connect(self.start_all_turns)
+        self.stop_btn.clicked.connect(self.stop_all_turns)
         self.save_btn.clicked.connect(self.save_all_results)
+        self.cache_checkbox = QCheckBox("使用缓存")
+        self.cache_checkbox.setChecked(True)
+        self.refresh_checkbox = QCheckBox("刷新缓存（强制重新生成）")
         button_layout.addWidget(self.start_btn)
+        button_layout.addWidget(self.stop_btn)
         button_layout.addWidget(self.save_btn)
+        button_layout.addWidget(self.cache_checkbox)
+        button_layout.addWidget(self.refresh_checkbox)
         button_layout.addStretch()
 
         # === 输出显示 ===
@@ -192,6 +215,7 @@ class MainWindow(QMainWindow):
         self.output_display = QTextEdit()
         self.output_display.setReadOnly(True)
         self.output_display.setFont(QFont("Consolas", 11))
+        self.chunk_buffer = ChunkBuffer(self.output_display, parent=self)
         output_layout.addWidget(self.output_display)
         output_group.setLayout(output_layout)
 
@@ -202,6 +226,7 @@ class MainWindow(QMainWindow):
         self.log_text.setReadOnly(True)
         self.log_text.setFont(QFont("Consolas", 10))
         self.log_text.setMaximumHeight(120)
+        limit_scrollback(self.log_text)
         log_layout.addWidget(self.log_text)
         log_group.setLayout(log_layout)
 
@@ -232,8 +257,7 @@ class MainWindow(QMainWindow):
         self.log_text.append(msg)
 
     def append_chunk_to_output(self, chunk):
-        self.output_display.insertPlainText(chunk)
-        self.output_display.moveCursor(self.output_display.textCursor().End)
+        self.chunk_buffer.append(chunk)
 
     def start_all_turns(self):
         self.system_prompt = self.system_prompt_input.toPlainText().strip()
@@ -252,10 +276,13 @@ class MainWindow(QMainWindow):
 
         self.assistant_outputs = [""] * 5
         self.current_step = -1
+        self.chunk_buffer.clear()
         self.output_display.clear()
         self.log_text.clear()
         self.start_btn.setEnabled(False)
         self.save_btn.setEnabled(False)
+        self.stop_btn.setEnabled(True)
+        self.stopped = False
 
         self.append_log("🚀 开始5轮对话流程...")
         self.run_next_step()
@@ -332,24 +359,41 @@ class MainWindow(QMainWindow):
             self.api_input.text().strip(),
             self.base_url,
             self.model,
-            messages
+            messages,
+            use_cache=self.cache_checkbox.isChecked(),
+            refresh_cache=self.refresh_checkbox.isChecked()
         )
         self.worker.log_signal.connect(self.append_log)
         self.worker.chunk_signal.connect(self.append_chunk_to_output)
+        self.worker.reset_signal.connect(self.chunk_buffer.reset)
         self.worker.response_signal.connect(lambda resp: self.on_step_response(step, resp))
         self.worker.finished_signal.connect(self.on_step_finished)
+        self.chunk_buffer.mark()
         self.worker.start()
 
     def on_step_response(self, step, response):
+        self.chunk_buffer.flush()
         self.assistant_outputs[step] = response
         self.output_display.append(f"\n=== 第 {step + 1} 轮模型输出 ===\n{response}\n")
 
     def on_step_finished(self):
+        if self.stopped:
+            self.start_btn.setEnabled(True)
+            self.save_btn.setEnabled(True)
+            return
         self.run_next_step()
 
+    def stop_all_turns(self):
+        # 取消当前轮次的请求，后续轮次不再执行
+        self.stopped = True
+        self.stop_btn.setEnabled(False)
+        if self.worker is not None:
+            self.worker.cancel()
+
     def on_all_finished(self):
         self.start_btn.setEnabled(True)
         self.save_btn.setEnabled(True)
+        self.stop_btn.setEnabled(False)
         self.append_log("✅ 5轮对话全部完成！")
 
     def save_all_results(self):
@@ -370,6 +414,14 @@ class MainWindow(QMainWindow):
             self.append_log(f"❌ 保存失败: {e}")
             QMessageBox.critical(self, "错误", f"保存失败: {e}")
 
+    def closeEvent(self, event):
+        # 关闭窗口时取消正在进行的请求，等线程退出后再关闭
+        if self.worker is not None and self.worker.isRunning():
+            self.stopped = True
+            self.worker.cancel()
+            self.worker.wait()
+        super().closeEvent(event)
+
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -1,16 +1,24 @@
+import argparse
+import asyncio
 import logging
-import openai
+import os
 import time
-import random
-from prompt_optimizer.atom_library import WomenShortStories
+import shutil
+from atom_library import WomenShortStories
 from log import logger
-from prompt_optimizer.config import config
-from openai import OpenAI
+from config import config
+import llm_client
+from response_cache import get_cache
+from checkpoint import save_checkpoint, load_checkpoint, clear_checkpoint
+from pair_selector import pick_pair
+from stream_checks import step_checks
+from dedup_check import check_output
+from session_log import SessionLog
+from context_builder import StoryContext, report_budget, parse_handoff, split_head
+from stream_writer import write_text, read_text
+import metrics
 from pathlib import Path
 
-# 初始化客户端
-client = OpenAI(base_url=config['url'], api_key=config['api-key-余额-50'])
-
 # 日志级别
 debug_mode = config['log_debug']
 logger.setLevel(logging.DEBUG if debug_mode else logging.INFO)
@@ -18,110 +26,259 @@ logger.setLevel(logging.DEBUG if debug_mode else logging.INFO)
 system_text = Path(config['prompt_path_sys']).read_text(encoding='utf-8')
 
 
-def stream_chat_completion(messages, model=config['model'], temperature=1.0):
+def echo_delta(delta):
+    # 可选：实时打印（调试用）
+    print(delta, end="", flush=True)
+
+
+def echo_reset():
+    # 已打印的半截输出作废（流被中止或质检未通过），接下来是重试的输出
+    print("\n[以上输出作废，重试中...]", flush=True)
+
+
+async def call_with_retry(messages, max_retries=5, echo=True, refresh=False, out_path=None, static_texts=(),
+                          session=None, step=None, label=None, checks=None, depends=None, on_reset=None):
+    """
+    带重试的流式调用（在 llm_client 的事件循环中执行），返回完整内容和更新后的消息列表
+    echo 为 False 时不实时打印（并发写作时避免多篇输出交错），为函数时每段 delta 交给它处理，
+    重试前已发出的内容作废时调用 on_reset()（echo 为 True 时打印提示行）
+    out_path 不为空时 delta 边收边写入该文件；static_texts 为固定提示词，支持时在其后加缓存断点
+    config['cache_enabled'] 打开时先查缓存，refresh=True 时忽略已有缓存重新生成
+    session 不为空时把本次请求和输出记入会话日志（step/label 为轮次和步骤名，depends 见 SessionLog.record）
+    checks 为流式质量检查器工厂（stream_checks.step_checks），不通过时中止并重试
+    """
+    # 缓存键和会话日志都基于发送时的 messages（不含本次回复）
+    request = list(messages)
+    cache = get_cache() if config['cache_enabled'] else None
+    if cache is not None and not refresh:
+        cached = cache.get(config['model'], 1.0, messages)
+        if cached is not None:
+            logger.info("命中缓存，跳过模型调用")
+            metrics.set_field('cache_hit', True)
+            metrics.set_output(cached)
+            if out_path:
+                write_text(out_path, cached)
+            if session is not None:
+                session.record(step, request, cached, label=label, depends=depends)
+            messages.append({"role": "assistant", "content": cached})
+            return messages, cached
+
+    content = await llm_client.chat_with_retry(messages, max_retries=max_retries, model=config['model'],
+                                               on_delta=(echo if callable(echo) else echo_delta) if echo else None,
+                                               on_reset=(on_reset if callable(echo) else echo_reset) if echo else None,
+                                               out_path=out_path, static_texts=static_texts, checks=checks)
+    if cache is not None:
+        cache.put(config['model'], 1.0, request, content)
+    if session is not None:
+        session.record(step, request, content, label=label, depends=depends)
+    messages.append({"role": "assistant", "content": content})
+    return messages, content
+
+
+STEP_NAMES = ['仿写导语', '剧情大纲', '第一次正文撰写', '第二次正文撰写', '第三次正文撰写']
+
+
+def story_dir(i):
+    return os.path.join(config['stream_dir'], f'story_{i+1}')
+
+
+def step_path(i, step):
     """
-    流式调用模型，返回完整内容和更新后的消息列表
+    第 i 篇第 step 步的流式输出文件
     """
-    full_content = ""
-    try:
-        stream = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            stream=True
-        )
-        for chunk in stream:
-            if chunk.choices and chunk.choices[0].delta.content:
-                delta = chunk.choices[0].delta.content
-                full_content += delta
-                # 可选：实时打印（调试用）
-                print(delta, end="", flush=True)
-        logger.debug(f"模型流式输出完成，总长度: {len(full_content)} 字符")
-        messages.append({"role": "assistant", "content": full_content})
-        return messages, full_content
-    except (openai.APIConnectionError, openai.APITimeoutError, openai.RateLimitError, openai.APIError) as e:
-        logger.error(f"OpenAI API 错误: {e}")
-        raise
-
-
-def call_with_retry(messages, max_retries=5):
+    return os.path.join(story_dir(i), f'step_{step}.txt')
+
+
+async def run_step(i, state, ctx, step, echo=True, session=None, on_reset=None):
     """
-    带指数退避重试的流式调用
+    执行第 step 步（1~5）并写入检查点；该步在检查点中已完成则直接返回已有输出
+    每步的请求由 ctx 按需组装，只包含本步需要的导语/大纲/已写正文
     """
-    for retry in range(max_retries):
-        try:
-            return stream_chat_completion(messages)
-        except Exception as e:
-            wait_time = (2 ** retry) + random.uniform(0, 1)
-            logger.warning(f"第 {retry + 1} 次调用失败，{wait_time:.2f} 秒后重试... 错误: {e}")
-            time.sleep(wait_time)
-    raise Exception("模型调用失败，已达到最大重试次数")
+    if state['step'] >= step:
+        logger.info(f"[第 {i+1} 篇] 第 {step} 步已在检查点中完成，跳过")
+        content = state['outputs'][step - 1]
+        if not os.path.exists(step_path(i, step)):
+            write_text(step_path(i, step), content)
+        ctx.record(step, content)
+        return content
 
+    depends = None
+    if ctx.rolling_summary and step >= 4:
+        await ensure_summary(i, state, ctx, step, session=session)
+        # 滚动摘要模式只带上一章结尾原文
+        depends = [(step - 1, config['metrics_steps'][step - 2], 'tail', config['summary_tail_chars'])]
+    messages = ctx.messages_for(step)
+    report_budget(step, messages, f"[第 {i+1} 篇] ")
+    with metrics.Span(config['metrics_steps'][step - 1], config['model'], story=i + 1):
+        messages, content = await call_with_retry(messages, echo=echo, out_path=step_path(i, step),
+                                                  static_texts=ctx.static_texts(), session=session, step=step,
+                                                  label=config['metrics_steps'][step - 1], checks=step_checks(step),
+                                                  depends=depends, on_reset=on_reset)
+    ctx.record(step, content)
 
-def main():
-    for i in range(5):
+    state['outputs'].append(content)
+    state['step'] = step
+    state['messages'] = messages
+    save_checkpoint(i + 1, state)
+    logger.info(f"[第 {i+1} 篇] ----------{step}.0---------- {STEP_NAMES[step - 1]}完成")
+    return content
+
+
+async def ensure_summary(i, state, ctx, step, session=None):
+    """
+    滚动摘要模式下，续写第 step 步（4/5）前确保摘要已覆盖之前各段正文；
+    每次只把上一版摘要和新的一段正文交给模型，摘要及其覆盖到的步骤写入检查点
+    """
+    covered = state.get('summary_step', 2)
+    ctx.summary = state.get('summary', "")
+    while covered < step - 1:
+        covered += 1
+        with metrics.Span('状态摘要', config['model'], story=i + 1):
+            _, summary = await call_with_retry(ctx.summary_messages(covered - 3), echo=False, session=session,
+                                               step=covered, label='状态摘要')
+        ctx.summary = summary
+        state['summary'], state['summary_step'] = summary, covered
+        save_checkpoint(i + 1, state)
+        logger.info(f"[第 {i+1} 篇] 前 {covered - 2} 段正文的状态摘要已更新（{len(summary)} 字）")
+
+
+async def write_chapters_parallel(i, state, ctx, session=None):
+    """
+    大纲完成后三段正文并行生成：先由大纲推出第 4、7 章结尾的衔接摘要，
+    三段同时写，最后改写第 2、3 段的开头使段与段之间衔接自然
+    衔接摘要、每段正文、每次衔接修整完成后都写入检查点（state['parallel']），resume 时只补未完成的部分
+    """
+    draft = state.setdefault('parallel', {'handoff': None, 'batches': {}, 'stitched': {}})
+    if draft['handoff'] is None:
+        with metrics.Span('衔接摘要', config['model'], story=i + 1):
+            _, draft['handoff'] = await call_with_retry(ctx.handoff_messages(), echo=False, session=session, step=3,
+                                                        label='衔接摘要')
+        save_checkpoint(i + 1, state)
+    handoff = parse_handoff(draft['handoff'])
+    handoffs = ["", handoff[4], handoff[7]]
+    logger.info(f"[第 {i+1} 篇] 衔接摘要完成，开始并行撰写三段正文")
+
+    async def write_batch(batch):
+        step = batch + 3
+        # 检查点里的键是字符串（JSON）
+        if str(batch) in draft['batches']:
+            logger.info(f"[第 {i+1} 篇] 第 {batch + 1} 段正文已在检查点中完成，跳过")
+            return draft['batches'][str(batch)]
+        with metrics.Span(config['metrics_steps'][step - 1], config['model'], story=i + 1, parallel=True):
+            _, content = await call_with_retry(ctx.batch_messages(batch, handoffs[batch]), echo=False,
+                                               out_path=step_path(i, step), static_texts=ctx.static_texts(),
+                                               session=session, step=step, label=config['metrics_steps'][step - 1],
+                                               checks=step_checks(step),
+                                               depends=[(3, '衔接摘要', 'handoff', (4, 7)[batch - 1])] if batch else None)
+        draft['batches'][str(batch)] = content
+        save_checkpoint(i + 1, state)
+        logger.info(f"[第 {i+1} 篇] 第 {batch + 1} 段正文完成")
+        return content
+
+    async def stitch(batch):
+        if str(batch) in draft['stitched']:
+            return draft['stitched'][str(batch)]
+        prev_tail = chapters[batch - 1][-config['stitch_chars']:]
+        head, rest = split_head(chapters[batch], config['stitch_chars'])
+        with metrics.Span('衔接修整', config['model'], story=i + 1):
+            _, revised = await call_with_retry(ctx.stitch_messages(prev_tail, head), echo=False, session=session,
+                                               step=batch + 3, label='衔接修整',
+                                               depends=[(batch + 2, config['metrics_steps'][batch + 1], 'last',
+                                                         config['stitch_chars']),
+                                                        (batch + 3, config['metrics_steps'][batch + 2], 'head',
+                                                         config['stitch_chars'])])
+        draft['stitched'][str(batch)] = revised.rstrip() + rest
+        save_checkpoint(i + 1, state)
+        return draft['stitched'][str(batch)]
+
+    chapters = list(await asyncio.gather(*(write_batch(batch) for batch in range(3))))
+    chapters[1:] = await asyncio.gather(stitch(1), stitch(2))
+    logger.info(f"[第 {i+1} 篇] 段落衔接修整完成")
+
+    for step, content in zip((3, 4, 5), chapters):
+        write_text(step_path(i, step), content)
+        ctx.record(step, content)
+        state['outputs'].append(content)
+    state['step'] = 5
+    del state['parallel']
+    save_checkpoint(i + 1, state)
+
+
+async def write_story(i, echo=True, resume=False, parallel=config['parallel_chapters'], pair=None, on_reset=None):
+    """
+    完成一篇故事：导语 → 大纲 → 正文×3，步骤之间严格按顺序执行
+    每步完成后写检查点，resume=True 时从最后完成的步骤继续
+    parallel=True 时大纲完成后三段正文并行生成
+    pair 为 (导语索引, 剧情索引)，为空时按 pair_selector 配对；检查点的配对与之不同时重新开始
+    echo 为函数时，某次输出中途作废重试前调用 on_reset()（见 call_with_retry）
+    返回保存路径
+    """
+    state = load_checkpoint(i + 1) if resume else None
+    if state is not None and pair is not None and (state['idx_ins'], state['idx_plot']) != tuple(pair):
+        logger.info(f"第 {i+1} 篇检查点的导语/剧情与任务不一致，重新开始")
+        state = None
+    if state is None:
         logger.info(f"开始第 {i+1} 次写作")
+        # 选择导语和剧情（默认按相似度配对）
+        idx_ins, idx_plot = pair if pair is not None else pick_pair()
+        state = {'idx_ins': idx_ins, 'idx_plot': idx_plot, 'step': 0, 'messages': [], 'outputs': []}
+    else:
+        idx_ins, idx_plot = state['idx_ins'], state['idx_plot']
+        logger.info(f"第 {i+1} 次写作从检查点恢复，已完成 {state['step']}/5 步")
+    logger.info(f"导语索引: {idx_ins}, 剧情索引: {idx_plot}")
+
+    # 构建导语提示
+    ins_content = WomenShortStories.json_ins[idx_ins]["导语内容"]
+    ins_ins = WomenShortStories.json_ins[idx_ins]["导语结构分析"]
+    intro_material = f"【原始导语】：\n{ins_content}\n【导语结构】：{ins_ins}"
 
-        # 随机选择导语和剧情
-        idx_ins = random.randint(0, len(WomenShortStories.json_ins) - 1)
-        idx_plot = random.randint(0, len(WomenShortStories.json_plot) - 1)
-        logger.info(f"导语索引: {idx_ins}, 剧情索引: {idx_plot}")
-
-        # 构建导语提示
-        ins_content = WomenShortStories.json_ins[idx_ins]["导语内容"]
-        ins_ins = WomenShortStories.json_ins[idx_ins]["导语结构分析"]
-        model_ins = f"【原始导语】：\n{ins_content}\n【导语结构】：{ins_ins}\n{WomenShortStories.prompt_ins}"
-
-        # 构建剧情提示
-        start_plot = WomenShortStories.json_plot[idx_plot]["开篇剧情概述"]
-        paid_plot = WomenShortStories.json_plot[idx_plot]["付费点剧情概述"]
-        end_plot = WomenShortStories.json_plot[idx_plot]["结尾剧情概述"]
-        plot_all = f"{start_plot}\n{paid_plot}\n{end_plot}"
-        prompt_plot_all = f"【主线剧情】：\n{plot_all}\n{WomenShortStories.prompt_plot}"
-
-        # Step 1: 仿写导语
-        messages = [
-            {"role": "system", "content": system_text},
-            {"role": "user", "content": model_ins}
-        ]
-        messages, rewritten_intro = call_with_retry(messages)
-        logger.info("----------1.0---------- 仿写导语完成")
-
-        # Step 2: 生成剧情大纲
-        messages.append({"role": "user", "content": f"【仿写导语】：\n{rewritten_intro}\n{prompt_plot_all}"})
-        messages, plot_outline = call_with_retry(messages)
-        logger.info("----------2.0---------- 剧情大纲完成")
-
-        # Step 3: 第一次正文（1-4章）
-        messages.append({
-            "role": "user",
-            "content": f"【仿写导语】：\n{rewritten_intro}\n【剧情大纲】：\n{plot_outline}\n{WomenShortStories.prompt_text}"
-        })
-        messages, text_part1 = call_with_retry(messages)
-        logger.info("----------3.0---------- 第一次正文撰写完成")
-
-        full_text = text_part1
-
-        # Step 4: 继续创作 5-7 章
-        messages.append({"role": "user", "content": "继续创作五到七章"})
-        messages, text_part2 = call_with_retry(messages)
-        full_text += "\n" + text_part2
-        logger.info("----------4.0---------- 第二次正文撰写完成")
-
-        # Step 5: 继续创作 8-10 章
-        messages.append({"role": "user", "content": "继续创作八到十章"})
-        messages, text_part3 = call_with_retry(messages)
-        full_text += "\n" + text_part3
-        logger.info("----------5.0---------- 第三次正文撰写完成")
-
-        res = rewritten_intro + "\n" + full_text
-
-        # 保存结果
-        output_path = f'test_{i+1}.txt'
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(res)
-        logger.info(f"第 {i+1} 次写作完成，已保存至 {output_path}")
+    # 构建剧情提示
+    start_plot = WomenShortStories.json_plot[idx_plot]["开篇剧情概述"]
+    paid_plot = WomenShortStories.json_plot[idx_plot]["付费点剧情概述"]
+    end_plot = WomenShortStories.json_plot[idx_plot]["结尾剧情概述"]
+    plot_all = f"{start_plot}\n{paid_plot}\n{end_plot}"
+    plot_material = f"【主线剧情】：\n{plot_all}"
 
+    # Step 1 仿写导语 → Step 2 剧情大纲 → Step 3 正文 1-4 章 → Step 4 5-7 章 → Step 5 8-10 章
+    ctx = StoryContext(system_text, intro_material, WomenShortStories.prompt_ins,
+                       plot_material, WomenShortStories.prompt_plot, WomenShortStories.prompt_text)
+    # 每篇一个会话日志，可用 replay.py 对其他模型/提示词重放；resume 时接着写检查点里记录的同一个文件
+    session = None
+    if config['session_log']:
+        session = SessionLog(f"story_{i+1}_{int(time.time())}", 'model_test', path=state.get('session'), append=True)
+        state['session'] = session.path
+    await run_step(i, state, ctx, 1, echo=echo, session=session, on_reset=on_reset)
+    await run_step(i, state, ctx, 2, echo=echo, session=session, on_reset=on_reset)
+    if parallel and state['step'] == 2:
+        await write_chapters_parallel(i, state, ctx, session=session)
+    else:
+        for step in (3, 4, 5):
+            await run_step(i, state, ctx, step, echo=echo, session=session, on_reset=on_reset)
+
+    # 保存结果：导语 + 三段正文，从各步骤的落盘文件拼接
+    output_path = f'test_{i+1}.txt'
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for n, step in enumerate((1, 3, 4, 5)):
+            if n:
+                f.write("\n")
+            f.write(read_text(step_path(i, step)))
+    clear_checkpoint(i + 1)
+    shutil.rmtree(story_dir(i), ignore_errors=True)
+    logger.info(f"第 {i+1} 次写作完成，已保存至 {output_path}")
+    if config['dedup_enabled']:
+        # 与参考故事和历史输出查重，并把本篇加入索引
+        await asyncio.to_thread(check_output, output_path)
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='五步写作流程')
+    parser.add_argument('--resume', action='store_true', help='从检查点继续未完成的故事')
+    parser.add_argument('--parallel', action='store_true', default=config['parallel_chapters'],
+                        help='大纲完成后三段正文并行生成')
+    args = parser.parse_args()
+    for i in range(5):
+        llm_client.run_sync(write_story(i, resume=args.resume, parallel=args.parallel))
         time.sleep(3)
 
 
@@ -3,16 +3,15 @@ import sys
 import os
 import logging
 import random
-import time
 from pathlib import Path
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QPushButton, QTextEdit,
-    QVBoxLayout, QWidget, QLabel, QLineEdit, QFileDialog, QMessageBox, QHBoxLayout
+    QVBoxLayout, QWidget, QLabel, QLineEdit, QMessageBox, QHBoxLayout
 )
 from PyQt5.QtCore import QThread, pyqtSignal, Qt
 from config import config
 from atom_library import WomenShortStories
-from openai import OpenAI
+from gen_client import GenerationClient, RunCancelled
 
 # 初始化日志捕获
 class LogHandler(logging.Handler):
@@ -35,11 +34,17 @@ class WorkerThread(QThread):
         self.base_url = base_url
         self.model = model
         self.user_prompt = user_prompt  # 接收用户输入的提示词
+        self.client = GenerationClient()
 
-    def run(self):
+    def cancel(self):
+        # 停止按钮调用：取消生成服务中正在进行的任务（只关窗口不会取消，任务在服务端继续）
         try:
-            client = OpenAI(base_url=self.base_url, api_key=self.api_key)
+            self.client.cancel()
+        except Exception as e:
+            self.log_signal.emit(f"❌ 停止失败: {str(e)}")
 
+    def run(self):
+        try:
             # 如果用户提供了提示词，就用用户的；否则用默认逻辑
             if self.user_prompt.strip():
                 messages = [
@@ -58,43 +63,23 @@ class WorkerThread(QThread):
                     {"role": "user", "content": model_ins}
                 ]
 
-            def stream_chat_completion(messages, model=self.model, temperature=1.0):
-                full_content = ""
-                stream = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=temperature,
-                    stream=True
-                )
-                for chunk in stream:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        delta = chunk.choices[0].delta.content
-                        full_content += delta
-                return full_content
-
-            def call_with_retry(messages, max_retries=5):
-                for retry in range(max_retries):
-                    try:
-                        return stream_chat_completion(messages)
-                    except Exception as e:
-                        wait_time = (2 ** retry) + random.uniform(0, 1)
-                        self.log_signal.emit(f"第 {retry + 1} 次调用失败，{wait_time:.2f} 秒后重试... 错误: {e}")
-                        time.sleep(wait_time)
-                raise Exception("模型调用失败，已达到最大重试次数")
+            def call_with_retry(messages, max_retries=5, save_path=None):
+                # 请求由生成服务（gen_server.py）执行，这里通过 SSE 接收重试信息
+                return self.client.chat(messages, model=self.model, api_key=self.api_key, base_url=self.base_url,
+                                        max_retries=max_retries, save_path=save_path, on_log=self.log_signal.emit,
+                                        on_saved=lambda path: self.log_signal.emit(f"已保存至 {path}"))
 
+            # 保存到文件（仅当使用默认逻辑时，由服务端保存）
+            output_path = None if self.user_prompt.strip() else os.path.join(self.output_dir, 'test_1.txt')
             self.log_signal.emit("正在调用模型生成内容...")
-            generated_text = call_with_retry(messages)
+            generated_text = call_with_retry(messages, save_path=output_path)
             self.log_signal.emit("✅ 模型生成完成")
 
-            # 保存到文件（仅当使用默认逻辑时）
-            if not self.user_prompt.strip():
-                output_path = os.path.join(self.output_dir, 'test_1.txt')
-                with open(output_path, 'w', encoding='utf-8') as f:
-                    f.write(generated_text)
-                self.log_signal.emit(f"已保存至 {output_path}")
-
             self.finished_signal.emit(generated_text)
 
+        except RunCancelled:
+            self.log_signal.emit("⏹ 已停止")
+            self.finished_signal.emit("")
         except Exception as e:
             self.log_signal.emit(f"❌ 程序异常: {str(e)}")
             self.finished_signal.emit("")
@@ -106,7 +91,8 @@ class MainWindow(QMainWindow):
         self.resize(1000, 700)
 
         # 默认值
-        self.output_dir = os.getcwd()
+        # 结果由生成服务落盘，这里只填服务端输出目录内的子目录，实际保存路径由服务端返回
+        self.output_dir = ''
         self.api_key = config.get('api-key-余额-100', '')
         self.base_url = config.get('url', '')
         self.model = config.get('model', '')
@@ -117,11 +103,10 @@ class MainWindow(QMainWindow):
 
         # === 输出目录 ===
         dir_layout = QHBoxLayout()
-        self.dir_label = QLabel(f"输出目录: {self.output_dir}")
-        self.dir_btn = QPushButton("选择输出文件夹")
-        self.dir_btn.clicked.connect(self.select_output_dir)
+        self.dir_label = QLabel(f"输出子目录（生成服务输出目录 {config['gen_server_output_dir']} 内，留空则直接保存在该目录）:")
+        self.dir_input = QLineEdit(self.output_dir)
         dir_layout.addWidget(self.dir_label)
-        dir_layout.addWidget(self.dir_btn)
+        dir_layout.addWidget(self.dir_input)
 
         # === API 配置 ===
         self.api_label = QLabel("API Key:")
@@ -142,6 +127,9 @@ class MainWindow(QMainWindow):
         # === 开始按钮 ===
         self.start_btn = QPushButton("开始生成")
         self.start_btn.clicked.connect(self.start_generation)
+        self.stop_btn = QPushButton("停止")
+        self.stop_btn.setEnabled(False)
+        self.stop_btn.clicked.connect(self.stop_generation)
 
         # === 日志区域 ===
         main_layout.addWidget(QLabel("运行日志:"))
@@ -154,6 +142,7 @@ class MainWindow(QMainWindow):
         main_layout.addWidget(self.api_label)
         main_layout.addWidget(self.api_input)
         main_layout.addWidget(self.start_btn)
+        main_layout.addWidget(self.stop_btn)
         main_layout.addWidget(self.prompt_input)
         main_layout.addWidget(self.output_display)
         main_layout.addWidget(self.log_text)
@@ -165,12 +154,6 @@ class MainWindow(QMainWindow):
         logging.getLogger().addHandler(self.log_handler)
         logging.getLogger().setLevel(logging.INFO)
 
-    def select_output_dir(self):
-        dir_path = QFileDialog.getExistingDirectory(self, "选择输出文件夹")
-        if dir_path:
-            self.output_dir = dir_path
-            self.dir_label.setText(f"输出目录: {self.output_dir}")
-
     def append_log(self, msg):
         self.log_text.append(msg)
 
@@ -189,7 +172,7 @@ class MainWindow(QMainWindow):
         user_prompt = self.prompt_input.toPlainText()
 
         self.worker = WorkerThread(
-            output_dir=self.output_dir,
+            output_dir=self.dir_input.text().strip(),
             api_key=api_key,
             base_url=self.base_url,
             model=self.model,
@@ -198,10 +181,16 @@ class MainWindow(QMainWindow):
         self.worker.log_signal.connect(self.append_log)
         self.worker.finished_signal.connect(self.on_finished)
         self.worker.start()
+        self.stop_btn.setEnabled(True)
+
+    def stop_generation(self):
+        self.stop_btn.setEnabled(False)
+        self.worker.cancel()
 
     def on_finished(self, generated_text):
         self.output_display.setPlainText(generated_text)
         self.start_btn.setEnabled(True)
+        self.stop_btn.setEnabled(False)
         self.append_log("✅ 生成任务已完成！")
 
 if __name__ == '__main__':
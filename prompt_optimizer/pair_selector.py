@@ -0,0 +1,80 @@
+import random
+import threading
+import time
+from log import logger
+from config import config
+from atom_library import WomenShortStories
+from minhash import SignatureStore
+
+# 导语与剧情的配对：按字符 n-gram MinHash 相似度为导语挑选题材相近的剧情，
+# 代替两边各自随机抽取（题材不搭时整篇十分钟的生成基本白费）
+
+
+def ins_text(record):
+    return f"{record['导语内容']}\n{record['导语结构分析']}"
+
+
+def plot_text(record):
+    return f"{record['开篇剧情概述']}\n{record['付费点剧情概述']}\n{record['结尾剧情概述']}"
+
+
+def library_signatures(library, text_of):
+    """
+    素材库对应的签名文件（与 JSON 同目录、后缀 .sig），源文件变化时重建
+    """
+    store = SignatureStore(library.path.with_suffix('.sig'))
+    mtime = library.path.stat().st_mtime_ns
+    if not store.load(mtime):
+        start = time.time()
+        store.build((text_of(library[i]) for i in range(len(library))), mtime)
+        logger.info(f"{library.path.name} 签名已重建：{len(store)} 条，耗时 {time.time() - start:.1f} 秒")
+    return store
+
+
+class PairSelector:
+    def __init__(self, ins_library=None, plot_library=None):
+        self.ins_library = ins_library or WomenShortStories.json_ins
+        self.plot_library = plot_library or WomenShortStories.json_plot
+        self.ins_sigs = library_signatures(self.ins_library, ins_text)
+        self.plot_sigs = library_signatures(self.plot_library, plot_text)
+
+    def top_plots(self, idx_ins, k=None):
+        """
+        与第 idx_ins 条导语最相近的 k 条剧情，返回 [(相似度, 剧情索引)]
+        """
+        return self.plot_sigs.top_k(self.ins_sigs.row(idx_ins), k or config['pair_top_k'])
+
+    def pick(self, idx_ins=None):
+        """
+        随机选导语，再从最相近的 top-k 剧情中随机选一条，返回 (导语索引, 剧情索引, 相似度)
+        """
+        if idx_ins is None:
+            idx_ins = random.randint(0, len(self.ins_sigs) - 1)
+        score, idx_plot = random.choice(self.top_plots(idx_ins))
+        return idx_ins, idx_plot, score
+
+
+_selector = None
+_selector_lock = threading.Lock()
+
+
+def get_pair_selector():
+    global _selector
+    if _selector is None:
+        with _selector_lock:
+            if _selector is None:
+                _selector = PairSelector()
+    return _selector
+
+
+def pick_pair():
+    """
+    按 config['pair_selection'] 选 (导语索引, 剧情索引)：'similar' 为相似度配对，其余为各自随机
+    """
+    if config['pair_selection'] == 'similar':
+        idx_ins, idx_plot, score = get_pair_selector().pick()
+        logger.info(f"相似度配对：导语 {idx_ins} ↔ 剧情 {idx_plot}（相似度 {score:.2f}）")
+        return idx_ins, idx_plot
+    idx_ins = random.randint(0, len(WomenShortStories.json_ins) - 1)
+    idx_plot = random.randint(0, len(WomenShortStories.json_plot) - 1)
+    return idx_ins, idx_plot
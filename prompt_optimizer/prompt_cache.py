@@ -0,0 +1,68 @@
+from log import logger
+from config import config
+
+
+def supports_cache_markers(model, base_url=None):
+    """
+    是否给请求加 cache_control 标记：'auto' 时仅对 Claude 系列、且接口在 config['cache_marker_urls'] 中时开启
+    （OpenAI/Gemini 为自动前缀缓存，无需标记；不认识该字段的转发接口可能直接拒绝分段格式的 content）
+    """
+    mode = config['cache_markers']
+    if mode == 'auto':
+        url = (base_url or config['url']).rstrip('/')
+        return 'claude' in model.lower() and url in (u.rstrip('/') for u in config['cache_marker_urls'])
+    return bool(mode)
+
+
+def _part(text, cache=False):
+    part = {"type": "text", "text": text}
+    if cache:
+        part["cache_control"] = {"type": "ephemeral"}
+    return part
+
+
+def apply_cache_markers(messages, model, static_texts=(), base_url=None):
+    """
+    返回带缓存断点的新消息列表（不修改原列表），最多 3 个断点：
+    system 提示词、以固定提示词开头的用户消息的固定部分、最后一条 assistant 消息
+    """
+    if not supports_cache_markers(model, base_url):
+        return messages
+    marked = [dict(m) for m in messages]
+    if marked and marked[0]['role'] == 'system':
+        marked[0]['content'] = [_part(marked[0]['content'], cache=True)]
+
+    for m in marked:
+        if m['role'] != 'user' or not isinstance(m['content'], str):
+            continue
+        prefix = next((s for s in static_texts if s and m['content'].startswith(s)), None)
+        if prefix is not None:
+            m['content'] = [_part(prefix, cache=True), _part(m['content'][len(prefix):])]
+            break
+
+    for m in reversed(marked):
+        if m['role'] == 'assistant':
+            m['content'] = [_part(m['content'], cache=True)]
+            break
+    return marked
+
+
+def cached_tokens(usage):
+    """
+    从 usage 中取缓存命中的输入 token 数（兼容 OpenAI 与 Anthropic 风格字段）
+    """
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, 'cache_read_input_tokens', None)
+    return cached or 0
+
+
+def log_usage(usage, label=""):
+    if usage is None:
+        logger.debug(f"{label}接口未返回 usage")
+        return
+    prompt = usage.prompt_tokens or 0
+    cached = cached_tokens(usage)
+    ratio = cached / prompt * 100 if prompt else 0
+    logger.info(f"{label}输入 {prompt} tokens（缓存命中 {cached}，{ratio:.0f}%），输出 {usage.completion_tokens} tokens")
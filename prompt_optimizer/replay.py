@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import copy
+import glob
+import os
+import time
+from log import logger
+from config import config
+import llm_client
+import metrics
+from context_builder import split_head, split_tail, parse_handoff
+from session_log import SessionLog, load_session
+
+# 会话重放：把 session_log 记录的请求原样（或按链式）发给任意模型/接口，多个会话可并发
+# 用法: python replay.py sessions/*.jsonl --model gemini-2.5-pro --mode chain -c 8 --label gemini
+# 结果按原会话写到 config['replay_dir']/<label>/，耗时和 token 记在指标文件里（python metrics.py summary --model ...）
+
+MODES = ('exact', 'chain')
+
+# 链式重放时，从前面某轮输出中取出被拼进本轮消息的片段（与 model_test 组装消息时的取法一致）
+PARTS = {
+    'head': lambda text, arg: split_head(text, arg)[0],
+    'tail': lambda text, arg: split_tail(text, arg)[1],
+    'last': lambda text, arg: text[-arg:],
+    'handoff': lambda text, arg: parse_handoff(text)[arg],
+}
+
+
+def substitute(messages, replacements):
+    """
+    链式重放：把消息中出现的原始输出替换成本次重放的输出（包括拼接进用户消息的导语、大纲等），按顺序替换
+    """
+    messages = copy.deepcopy(messages)
+    for m in messages:
+        if isinstance(m.get('content'), str):
+            for old, new in replacements:
+                if old:
+                    m['content'] = m['content'].replace(old, new)
+    return messages
+
+
+def depends_of(turn):
+    return [(d['step'], d['label'], d['part'], d['arg']) for d in turn.get('depends') or ()]
+
+
+async def replay_session(path, model=None, base_url=None, api_key=None, mode='exact', temperature=None,
+                         out_dir=None):
+    """
+    exact: 每轮都用记录中的原始输入，各轮相互独立、并发发出，适合在同一输入上对比模型/提示词；
+    chain: 按顺序执行，后面轮次中的原始输出替换为本次的输出，模拟完整流程；
+           轮次记录了 depends 时，只拼入了部分输出（上一段结尾、下一段开头等）的地方也按片段替换
+    返回新会话文件路径
+    """
+    meta, turns = load_session(path)
+    model = model or meta.get('model') or config['model']
+    out_dir = out_dir or os.path.join(config['replay_dir'], model)
+    source = f"replay:{meta.get('id')}:{mode}"
+    log = SessionLog(meta.get('id'), source, model, base_url, path=os.path.join(out_dir, os.path.basename(path)))
+
+    async def run_turn(turn, messages):
+        label = turn.get('label') or str(turn['step'])
+        with metrics.Span(label, model, story=meta.get('id'), replay=mode):
+            return await llm_client.chat_with_retry(
+                messages, model=model, base_url=base_url, api_key=api_key,
+                temperature=turn.get('temperature', 1.0) if temperature is None else temperature)
+
+    if mode == 'exact':
+        responses = await asyncio.gather(*(run_turn(t, t['messages']) for t in turns))
+        for turn, response in zip(turns, responses):
+            log.record(turn['step'], turn['messages'], response, label=turn.get('label'), model=model,
+                       temperature=turn.get('temperature', 1.0) if temperature is None else temperature,
+                       depends=depends_of(turn))
+    else:
+        replacements = []
+        # (step, label) -> (原始输出, 本次输出)，供 depends 取片段
+        outputs = {}
+        for turn in turns:
+            parts = []
+            for dep in turn.get('depends') or ():
+                if (dep['step'], dep['label']) in outputs:
+                    extract = PARTS[dep['part']]
+                    old, new = outputs[(dep['step'], dep['label'])]
+                    parts.append((extract(old, dep['arg']), extract(new, dep['arg'])))
+            # 先整段替换，再替换片段（片段是原始输出的一部分，整段已替换时不会再匹配）
+            messages = substitute(turn['messages'], replacements + parts)
+            response = await run_turn(turn, messages)
+            log.record(turn['step'], messages, response, label=turn.get('label'), model=model,
+                       temperature=turn.get('temperature', 1.0) if temperature is None else temperature,
+                       depends=depends_of(turn))
+            replacements.append((turn.get('response', ''), response))
+            outputs[(turn['step'], turn.get('label'))] = (turn.get('response', ''), response)
+    return log.path
+
+
+async def replay_many(paths, concurrency=4, **kwargs):
+    """
+    多个会话并发重放，返回 (成功路径列表, 失败路径列表)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    done, failed = [], []
+
+    async def run_one(path):
+        async with semaphore:
+            try:
+                done.append(await replay_session(path, **kwargs))
+                logger.info(f"重放完成 {path}（{len(done) + len(failed)}/{len(paths)}）")
+            except Exception as e:
+                failed.append(path)
+                logger.error(f"重放失败 {path}: {e}")
+
+    await asyncio.gather(*(run_one(p) for p in paths))
+    return done, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='按会话日志重放模型调用')
+    parser.add_argument('paths', nargs='+', help='会话日志（.jsonl，支持 glob）')
+    parser.add_argument('--model', help='重放使用的模型，默认沿用记录中的模型')
+    parser.add_argument('--url', help='接口地址，默认 config["url"]')
+    parser.add_argument('--key-name', help='使用 config 中的哪个 key（默认走 key 池）')
+    parser.add_argument('--mode', choices=MODES, default='exact')
+    parser.add_argument('--temperature', type=float, help='覆盖记录中的温度')
+    parser.add_argument('-c', '--concurrency', type=int, default=config['batch_concurrency'], help='同时重放的会话数')
+    parser.add_argument('--label', help='结果子目录名，默认为模型名')
+    args = parser.parse_args()
+
+    paths = sorted({p for pattern in args.paths for p in glob.glob(pattern)})
+    if not paths:
+        parser.error("没有找到会话日志")
+    model = args.model
+    out_dir = os.path.join(config['replay_dir'], args.label or model or config['model'])
+    api_key = config[args.key_name] if args.key_name else None
+    start = time.time()
+    done, failed = llm_client.run_sync(replay_many(
+        paths, max(1, args.concurrency), model=model, base_url=args.url, api_key=api_key, mode=args.mode,
+        temperature=args.temperature, out_dir=out_dir))
+    logger.info(f"重放结束：成功 {len(done)}，失败 {len(failed)}，耗时 {time.time() - start:.1f} 秒，结果在 {out_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+import time
+from config import config
+
+# 机器可读的会话日志（JSONL）：第一行为会话信息，之后每行一次模型调用的完整输入和输出
+# {"type": "session", "id": ..., "source": ..., "model": ..., "base_url": ..., "created": ...}
+# {"type": "turn", "step": 1, "label": "导语", "model": ..., "temperature": 1.0, "messages": [...], "response": "...", "ts": ...}
+# 消息中只拼入了前面某轮输出的一部分（结尾、开头等）时，turn 带 "depends": [{"step", "label", "part", "arg"}]，
+# 链式重放据此替换对应片段（见 replay.PARTS）
+# replay.py 读取这些文件，对任意模型/接口重放
+
+
+class SessionLog:
+    """
+    边运行边追加写入，进程中断时已完成的轮次不会丢
+    append=True 且 path 已存在时接着原文件写（断点续跑），不再写会话信息行
+    """
+
+    def __init__(self, session_id, source, model=None, base_url=None, directory=None, path=None, append=False):
+        directory = directory or config['session_dir']
+        self.path = path or os.path.join(directory, f"{session_id}.jsonl")
+        self._lock = threading.Lock()
+        if append and os.path.exists(self.path):
+            self.id = os.path.splitext(os.path.basename(self.path))[0]
+            return
+        self.id = session_id
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._write({
+            'type': 'session',
+            'id': session_id,
+            'source': source,
+            'model': model or config['model'],
+            'base_url': base_url or config['url'],
+            'created': time.time(),
+        }, mode='w')
+
+    def _write(self, record, mode='a'):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, mode, encoding='utf-8') as f:
+                f.write(line + '\n')
+
+    def record(self, step, messages, response, label=None, model=None, temperature=1.0, depends=None):
+        """
+        messages 为发送时的消息列表（不含本次回复）
+        depends 为 [(step, label, part, arg)]：messages 中拼入了哪一轮输出的哪一部分
+        """
+        record = {
+            'type': 'turn',
+            'step': step,
+            'label': label,
+            'model': model or config['model'],
+            'temperature': temperature,
+            'messages': messages,
+            'response': response,
+            'ts': time.time(),
+        }
+        if depends:
+            record['depends'] = [{'step': s, 'label': l, 'part': part, 'arg': arg} for s, l, part, arg in depends]
+        self._write(record)
+
+
+def write_session(path, session_id, source, turns, model=None, base_url=None):
+    """
+    一次性写出整个会话；turns 为 [{'step', 'messages', 'response', ...}]
+    """
+    log = SessionLog(session_id, source, model, base_url, path=path)
+    for turn in turns:
+        log.record(turn['step'], turn['messages'], turn.get('response', ''), label=turn.get('label'),
+                   model=turn.get('model', model), temperature=turn.get('temperature', 1.0))
+    return log.path
+
+
+def load_session(path):
+    """
+    返回 (会话信息, 轮次列表)
+    """
+    meta, turns = None, []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record.get('type') == 'session':
+                meta = record
+            else:
+                turns.append(record)
+    if meta is None:
+        meta = {'id': os.path.splitext(os.path.basename(path))[0]}
+    return meta, turns
@@ -0,0 +1,192 @@
+import re
+from config import config
+from context_builder import CHAPTER_BATCHES
+
+# 流式质量检查：边接收 delta 边检查已收到的内容，发现拒答、说明性开头、章节标题缺失、语言跑偏、
+# 重复循环时立即中止本次流式输出并抛出 QualityCheckFailed（由 llm_client.chat_with_retry 重试），
+# 不用等一万字全部生成完才发现不能用
+# 新增检查：继承 StreamCheck 实现 check()，用 @register('名称') 注册，再加到 config['quality_checks']
+
+_checks = {}
+
+_heading = re.compile(r'^#+\s*(?:第\s*)?(\d+)', re.M)
+_cjk = re.compile(r'[\u3400-\u9fff]')
+_latin = re.compile(r'[A-Za-z]')
+
+
+class QualityCheckFailed(Exception):
+    def __init__(self, check, reason, chars):
+        self.check = check
+        self.reason = reason
+        self.chars = chars
+        super().__init__(f"质量检查未通过（{check}，已收到 {chars} 字）：{reason}")
+
+
+def register(name):
+    def wrap(cls):
+        cls.name = name
+        _checks[name] = cls
+        return cls
+    return wrap
+
+
+class StreamCheck:
+    """
+    check(text, final) 检查目前收到的全部内容，不通过时返回原因，否则返回 None
+    final=True 表示输出已结束（可以检查"应该出现但没出现"的内容）
+    """
+    name = None
+
+    def __init__(self, step):
+        self.step = step
+
+    def check(self, text, final):
+        raise NotImplementedError
+
+
+class PhraseCheck(StreamCheck):
+    """
+    开头 quality_refusal_chars 字内出现 config[phrases_key] 中的短语即不通过（正文对白里出现不算，只看开头）
+    """
+    phrases_key = None
+    label = None
+
+    def check(self, text, final):
+        head = text[:config['quality_refusal_chars']]
+        for phrase in config[self.phrases_key]:
+            if phrase in head:
+                return f"开头出现{self.label}「{phrase}」"
+        return None
+
+
+@register('refusal')
+class RefusalCheck(PhraseCheck):
+    phrases_key = 'quality_refusal_phrases'
+    label = '拒答'
+
+
+@register('meta')
+class MetaCheck(PhraseCheck):
+    """
+    正文/导语开头的自我说明（"以下是……"、"好的，我来……"），说明模型没有按格式直接输出
+    """
+    phrases_key = 'quality_meta_phrases'
+    label = '说明性语句'
+
+
+@register('headings')
+class HeadingCheck(StreamCheck):
+    """
+    正文步骤（3~5）必须以本段第一章的 # N 标题开头，章节号在本段范围内，
+    两个标题之间不超过 quality_chapter_max_chars 字；结束时本段各章标题都要出现
+    """
+
+    def __init__(self, step):
+        super().__init__(step)
+        self.chapters = CHAPTER_BATCHES[step - 3] if 3 <= step <= 5 else None
+
+    def check(self, text, final):
+        if self.chapters is None:
+            return None
+        start, end = self.chapters
+        # 最后一行可能还没收完（# 1 之后可能还有 0），输出结束前只看已换行的标题
+        found = [(m.start(), int(m.group(1))) for m in _heading.finditer(text)
+                 if final or '\n' in text[m.end():]]
+        if not found:
+            if len(text) > config['quality_heading_chars'] or final:
+                return f"前 {config['quality_heading_chars']} 字内没有章节标题 # {start}"
+            return None
+        if found[0][1] != start or found[0][0] > config['quality_heading_chars']:
+            return f"第一个章节标题应为 # {start}，实际为 # {found[0][1]}（第 {found[0][0]} 字）"
+        numbers = [n for _, n in found]
+        if any(n < start or n > end for n in numbers):
+            return f"章节号超出本段范围 {start}~{end}: {numbers}"
+        positions = [p for p, _ in found] + [len(text)]
+        if max(b - a for a, b in zip(positions, positions[1:])) > config['quality_chapter_max_chars']:
+            return f"单章超过 {config['quality_chapter_max_chars']} 字没有下一个章节标题"
+        if final and sorted(set(numbers)) != list(range(start, end + 1)):
+            return f"缺少章节标题，应有 {start}~{end}，实际 {numbers}"
+        return None
+
+
+@register('language')
+class LanguageCheck(StreamCheck):
+    """
+    最近 quality_language_window 字中，汉字在汉字+拉丁字母中的占比低于 quality_cjk_min 视为语言跑偏
+    """
+
+    def check(self, text, final):
+        window = text[-config['quality_language_window']:]
+        cjk = len(_cjk.findall(window))
+        latin = len(_latin.findall(window))
+        if cjk + latin >= config['quality_language_window'] // 4 and cjk / (cjk + latin) < config['quality_cjk_min']:
+            return f"最近 {len(window)} 字中汉字占比 {cjk / (cjk + latin):.0%}"
+        return None
+
+
+@register('repetition')
+class RepetitionCheck(StreamCheck):
+    """
+    最后 quality_repeat_chars 字在最近 quality_repeat_window 字里出现不少于 quality_repeat_times 次，视为陷入重复循环
+    """
+
+    def check(self, text, final):
+        size = config['quality_repeat_chars']
+        tail = text[-size:]
+        if len(tail) < size or not tail.strip():
+            return None
+        times = text[-config['quality_repeat_window']:].count(tail)
+        if times >= config['quality_repeat_times']:
+            return f"最后 {size} 字在最近 {config['quality_repeat_window']} 字中重复出现 {times} 次"
+        return None
+
+
+class QualityGate:
+    """
+    一次流式调用的检查器：feed() 每收到一段 delta 调用，每累计 quality_check_every 字检查一次；
+    finish() 在输出结束时做最后一次检查
+    """
+
+    def __init__(self, checks):
+        self.checks = checks
+        # 逐段收集 delta，只在检查时拼接，避免每个 delta 都复制一遍已收到的全文
+        self._parts = []
+        self._length = 0
+        self._checked = 0
+
+    def feed(self, delta):
+        self._parts.append(delta)
+        self._length += len(delta)
+        if self._length - self._checked >= config['quality_check_every']:
+            self._run(False)
+
+    def finish(self):
+        self._run(True)
+
+    def _run(self, final):
+        text = ''.join(self._parts)
+        self._parts = [text]
+        self._checked = self._length
+        for check in self.checks:
+            reason = check.check(text, final)
+            if reason:
+                raise QualityCheckFailed(check.name, reason, self._length)
+
+
+def build_checks(names, step):
+    unknown = [name for name in names if name not in _checks]
+    if unknown:
+        raise ValueError(f"未知的质量检查: {unknown}（可用: {sorted(_checks)}）")
+    return [_checks[name](step) for name in names]
+
+
+def step_checks(step):
+    """
+    第 step 步（1~5）的检查器工厂，每次请求（包括重试）调用一次得到新的 QualityGate；
+    该步没有配置检查时返回 None
+    """
+    names = config['quality_checks'][step - 1] if config['quality_enabled'] else []
+    if not names:
+        return None
+    build_checks(names, step)
+    return lambda: QualityGate(build_checks(names, step))
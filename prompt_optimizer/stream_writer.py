@@ -0,0 +1,64 @@
+import os
+import time
+from config import config
+
+
+class StreamFile:
+    """
+    流式输出落盘：delta 先进缓冲区，攒够字符数或到时间间隔后写入文件（交给操作系统），
+    进程崩溃时最多丢失一个刷新周期的内容；fsync 只在关闭时和按 fsync_interval 间隔执行，
+    避免在共享事件循环上频繁阻塞；每次打开都会清空文件（重试时丢弃半截输出）
+    """
+
+    def __init__(self, path, flush_chars=config['stream_flush_chars'],
+                 flush_interval=config['stream_flush_interval'], fsync_interval=config['stream_fsync_interval']):
+        self.path = path
+        self.flush_chars = flush_chars
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = self._last_fsync = time.monotonic()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def write(self, delta):
+        self._buffer.append(delta)
+        self._buffered += len(delta)
+        if self._buffered >= self.flush_chars or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self, sync=False):
+        if self._buffer:
+            self._file.write(''.join(self._buffer))
+            self._buffer.clear()
+            self._buffered = 0
+        self._file.flush()
+        self._last_flush = time.monotonic()
+        if sync or self._last_flush - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = self._last_flush
+
+    def close(self):
+        if not self._file.closed:
+            self.flush(sync=True)
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def write_text(path, content):
+    """
+    一次性写入（缓存命中或从检查点恢复时补齐步骤文件）
+    """
+    with StreamFile(path) as f:
+        f.write(content)
+
+
+def read_text(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
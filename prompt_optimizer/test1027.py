@@ -2,7 +2,6 @@
 import sys
 import os
 import logging
-import random
 import time
 import json
 from pathlib import Path
@@ -14,7 +13,9 @@ from PyQt5.QtWidgets import (
 from PyQt5.QtCore import QThread, pyqtSignal, Qt
 from PyQt5.QtGui import QFont
 from config import config
-from openai import OpenAI
+from ui_buffer import ChunkBuffer, limit_scrollback
+from gen_client import GenerationClient, RunCancelled
+from session_log import write_session
 
 
 class LogHandler(logging.Handler):
@@ -31,50 +32,39 @@ class LogHandler(logging.Handler):
 class WorkerThread(QThread):
     log_signal = pyqtSignal(str)
     chunk_signal = pyqtSignal(str)
-    response_signal = pyqtSignal(str)
+    turn_signal = pyqtSignal(int, list)  # 每轮开始：轮次、实际发送的 messages
+    response_signal = pyqtSignal(int, str)  # 每轮结束：轮次、模型输出
+    reset_signal = pyqtSignal()  # 本轮已显示的输出作废（中途中止后重试）
     finished_signal = pyqtSignal()
 
-    def __init__(self, api_key, base_url, model, messages):
+    def __init__(self, api_key, base_url, model, turns):
         super().__init__()
         self.api_key = api_key
         self.base_url = base_url
         self.model = model
-        self.messages = messages
+        self.turns = turns
+        self.client = GenerationClient()
 
-    def run(self):
+    def cancel(self):
+        # 停止按钮调用：取消生成服务中正在进行的任务（只关窗口不会取消，任务在服务端继续）
         try:
-            client = OpenAI(base_url=self.base_url, api_key=self.api_key)
-
-            def stream_chat_completion(messages, model=self.model, temperature=1.0):
-                full_content = ""
-                stream = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=temperature,
-                    stream=True
-                )
-                for chunk in stream:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        delta = chunk.choices[0].delta.content
-                        full_content += delta
-                        self.chunk_signal.emit(delta)
-                return full_content
-
-            def call_with_retry(messages, max_retries=5):
-                for retry in range(max_retries):
-                    try:
-                        return stream_chat_completion(messages)
-                    except Exception as e:
-                        wait_time = (2 ** retry) + random.uniform(0, 1)
-                        self.log_signal.emit(f"第 {retry + 1} 次调用失败，{wait_time:.2f} 秒后重试... 错误: {e}")
-                        time.sleep(wait_time)
-                raise Exception("模型调用失败，已达到最大重试次数")
+            self.client.cancel()
+        except Exception as e:
+            self.log_signal.emit(f"❌ 停止失败: {str(e)}")
 
+    def run(self):
+        try:
+            # 5 轮对话整条链由生成服务（gen_server.py）执行，后面轮次对前面输出的拼接也在服务端完成，
+            # 这里通过 SSE 接收每轮的实际输入、输出片段和重试信息
             self.log_signal.emit("正在调用模型...")
-            assistant_response = call_with_retry(self.messages)
-            self.response_signal.emit(assistant_response)
+            self.client.turns(self.turns, model=self.model, api_key=self.api_key, base_url=self.base_url,
+                              on_delta=self.chunk_signal.emit, on_log=self.log_signal.emit,
+                              on_turn=self.turn_signal.emit, on_output=self.response_signal.emit,
+                              on_reset=self.reset_signal.emit)
             self.log_signal.emit("模型响应完成.")
 
+        except RunCancelled:
+            self.log_signal.emit("⏹ 已停止")
         except Exception as e:
             self.log_signal.emit(f"❌ 程序异常: {str(e)}")
         finally:
@@ -100,6 +90,8 @@ class MainWindow(QMainWindow):
         self.current_step = -1
         self.system_prompt = ""
         self.all_messages_log = []
+        self.worker = None
+        self.stopped = False  # 点击停止后不再进入下一轮
 
         central_widget = QWidget()
         self.setCentralWidget(central_widget)
@@ -185,10 +177,14 @@ class MainWindow(QMainWindow):
         self.save_log_btn = QPushButton("📄 保存输入日志")
         self.save_btn.setEnabled(False)
         self.save_log_btn.setEnabled(False)
+        self.stop_btn = QPushButton("⏹ 停止")
+        self.stop_btn.setEnabled(False)
         self.start_btn.clicked.connect(self.start_all_turns)
+        self.stop_btn.clicked.connect(self.stop_all_turns)
         self.save_btn.clicked.connect(self.save_all_results)
         self.save_log_btn.clicked.connect(self.save_input_log)
         button_layout.addWidget(self.start_btn)
+        button_layout.addWidget(self.stop_btn)
         button_layout.addWidget(self.save_btn)
         button_layout.addWidget(self.save_log_btn)
         button_layout.addStretch()
@@ -199,6 +195,7 @@ class MainWindow(QMainWindow):
         self.output_display = QTextEdit()
         self.output_display.setReadOnly(True)
         self.output_display.setFont(QFont("Consolas", 11))
+        self.chunk_buffer = ChunkBuffer(self.output_display, parent=self)
         output_layout.addWidget(self.output_display)
         output_group.setLayout(output_layout)
 
@@ -209,6 +206,7 @@ class MainWindow(QMainWindow):
         self.log_text.setReadOnly(True)
         self.log_text.setFont(QFont("Consolas", 9))
         self.log_text.setMaximumHeight(250)
+        limit_scrollback(self.log_text)
         log_layout.addWidget(self.log_text)
         log_group.setLayout(log_layout)
 
@@ -239,8 +237,7 @@ class MainWindow(QMainWindow):
         self.log_text.append(msg)
 
     def append_chunk_to_output(self, chunk):
-        self.output_display.insertPlainText(chunk)
-        self.output_display.moveCursor(self.output_display.textCursor().End)
+        self.chunk_buffer.append(chunk)
 
     def format_messages_for_log(self, messages, step):
         """格式化 messages 用于日志显示 - 完整显示"""
@@ -278,85 +275,69 @@ class MainWindow(QMainWindow):
         self.assistant_outputs = [""] * 5
         self.current_step = -1
         self.all_messages_log = []
+        self.chunk_buffer.clear()
         self.output_display.clear()
         self.log_text.clear()
         self.start_btn.setEnabled(False)
         self.save_btn.setEnabled(False)
         self.save_log_btn.setEnabled(False)
+        self.stop_btn.setEnabled(True)
+        self.stopped = False
 
         self.append_log("🚀 开始5轮对话流程...")
-        self.run_next_step()
-
-    def run_next_step(self):
-        self.current_step += 1
-        if self.current_step >= 5:
-            self.on_all_finished()
-            return
-
-        step = self.current_step
-        user_input = self.user_inputs[step]
-        self.append_log(f"\n{'=' * 80}")
-        self.append_log(f"▶️ 第 {step + 1} 轮开始")
-
-        # 构建 messages
-        messages = [{"role": "system", "content": self.system_prompt}]
-        actual_user_input = ""  # 实际发送的用户输入
+        self.worker = WorkerThread(
+            self.api_input.text().strip(),
+            self.base_url,
+            self.model,
+            self.build_turns()
+        )
+        self.worker.log_signal.connect(self.append_log)
+        self.worker.chunk_signal.connect(self.append_chunk_to_output)
+        self.worker.turn_signal.connect(self.on_step_started)
+        self.worker.response_signal.connect(self.on_step_response)
+        self.worker.reset_signal.connect(self.chunk_buffer.reset)
+        self.worker.finished_signal.connect(self.on_all_finished)
+        self.worker.start()
 
-        if step == 0:
+    def build_turns(self):
+        """
+        组装 5 轮的 messages；{'output': n} 表示第 n+1 轮的模型输出，由生成服务在该轮完成后填入
+        """
+        u = self.user_inputs
+        a = [{'output': n} for n in range(4)]
+        system = {"role": "system", "content": self.system_prompt}
+        turns = [
             # 第1轮: [system, U1]
-            actual_user_input = user_input
-            messages.append({"role": "user", "content": actual_user_input})
-
-        elif step == 1:
+            [system, {"role": "user", "content": u[0]}],
             # 第2轮: [system, U1, A1, A1+U2]
-            actual_user_input = f"【导语】:\n{self.assistant_outputs[0]}\n{user_input}"
-            messages.extend([
-                {"role": "user", "content": self.user_inputs[0]},
-                {"role": "assistant", "content": self.assistant_outputs[0]},
-                {"role": "user", "content": actual_user_input}
-            ])
-
-        elif step == 2:
+            [system, {"role": "user", "content": u[0]}, {"role": "assistant", "content": [a[0]]},
+             {"role": "user", "content": ["【导语】:\n", a[0], f"\n{u[1]}"]}],
             # 第3轮: [system, U1, A1, U2, A2, A1+A2+U3]
-            actual_user_input = f'【导语】：\n{self.assistant_outputs[0]}\n【剧情大纲】：\n{self.assistant_outputs[1]}\n{user_input}'
-            messages.extend([
-                {"role": "user", "content": self.user_inputs[0]},
-                {"role": "assistant", "content": self.assistant_outputs[0]},
-                {"role": "user", "content": self.user_inputs[1]},
-                {"role": "assistant", "content": self.assistant_outputs[1]},
-                {"role": "user", "content": actual_user_input}
-            ])
-
-        elif step == 3:
+            [system, {"role": "user", "content": u[0]}, {"role": "assistant", "content": [a[0]]},
+             {"role": "user", "content": u[1]}, {"role": "assistant", "content": [a[1]]},
+             {"role": "user", "content": ["【导语】：\n", a[0], "\n【剧情大纲】：\n", a[1], f"\n{u[2]}"]}],
             # 第4轮: [system, U1, A1, U2, A2, U3, A3, U4]
-            actual_user_input = user_input
-            messages.extend([
-                {"role": "user", "content": self.user_inputs[0]},
-                {"role": "assistant", "content": self.assistant_outputs[0]},
-                {"role": "user", "content": self.user_inputs[1]},
-                {"role": "assistant", "content": self.assistant_outputs[1]},
-                {"role": "user", "content": self.user_inputs[2]},
-                {"role": "assistant", "content": self.assistant_outputs[2]},
-                {"role": "user", "content": actual_user_input}
-            ])
-
-        elif step == 4:
+            [system, {"role": "user", "content": u[0]}, {"role": "assistant", "content": [a[0]]},
+             {"role": "user", "content": u[1]}, {"role": "assistant", "content": [a[1]]},
+             {"role": "user", "content": u[2]}, {"role": "assistant", "content": [a[2]]},
+             {"role": "user", "content": u[3]}],
             # 第5轮: [system, U1, A1, U2, A2, U3, A3, U4, A4, U5]
-            actual_user_input = user_input
-            messages.extend([
-                {"role": "user", "content": self.user_inputs[0]},
-                {"role": "assistant", "content": self.assistant_outputs[0]},
-                {"role": "user", "content": self.user_inputs[1]},
-                {"role": "assistant", "content": self.assistant_outputs[1]},
-                {"role": "user", "content": self.user_inputs[2]},
-                {"role": "assistant", "content": self.assistant_outputs[2]},
-                {"role": "user", "content": self.user_inputs[3]},
-                {"role": "assistant", "content": self.assistant_outputs[3]},
-                {"role": "user", "content": actual_user_input}
-            ])
-
-        # 保存实际输入
-        self.actual_inputs[step] = actual_user_input
+            [system, {"role": "user", "content": u[0]}, {"role": "assistant", "content": [a[0]]},
+             {"role": "user", "content": u[1]}, {"role": "assistant", "content": [a[1]]},
+             {"role": "user", "content": u[2]}, {"role": "assistant", "content": [a[2]]},
+             {"role": "user", "content": u[3]}, {"role": "assistant", "content": [a[3]]},
+             {"role": "user", "content": u[4]}],
+        ]
+        return [{'messages': messages} for messages in turns]
+
+    def on_step_started(self, step, messages):
+        self.current_step = step
+        self.chunk_buffer.mark()
+        self.append_log(f"\n{'=' * 80}")
+        self.append_log(f"▶️ 第 {step + 1} 轮开始")
+
+        # 保存实际输入（服务端拼接后的最后一条用户消息）
+        self.actual_inputs[step] = messages[-1]['content']
 
         # 保存到日志列表
         self.all_messages_log.append({
@@ -368,30 +349,27 @@ class MainWindow(QMainWindow):
         formatted_log = self.format_messages_for_log(messages, step)
         self.append_log(formatted_log)
 
-        # 启动线程
-        self.worker = WorkerThread(
-            self.api_input.text().strip(),
-            self.base_url,
-            self.model,
-            messages
-        )
-        self.worker.log_signal.connect(self.append_log)
-        self.worker.chunk_signal.connect(self.append_chunk_to_output)
-        self.worker.response_signal.connect(lambda resp: self.on_step_response(step, resp))
-        self.worker.finished_signal.connect(self.on_step_finished)
-        self.worker.start()
-
     def on_step_response(self, step, response):
+        self.chunk_buffer.flush()
         self.assistant_outputs[step] = response
+        self.all_messages_log[-1]['response'] = response
         self.output_display.append(f"\n=== 第 {step + 1} 轮模型输出 ===\n{response}\n")
 
-    def on_step_finished(self):
-        self.run_next_step()
+    def stop_all_turns(self):
+        # 取消服务端的多轮任务，后续轮次不再执行
+        self.stopped = True
+        self.stop_btn.setEnabled(False)
+        if self.worker is not None:
+            self.worker.cancel()
 
     def on_all_finished(self):
         self.start_btn.setEnabled(True)
         self.save_btn.setEnabled(True)
         self.save_log_btn.setEnabled(True)
+        self.stop_btn.setEnabled(False)
+        if self.stopped or not self.assistant_outputs[4]:
+            self.append_log("⚠️ 5轮对话未全部完成")
+            return
         self.append_log("\n" + "=" * 80)
         self.append_log("✅ 5轮对话全部完成！")
         self.append_log("=" * 80)
@@ -420,11 +398,15 @@ class MainWindow(QMainWindow):
                 content += f"{'-' * 100}\n\n"
 
         try:
-            path = os.path.join(self.output_dir, f'input_log_{int(time.time())}.txt')
+            ts = int(time.time())
+            path = os.path.join(self.output_dir, f'input_log_{ts}.txt')
             with open(path, 'w', encoding='utf-8') as f:
                 f.write(content)
-            self.append_log(f"✅ 输入日志已保存至: {path}")
-            QMessageBox.information(self, "成功", f"输入日志已保存至:\n{path}")
+            # 同时保存机器可读版本，可用 replay.py 对其他模型重放
+            json_path = write_session(os.path.join(self.output_dir, f'input_log_{ts}.jsonl'), f'input_log_{ts}',
+                                      'test1027', self.all_messages_log, self.model, self.base_url)
+            self.append_log(f"✅ 输入日志已保存至: {path}\n   会话日志: {json_path}")
+            QMessageBox.information(self, "成功", f"输入日志已保存至:\n{path}\n{json_path}")
         except Exception as e:
             self.append_log(f"❌ 保存失败: {e}")
             QMessageBox.critical(self, "错误", f"保存失败: {e}")
@@ -2,8 +2,8 @@
 import sys
 import os
 import logging
-import random
 import time
+from concurrent.futures import CancelledError
 from pathlib import Path
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QPushButton, QTextEdit,
@@ -13,7 +13,8 @@ from PyQt5.QtWidgets import (
 from PyQt5.QtCore import QThread, pyqtSignal, Qt
 from PyQt5.QtGui import QFont
 from config import config
-from openai import OpenAI
+from ui_buffer import ChunkBuffer, limit_scrollback
+import llm_client
 
 
 class LogHandler(logging.Handler):
@@ -30,6 +31,7 @@ class WorkerThread(QThread):
     log_signal = pyqtSignal(str)
     chunk_signal = pyqtSignal(str)
     response_signal = pyqtSignal(str)
+    reset_signal = pyqtSignal()  # 已显示的输出作废（中途中止后重试）
     finished_signal = pyqtSignal()
 
     def __init__(self, api_key, base_url, model, messages):
@@ -38,41 +40,37 @@ class WorkerThread(QThread):
         self.base_url = base_url
         self.model = model
         self.messages = messages
+        self.future = None
+        self.cancelled = False
+
+    def cancel(self):
+        # 取消后台事件循环中正在进行的请求（停止按钮和关闭窗口时调用）
+        self.cancelled = True
+        if self.future is not None:
+            self.future.cancel()
 
     def run(self):
         try:
-            client = OpenAI(base_url=self.base_url, api_key=self.api_key)
-
-            def stream_chat_completion(messages, model=self.model, temperature=1.0):
-                full_content = ""
-                stream = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=temperature,
-                    stream=True
-                )
-                for chunk in stream:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        delta = chunk.choices[0].delta.content
-                        full_content += delta
-                        self.chunk_signal.emit(delta)  # 直接调用
-                return full_content
-
             def call_with_retry(messages, max_retries=5):
-                for retry in range(max_retries):
-                    try:
-                        return stream_chat_completion(messages)
-                    except Exception as e:
-                        wait_time = (2 ** retry) + random.uniform(0, 1)
-                        self.log_signal.emit(f"第 {retry + 1} 次调用失败，{wait_time:.2f} 秒后重试... 错误: {e}")
-                        time.sleep(wait_time)
-                raise Exception("模型调用失败，已达到最大重试次数")
+                # 请求在 llm_client 的后台事件循环中执行，这里只等待结果
+                self.future = llm_client.submit(llm_client.chat_with_retry(
+                    messages, max_retries=max_retries, model=self.model, api_key=self.api_key,
+                    base_url=self.base_url, on_delta=self.chunk_signal.emit, on_reset=self.reset_signal.emit,
+                    on_retry=lambda n, wait, e: self.log_signal.emit(
+                        f"第 {n} 次调用失败，{wait:.2f} 秒后重试... 错误: {e}")))
+                if self.cancelled:
+                    # 提交前已点击停止
+                    self.future.cancel()
+                full_content = self.future.result()
+                return full_content
 
             self.log_signal.emit("正在调用模型...")
             assistant_response = call_with_retry(self.messages)
             self.response_signal.emit(assistant_response)
             self.log_signal.emit("模型响应完成.")
 
+        except CancelledError:
+            self.log_signal.emit("⏹ 已停止")
         except Exception as e:
             self.log_signal.emit(f"❌ 程序异常: {str(e)}")
         finally:
@@ -95,6 +93,8 @@ class MainWindow(QMainWindow):
         self.assistant_outputs = [""] * 5  # A1~A5
         self.current_step = -1  # -1: 未开始; 0~4: 当前轮次
         self.system_prompt = ""
+        self.worker = None
+        self.stopped = False  # 点击停止后不再进入下一轮
 
         central_widget = QWidget()
         self.setCentralWidget(central_widget)
@@ -178,9 +178,13 @@ class MainWindow(QMainWindow):
         self.start_btn = QPushButton("▶️ 开始5轮对话")
         self.save_btn = QPushButton("💾 保存全部结果")
         self.save_btn.setEnabled(False)
+        self.stop_btn = QPushButton("⏹ 停止")
+        self.stop_btn.setEnabled(False)
         self.start_btn.clicked.connect(self.start_all_turns)
+        self.stop_btn.clicked.connect(self.stop_all_turns)
         self.save_btn.clicked.connect(self.save_all_results)
         button_layout.addWidget(self.start_btn)
+        button_layout.addWidget(self.stop_btn)
         button_layout.addWidget(self.save_btn)
         button_layout.addStretch()
 
@@ -190,6 +194,7 @@ class MainWindow(QMainWindow):
         self.output_display = QTextEdit()
         self.output_display.setReadOnly(True)
         self.output_display.setFont(QFont("Consolas", 11))
+        self.chunk_buffer = ChunkBuffer(self.output_display, parent=self)
         output_layout.addWidget(self.output_display)
         output_group.setLayout(output_layout)
 
@@ -200,6 +205,7 @@ class MainWindow(QMainWindow):
         self.log_text.setReadOnly(True)
         self.log_text.setFont(QFont("Consolas", 10))
         self.log_text.setMaximumHeight(120)
+        limit_scrollback(self.log_text)
         log_layout.addWidget(self.log_text)
         log_group.setLayout(log_layout)
 
@@ -228,8 +234,7 @@ class MainWindow(QMainWindow):
         self.log_text.append(msg)
 
     def append_chunk_to_output(self, chunk):
-        self.output_display.insertPlainText(chunk)
-        self.output_display.moveCursor(self.output_display.textCursor().End)
+        self.chunk_buffer.append(chunk)
 
     def start_all_turns(self):
         # 读取输入
@@ -250,10 +255,13 @@ class MainWindow(QMainWindow):
         # 重置状态
         self.assistant_outputs = [""] * 5
         self.current_step = -1
+        self.chunk_buffer.clear()
         self.output_display.clear()
         self.log_text.clear()
         self.start_btn.setEnabled(False)
         self.save_btn.setEnabled(False)
+        self.stop_btn.setEnabled(True)
+        self.stopped = False
 
         self.append_log("🚀 开始5轮对话流程...")
         self.run_next_step()
@@ -306,22 +314,37 @@ class MainWindow(QMainWindow):
         )
         self.worker.log_signal.connect(self.append_log)
         self.worker.chunk_signal.connect(self.append_chunk_to_output)
+        self.worker.reset_signal.connect(self.chunk_buffer.reset)
         self.worker.response_signal.connect(lambda resp: self.on_step_response(step, resp))
         self.worker.finished_signal.connect(self.on_step_finished)
+        self.chunk_buffer.mark()
         self.worker.start()
 
     def on_step_response(self, step, response):
+        self.chunk_buffer.flush()
         self.assistant_outputs[step] = response
         # 显示当前轮次输出
         self.output_display.append(f"\n=== 第 {step + 1} 轮模型输出 ===\n{response}\n")
 
     def on_step_finished(self):
+        if self.stopped:
+            self.start_btn.setEnabled(True)
+            self.save_btn.setEnabled(True)
+            return
         # 自动进入下一轮
         self.run_next_step()
 
+    def stop_all_turns(self):
+        # 取消当前轮次的请求，后续轮次不再执行
+        self.stopped = True
+        self.stop_btn.setEnabled(False)
+        if self.worker is not None:
+            self.worker.cancel()
+
     def on_all_finished(self):
         self.start_btn.setEnabled(True)
         self.save_btn.setEnabled(True)
+        self.stop_btn.setEnabled(False)
         self.append_log("✅ 5轮对话全部完成！")
 
     def save_all_results(self):
@@ -342,6 +365,14 @@ class MainWindow(QMainWindow):
             self.append_log(f"❌ 保存失败: {e}")
             QMessageBox.critical(self, "错误", f"保存失败: {e}")
 
+    def closeEvent(self, event):
+        # 关闭窗口时取消正在进行的请求，等线程退出后再关闭
+        if self.worker is not None and self.worker.isRunning():
+            self.stopped = True
+            self.worker.cancel()
+            self.worker.wait()
+        super().closeEvent(event)
+
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
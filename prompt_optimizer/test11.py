@@ -3,16 +3,15 @@ import sys
 import os
 import logging
 import random
-import time
 from pathlib import Path
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QPushButton, QTextEdit,
-    QVBoxLayout, QWidget, QLabel, QLineEdit, QFileDialog, QMessageBox
+    QVBoxLayout, QWidget, QLabel, QLineEdit, QMessageBox
 )
 from PyQt5.QtCore import QThread, pyqtSignal, Qt
 from config import config
 from atom_library import WomenShortStories
-from openai import OpenAI
+from gen_client import GenerationClient, RunCancelled
 
 # 初始化日志捕获
 class LogHandler(logging.Handler):
@@ -35,11 +34,17 @@ class WorkerThread(QThread):
         self.base_url = base_url
         self.model = model
         self.custom_system_prompt = custom_system_prompt
+        self.client = GenerationClient()
 
-    def run(self):
+    def cancel(self):
+        # 停止按钮调用：取消生成服务中正在进行的任务（只关窗口不会取消，任务在服务端继续）
         try:
-            client = OpenAI(base_url=self.base_url, api_key=self.api_key)
+            self.client.cancel()
+        except Exception as e:
+            self.log_signal.emit(f"❌ 停止失败: {str(e)}")
 
+    def run(self):
+        try:
             # 使用用户输入的提示词，否则从文件读取
             if self.custom_system_prompt.strip():
                 system_text = self.custom_system_prompt
@@ -49,31 +54,7 @@ class WorkerThread(QThread):
                 system_text = Path(prompt_path).read_text(encoding='utf-8')
                 self.log_signal.emit(f"📄 使用默认系统提示词: {prompt_path}")
 
-            def stream_chat_completion(messages, model=self.model, temperature=1.0):
-                full_content = ""
-                stream = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=temperature,
-                    stream=True
-                )
-                for chunk in stream:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        delta = chunk.choices[0].delta.content
-                        full_content += delta
-                messages.append({"role": "assistant", "content": full_content})
-                return messages, full_content
-
-            def call_with_retry(messages, max_retries=5):
-                for retry in range(max_retries):
-                    try:
-                        return stream_chat_completion(messages)
-                    except Exception as e:
-                        wait_time = (2 ** retry) + random.uniform(0, 1)
-                        self.log_signal.emit(f"第 {retry + 1} 次调用失败，{wait_time:.2f} 秒后重试... 错误: {e}")
-                        time.sleep(wait_time)
-                raise Exception("模型调用失败，已达到最大重试次数")
-
+            turns = []
             for i in range(1):
                 self.log_signal.emit(f"开始第 {i+1} 次写作")
                 idx_ins = random.randint(0, len(WomenShortStories.json_ins) - 1)
@@ -88,16 +69,19 @@ class WorkerThread(QThread):
                     {"role": "system", "content": system_text},
                     {"role": "user", "content": model_ins}
                 ]
-                messages, rewritten_intro = call_with_retry(messages)
-                self.log_signal.emit("----------1.0---------- 仿写导语完成")
+                turns.append({'messages': messages, 'save_path': os.path.join(self.output_dir, f'test_{i+1}.txt')})
 
-                output_path = os.path.join(self.output_dir, f'test_{i+1}.txt')
-                with open(output_path, 'w', encoding='utf-8') as f:
-                    f.write(rewritten_intro)
-                self.log_signal.emit(f"第 {i+1} 次写作完成，已保存至 {output_path}")
+            def on_saved(i, path):
+                self.log_signal.emit("----------1.0---------- 仿写导语完成")
+                self.log_signal.emit(f"第 {i+1} 次写作完成，已保存至 {path}")
 
-                time.sleep(3)
+            # 全部写作作为一个多轮任务交给生成服务（gen_server.py）依次执行并落盘，界面关闭后也会跑完；
+            # 原来两次写作之间的 sleep 由服务端的并发窗口代替
+            self.client.turns(turns, model=self.model, api_key=self.api_key, base_url=self.base_url,
+                              on_log=self.log_signal.emit, on_saved=on_saved)
 
+        except RunCancelled:
+            self.log_signal.emit("⏹ 已停止")
         except Exception as e:
             self.log_signal.emit(f"❌ 程序异常: {str(e)}")
         finally:
@@ -110,7 +94,8 @@ class MainWindow(QMainWindow):
         self.resize(900, 700)  # 稍微加大窗口
 
         # 默认值
-        self.output_dir = os.getcwd()
+        # 结果由生成服务落盘，这里只填服务端输出目录内的子目录，实际保存路径由服务端返回
+        self.output_dir = ''
         self.api_key = config.get('api-key-余额-100', '')
         self.base_url = config.get('url', 'https://api.openai.com/v1')
         self.model = config.get('model', 'gpt-3.5-turbo')
@@ -120,9 +105,8 @@ class MainWindow(QMainWindow):
         layout = QVBoxLayout()
 
         # 输出目录
-        self.dir_label = QLabel(f"输出目录: {self.output_dir}")
-        self.dir_btn = QPushButton("选择输出文件夹")
-        self.dir_btn.clicked.connect(self.select_output_dir)
+        self.dir_label = QLabel(f"输出子目录（生成服务输出目录 {config['gen_server_output_dir']} 内，留空则直接保存在该目录）:")
+        self.dir_input = QLineEdit(self.output_dir)
 
         # API 配置
         self.api_label = QLabel("API Key:")
@@ -146,6 +130,9 @@ class MainWindow(QMainWindow):
         # 开始按钮
         self.start_btn = QPushButton("开始生成故事（1次）")
         self.start_btn.clicked.connect(self.start_generation)
+        self.stop_btn = QPushButton("停止")
+        self.stop_btn.setEnabled(False)
+        self.stop_btn.clicked.connect(self.stop_generation)
 
         # 日志显示
         self.log_text = QTextEdit()
@@ -153,7 +140,7 @@ class MainWindow(QMainWindow):
 
         # 布局
         layout.addWidget(self.dir_label)
-        layout.addWidget(self.dir_btn)
+        layout.addWidget(self.dir_input)
         layout.addWidget(self.api_label)
         layout.addWidget(self.api_input)
         layout.addWidget(self.url_label)
@@ -163,6 +150,7 @@ class MainWindow(QMainWindow):
         layout.addWidget(self.prompt_label)
         layout.addWidget(self.prompt_input)  # 新增提示词输入框
         layout.addWidget(self.start_btn)
+        layout.addWidget(self.stop_btn)
         layout.addWidget(QLabel("运行日志:"))
         layout.addWidget(self.log_text)
 
@@ -173,12 +161,6 @@ class MainWindow(QMainWindow):
         logging.getLogger().addHandler(self.log_handler)
         logging.getLogger().setLevel(logging.INFO)
 
-    def select_output_dir(self):
-        dir_path = QFileDialog.getExistingDirectory(self, "选择输出文件夹")
-        if dir_path:
-            self.output_dir = dir_path
-            self.dir_label.setText(f"输出目录: {self.output_dir}")
-
     def append_log(self, msg):
         self.log_text.append(msg)
 
@@ -197,13 +179,19 @@ class MainWindow(QMainWindow):
             self.start_btn.setEnabled(True)
             return
 
-        self.worker = WorkerThread(self.output_dir, api_key, base_url, model, custom_prompt)
+        self.worker = WorkerThread(self.dir_input.text().strip(), api_key, base_url, model, custom_prompt)
         self.worker.log_signal.connect(self.append_log)
         self.worker.finished_signal.connect(self.on_finished)
         self.worker.start()
+        self.stop_btn.setEnabled(True)
+
+    def stop_generation(self):
+        self.stop_btn.setEnabled(False)
+        self.worker.cancel()
 
     def on_finished(self):
         self.start_btn.setEnabled(True)
+        self.stop_btn.setEnabled(False)
         self.append_log("✅ 所有任务已完成！")
 
 if __name__ == '__main__':
@@ -7,11 +7,11 @@ import time
 from pathlib import Path
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QPushButton, QTextEdit,
-    QVBoxLayout, QWidget, QLabel, QFileDialog, QMessageBox
+    QVBoxLayout, QWidget, QLabel, QLineEdit, QMessageBox
 )
 from PyQt5.QtCore import QThread, pyqtSignal
 from config import config
-from openai import OpenAI
+from gen_client import GenerationClient, RunCancelled
 
 # 日志处理器
 class LogHandler(logging.Handler):
@@ -32,6 +32,14 @@ class WorkerThread(QThread):
         self.output_dir = output_dir
         self.intro_structure = intro_structure
         self.instruction_prompt = instruction_prompt
+        self.client = GenerationClient()
+
+    def cancel(self):
+        # 停止按钮调用：取消生成服务中正在进行的任务（只关窗口不会取消，任务在服务端继续）
+        try:
+            self.client.cancel()
+        except Exception as e:
+            self.log_signal.emit(f"❌ 停止失败: {str(e)}")
 
     def run(self):
         try:
@@ -44,8 +52,6 @@ class WorkerThread(QThread):
                 self.log_signal.emit("❌ 配置文件中缺少 API Key，请检查 config.py")
                 return
 
-            client = OpenAI(base_url=base_url, api_key=api_key)
-
             # 读取系统提示词（可保留，或也可让用户输入，但按你要求只改导语部分）
             system_prompt_path = config.get('prompt_path_sys')
             if system_prompt_path and Path(system_prompt_path).exists():
@@ -64,27 +70,17 @@ class WorkerThread(QThread):
 
             self.log_signal.emit("🚀 开始调用模型生成仿写导语...")
 
-            # 调用模型（带重试）
-            full_content = ""
-            stream = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=1.0,
-                stream=True
-            )
-            for chunk in stream:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    delta = chunk.choices[0].delta.content
-                    full_content += delta
-
-            # 保存结果
+            # 调用模型（带重试），请求由生成服务（gen_server.py）执行，结果由服务端保存
             output_path = os.path.join(self.output_dir, 'rewritten_intro.txt')
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(full_content)
+            saved = []
+            self.client.chat(messages, model=model, api_key=api_key, base_url=base_url, save_path=output_path,
+                             on_log=self.log_signal.emit, on_saved=saved.append)
 
             self.log_signal.emit("----------1.0---------- 仿写导语完成")
-            self.log_signal.emit(f"✅ 结果已保存至: {output_path}")
+            self.log_signal.emit(f"✅ 结果已保存至: {saved[0]}")
 
+        except RunCancelled:
+            self.log_signal.emit("⏹ 已停止")
         except Exception as e:
             self.log_signal.emit(f"❌ 程序异常: {str(e)}")
         finally:
@@ -96,16 +92,16 @@ class MainWindow(QMainWindow):
         self.setWindowTitle("仅供内部测试使用")
         self.resize(900, 800)
 
-        self.output_dir = os.getcwd()
+        # 结果由生成服务落盘，这里只填服务端输出目录内的子目录，实际保存路径由服务端返回
+        self.output_dir = ''
 
         central_widget = QWidget()
         self.setCentralWidget(central_widget)
         layout = QVBoxLayout()
 
         # 输出目录
-        self.dir_label = QLabel(f"输出目录: {self.output_dir}")
-        self.dir_btn = QPushButton("选择输出文件夹")
-        self.dir_btn.clicked.connect(self.select_output_dir)
+        self.dir_label = QLabel(f"输出子目录（生成服务输出目录 {config['gen_server_output_dir']} 内，留空则直接保存在该目录）:")
+        self.dir_input = QLineEdit(self.output_dir)
 
         # 用户输入区
         self.intro_structure_label = QLabel("1. 请输入导语结构分析 + 参照核心梗：")
@@ -119,6 +115,9 @@ class MainWindow(QMainWindow):
         # 开始按钮
         self.start_btn = QPushButton("开始创作导语")
         self.start_btn.clicked.connect(self.start_generation)
+        self.stop_btn = QPushButton("停止")
+        self.stop_btn.setEnabled(False)
+        self.stop_btn.clicked.connect(self.stop_generation)
 
         # 日志显示
         self.log_text = QTextEdit()
@@ -126,12 +125,13 @@ class MainWindow(QMainWindow):
 
         # 布局
         layout.addWidget(self.dir_label)
-        layout.addWidget(self.dir_btn)
+        layout.addWidget(self.dir_input)
         layout.addWidget(self.intro_structure_label)
         layout.addWidget(self.intro_structure_input)
         layout.addWidget(self.instruction_prompt_label)
         layout.addWidget(self.instruction_prompt_input)
         layout.addWidget(self.start_btn)
+        layout.addWidget(self.stop_btn)
         layout.addWidget(QLabel("运行日志:"))
         layout.addWidget(self.log_text)
 
@@ -142,12 +142,6 @@ class MainWindow(QMainWindow):
         logging.getLogger().addHandler(self.log_handler)
         logging.getLogger().setLevel(logging.INFO)
 
-    def select_output_dir(self):
-        dir_path = QFileDialog.getExistingDirectory(self, "选择输出文件夹")
-        if dir_path:
-            self.output_dir = dir_path
-            self.dir_label.setText(f"输出目录: {self.output_dir}")
-
     def append_log(self, msg):
         self.log_text.append(msg)
 
@@ -167,16 +161,22 @@ class MainWindow(QMainWindow):
         self.append_log("⏳ 正在处理请求...")
 
         self.worker = WorkerThread(
-            self.output_dir,
+            self.dir_input.text().strip(),
             intro_structure,
             instruction_prompt
         )
         self.worker.log_signal.connect(self.append_log)
         self.worker.finished_signal.connect(self.on_finished)
         self.worker.start()
+        self.stop_btn.setEnabled(True)
+
+    def stop_generation(self):
+        self.stop_btn.setEnabled(False)
+        self.worker.cancel()
 
     def on_finished(self):
         self.start_btn.setEnabled(True)
+        self.stop_btn.setEnabled(False)
         self.append_log("✨ 任务结束。")
 
 if __name__ == '__main__':
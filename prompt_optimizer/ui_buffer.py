@@ -0,0 +1,64 @@
+from PyQt5.QtCore import QObject, QTimer
+from PyQt5.QtGui import QTextCursor
+from config import config
+
+
+class ChunkBuffer(QObject):
+    """
+    流式输出的合并缓冲：收到的 delta 先攒起来，由定时器按固定频率一次性写入 QTextEdit，
+    避免每个 delta 都触发一次插入和重绘
+    一次输出开始前调用 mark()，中途作废重试时 reset() 删掉 mark 之后已显示的半截内容
+    """
+
+    def __init__(self, text_edit, interval_ms=config['ui_flush_interval_ms'], parent=None):
+        super().__init__(parent)
+        self.text_edit = text_edit
+        self._chunks = []
+        self._mark = 0
+        self._timer = QTimer(self)
+        self._timer.setInterval(interval_ms)
+        self._timer.timeout.connect(self.flush)
+
+    def append(self, chunk):
+        self._chunks.append(chunk)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self):
+        if not self._chunks:
+            self._timer.stop()
+            return
+        text = ''.join(self._chunks)
+        self._chunks.clear()
+        cursor = self.text_edit.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+        self.text_edit.setTextCursor(cursor)
+        self.text_edit.ensureCursorVisible()
+
+    def clear(self):
+        self._chunks.clear()
+        self._timer.stop()
+
+    def _end(self):
+        cursor = self.text_edit.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        return cursor.position()
+
+    def mark(self):
+        self.flush()
+        self._mark = self._end()
+
+    def reset(self):
+        self.clear()
+        cursor = self.text_edit.textCursor()
+        cursor.setPosition(min(self._mark, self._end()))
+        cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+
+
+def limit_scrollback(text_edit, max_lines=config['ui_log_max_lines']):
+    """
+    限制日志框保留的行数，超出后自动丢弃最早的内容
+    """
+    text_edit.document().setMaximumBlockCount(max_lines)